@@ -1,16 +1,53 @@
+import builtins
+import concurrent.futures
+import contextlib
+import errno
+import hashlib
+import importlib
+import itertools
+import json
+import multiprocessing
 import os
 import re
 import shlex
 import shutil
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import time
+import traceback
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
 
 import expandvars
 import kdl
+from kdl.errors import ParseError
 from termcolor import colored
 
+from .cache import cache_directory
+from .conditions import evaluate
+from .context import EnvironmentOverlay, ExecutionContext
+from .globbing import DirectoryCache, has_magic
+from .events import EventWriter
+from .history import record_run
+from .journal import Journal, file_hashes, journal_path, load_journal
+from .jobserver import JobServer
+from .output import CapturedOutput, OutputFilter, OutputMultiplexer, pipe
+from .scheduling import SCHEDULING_PROPERTIES, describe, scheduling_function
+from .scratch import DEFAULT_SCRATCH_SIZE, ScratchDirectory, parse_size
+from .timeouts import (
+    TIMEOUT_STATUS,
+    Deadline,
+    earliest,
+    parse_duration,
+    process_group_options,
+    signal_group,
+    terminate,
+)
+from .workers import WorkerError, WorkerPool
+
 
 @dataclass
 class NormalizedNode:
@@ -44,6 +81,10 @@ def _normalize_nodes(nodes) -> List[NormalizedNode]:
 _KDL_PATCHED = False
 
 
+class _Unquoted(str):
+    """A value written without quotes (a bare identifier), which is glob-expanded by default."""
+
+
 def _ensure_kdl_supports_bare_identifiers():
     global _KDL_PATCHED
     if _KDL_PATCHED:
@@ -61,6 +102,7 @@ def _ensure_kdl_supports_bare_identifiers():
             tag = None
 
         value_start = i
+        unquoted = False
         val, i = parsefuncs.parseNumber(stream, i)
         if val is Failure:
             val, i = parsefuncs.parseKeyword(stream, i)
@@ -71,6 +113,7 @@ def _ensure_kdl_supports_bare_identifiers():
                     if ident is not Failure:
                         val = kdl_types.String(ident)
                         i = ident_end
+                        unquoted = True
 
         if val is not Failure:
             val.tag = tag
@@ -92,6 +135,8 @@ def _ensure_kdl_supports_bare_identifiers():
                         val,
                         ParseFragment(stream[value_start:i], stream, i),
                     )
+            if unquoted and type(val) is str:
+                val = _Unquoted(val)
             return Result((None, val), i)
 
         if stream[i] == "'":
@@ -109,10 +154,138 @@ def _ensure_kdl_supports_bare_identifiers():
     _KDL_PATCHED = True
 
 
+# Variables the shell itself maintains; they never count as changes made by a sourced script
+_SOURCE_IGNORED_VARIABLES = {"PWD", "OLDPWD", "SHLVL", "_", "COLUMNS", "LINES"}
+
+# Variables left out of the cache key of sourced scripts, because they differ from run to run
+# (e.g. the jobserver fifo in MAKEFLAGS)
+_SOURCE_KEY_IGNORED_VARIABLES = _SOURCE_IGNORED_VARIABLES | {"MAKEFLAGS"}
+
+_BUILTINS = (
+    "exit", "cd", "test", "lus", "wait", "each", "py", "export", "set", "call", "source"
+)
+
+_DUMP_ENVIRONMENT = "import json, os, sys; json.dump(dict(os.environ), sys.stdout)"
+
+_ANSI_ESCAPE = re.compile(r"\x1B\[[0-?]*[ -/]*[@-~]")
+
+
+def _argument_limit(environ: Mapping[str, str]) -> int:
+    """Space available for the arguments of a new process, in the unit of _argument_size."""
+    if os.name == "nt":
+        # Maximum length of a command line, minus some room for quoting
+        return 32767 - 2048
+    try:
+        limit = os.sysconf("SC_ARG_MAX")
+    except (ValueError, OSError):
+        limit = 128 * 1024
+    if limit <= 0:
+        limit = 128 * 1024
+    # The environment is passed in the same space. Leave some headroom like xargs does.
+    limit -= sum(len(k) + len(v) + 2 + 8 for k, v in environ.items())
+    return max(limit - 2048, 4096)
+
+
+def _argument_size(arg: str) -> int:
+    if os.name == "nt":
+        return len(arg) + 3  # quotes and separating space
+    # Terminating NUL and the pointer in argv
+    return len(os.fsencode(arg)) + 1 + 8
+
+
+# `py module:function` instead of code
+_PYTHON_REFERENCE = re.compile(r"^[A-Za-z_][\w.]*:[A-Za-z_][\w.]*$")
+
+
+@contextlib.contextmanager
+def _redirected_output(path: Optional[str]) -> Iterator[None]:
+    """Redirect stdout and stderr of this process to the file or FIFO path (unless it's None)."""
+    if path is None:
+        yield
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    output_fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    saved = [os.dup(1), os.dup(2)]
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, saved_fd in enumerate(saved, 1):
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+
+
+def _run_python(
+    code: str,
+    args: List[str],
+    cwd: str = None,
+    environ: Dict[str, str] = None,
+    output: str = None,
+) -> int:
+    """Run Python code or call a module:function in this process and return the exit status.
+
+    cwd, environ and output (a file or FIFO for stdout and stderr) are used when this runs in a
+    worker process.
+    """
+    if cwd is not None:
+        os.chdir(cwd)
+    if environ is not None:
+        os.environ.clear()
+        os.environ.update(environ)
+    with _redirected_output(output):
+        return _call_python(code, args)
+
+
+def _call_python(code: str, args: List[str]) -> int:
+    old_argv = sys.argv
+    # Like `python -c`, modules next to the working directory can be imported
+    search_path = os.getcwd()
+    sys.path.insert(0, search_path)
+    try:
+        if _PYTHON_REFERENCE.match(code):
+            module_name, function_name = code.split(":")
+            sys.argv = [code] + args
+            function = importlib.import_module(module_name)
+            for name in function_name.split("."):
+                function = getattr(function, name)
+            # Called like a console_scripts entry point
+            result = function()
+            status = result if isinstance(result, int) else 0
+        else:
+            sys.argv = ["-c"] + args
+            exec(
+                compile(code, "<py>", "exec"),
+                {"__name__": "__main__", "__builtins__": builtins},
+            )
+            status = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            status = 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.argv = old_argv
+        if search_path in sys.path:
+            sys.path.remove(search_path)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return status
+
+
 class Environment:
-    def __init__(self, variables: Dict[str, str]):
+    def __init__(self, variables: Dict[str, str], environ: Mapping[str, str] = os.environ):
         self.args_used = False
         self.variables = variables
+        self.environ = environ
         assert "args" in variables
 
     def get(self, key: str, fallback: str = None) -> str:
@@ -120,33 +293,296 @@ class Environment:
             if key == "args":
                 self.args_used = True
             return self.variables[key]
-        return os.environ.get(key, fallback)
+        return self.environ.get(key, fallback)
 
 
 class LusFile:
     @staticmethod
     def _strip_ansi(text: str) -> str:
         # Remove ANSI escape codes for visible width calculation
-        return re.sub(r"\x1b\[[0-9;]*m", "", text)
+        return _ANSI_ESCAPE.sub("", text)
 
     def __init__(
-        self, content: str, invocation_directory: str = None, args: List[str] = None
+        self,
+        content: str,
+        invocation_directory: str = None,
+        args: List[str] = None,
+        output: str = "inherit",
+        history: bool = False,
+        jobs: Optional[int] = None,
+        execute: bool = True,
+        nodes: Optional[List[NormalizedNode]] = None,
+        includes: Optional[Dict[str, Tuple[List[NormalizedNode], Dict[str, str]]]] = None,
+        events: Optional[EventWriter] = None,
+        journal: bool = False,
+        resume: bool = False,
+        project_root: Optional[str] = None,
+        filters: Iterable[str] = (),
+        deadline: Optional[Deadline] = None,
     ):
         _ensure_kdl_supports_bare_identifiers()
         self._raw_content = content
-        self.main_lus_kdl = _normalize_nodes(kdl.parse(content).nodes)
-        self.print_commands = True
+        # nodes and includes allow reusing what has been parsed before (see LusProject)
+        self.main_lus_kdl = (
+            nodes if nodes is not None else _normalize_nodes(kdl.parse(content).nodes)
+        )
+        self._project_root = project_root or os.getcwd()
+        self._invocation_directory = invocation_directory or self._project_root
+        # Working directory, environment variables and print settings of the commands
+        self.context = ExecutionContext(self._project_root)
         self.local_variables = {}
         self._piped = not sys.stdout.isatty()
-        self._old_working_directory = os.getcwd()
-        self._invocation_directory = invocation_directory or os.getcwd()
+        # Whether runs are recorded in the run history
+        self._history = history
+        self._events = events
+        # Journal of the finished steps for --resume, see journal.py
+        self._journal_enabled = journal
+        self._resume = resume
+        self._journal: Optional[Journal] = None
+        # Finished steps of the resumed run (in reverse order), skipped while they match
+        self._resume_steps: List[Dict[str, Any]] = []
+        # Index path of the current node (e.g. [2, 0] for the first child of the third node) and
+        # how many commands each node has run, which identify the steps in the journal
+        self._node_path: List[int] = []
+        self._step_counts: Dict[Tuple[int, ...], int] = {}
+        # (argv, task path, start time) of running processes by pid, for the exit events
+        self._processes: Dict[int, Tuple[List[str], List[str], float]] = {}
+        # Deadline of the whole run (--deadline) and the one of the current command, which
+        # timeout= of the command and its enclosing subcommands may make earlier
+        self._run_deadline = deadline
+        self._deadline: Optional[Deadline] = None
+        # Processes that were started with a deadline, by pid
+        self._timed_processes: Dict[int, Tuple[subprocess.Popen, Deadline]] = {}
+        # Scratch directory of the innermost subcommand with scratch=, and that subcommand
+        self._scratch: Optional[Tuple[ScratchDirectory, str]] = None
         self._subcommand_comments = self._extract_top_level_comments(content)
         self._aliases = self._compute_aliases(self.main_lus_kdl)
-
-        if self.main_lus_kdl:
-            self.check_args(
-                self.main_lus_kdl, args if args is not None else sys.argv[1:], True
+        self._includes: Dict[str, Tuple[List[NormalizedNode], Dict[str, str]]] = (
+            includes if includes is not None else {}
+        )
+        # Directory of the lus.kdl whose nodes run, which its include paths are relative to
+        self._file_directory = self._project_root
+        # Subcommand names of included files by path, with their mtime and size (see
+        # _include_names), loaded from the cache directory on first use
+        self._include_index: Optional[Dict[str, Any]] = None
+        # Filters for the output of commands (see OUTPUT_FILTERS), which then has to be captured
+        self._filters = tuple(filters)
+        self._output = (
+            OutputMultiplexer(output) if output != "inherit" or self._filters else None
+        )
+        self._task_path: List[str] = []
+        # Properties of the enclosing subcommand nodes that apply to all commands inside
+        self._node_properties: Dict[str, Any] = {}
+        # Worker processes for `py` with isolate=true
+        self._python_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        # Maximum number of parallel jobs given with -j, shared with children through a jobserver
+        self._jobs = jobs
+        self._jobserver: Optional[JobServer] = None
+        # Tools started with worker=true, kept running for the rest of the run
+        self._workers = WorkerPool()
+        # Shared by all glob patterns, invalidated whenever a command runs
+        self._directory_cache = DirectoryCache()
+        # Commands started with `&`, by job id
+        self._background_jobs: Dict[
+            int, Tuple[List[str], subprocess.Popen, Optional[CapturedOutput]]
+        ] = {}
+        self._next_job_id = 1
+        # (command, task path, working directory, properties) of the commands plan() found
+        self._plan: Optional[List[Tuple[List[str], List[str], str, Dict[str, Any]]]] = None
+        # (command, duration in seconds, exit status) of every command that has been run
+        self.command_timings: List[Tuple[str, float, int]] = []
+
+        if self.main_lus_kdl and execute:
+            args = args if args is not None else sys.argv[1:]
+            self._check_args_and_record(args)
+
+    @property
+    def print_commands(self) -> bool:
+        return self.context.print_commands
+
+    @print_commands.setter
+    def print_commands(self, value: bool):
+        self.context.print_commands = value
+
+    def execute(self, args: List[str]):
+        """Run args on the already parsed lus.kdl, e.g. repeatedly for benchmarks.
+
+        Every call starts from the same state: each run gets a fresh execution context, so
+        `cd`, `export` and settings like `set +x` don't carry over.
+        """
+        self.local_variables = {}
+        self._task_path = []
+        self._node_properties = {}
+        self._directory_cache.invalidate()
+        self._check_args_and_record(args)
+
+    def plan(self, args: List[str]) -> List[Tuple[List[str], List[str], str, Dict[str, Any]]]:
+        """Resolve args into the commands they would run, without running them.
+
+        Only `cd`, `export` and `set` are applied, so that the following commands are resolved
+        like in a real run. Returns (command, task path, working directory, properties) tuples.
+        """
+        self._plan = []
+        try:
+            self.execute(args)
+            return self._plan
+        finally:
+            self._plan = None
+
+    def _check_args_and_wait(self, args: List[str]):
+        self._jobserver = JobServer.from_environment()
+        if self._jobserver is None and self._jobs is not None and self._jobs > 1:
+            self._jobserver = JobServer.create(self._jobs)
+        if self._jobserver is not None:
+            self._jobserver.__enter__()
+        # Taken after entering the jobserver, so that children see its MAKEFLAGS
+        self.context = ExecutionContext(self._project_root, EnvironmentOverlay.from_process())
+        self._file_directory = self._project_root
+        self._deadline = self._run_deadline
+        try:
+            self.check_args(self.main_lus_kdl, args, True)
+        except BaseException:
+            # Don't leave e.g. servers started with `&` running after a failure
+            for _, process, _ in self._background_jobs.values():
+                if process.poll() is None:
+                    process.terminate()
+            # Commands with a deadline run in their own process group, which e.g. doesn't get
+            # the SIGINT of Ctrl+C from the terminal
+            for process, _ in list(self._timed_processes.values()):
+                if process.poll() is None:
+                    signal_group(process, signal.SIGTERM)
+            raise
+        finally:
+            self._workers.close()
+            if self._python_pool is not None:
+                self._python_pool.shutdown()
+                self._python_pool = None
+        try:
+            # Like a shell script, lus is only done once its background jobs are
+            status = self._wait_for_jobs(list(self._background_jobs))
+            if status != 0:
+                raise SystemExit(status)
+        finally:
+            if self._jobserver is not None:
+                self._jobserver.__exit__(None, None, None)
+                self._jobserver = None
+
+    def _check_args_and_record(self, args: List[str]):
+        """_check_args_and_wait, recording the run in the history, journal and event stream."""
+        journaling = self._journal_enabled and "-l" not in args
+        if not (self._history and "-l" not in args) and self._events is None and not journaling:
+            return self._check_args_and_wait(args)
+        if journaling:
+            self._start_journal(args)
+        self._emit("run-start", args=args)
+        started = time.time()
+        status = 1
+        try:
+            self._check_args_and_wait(args)
+            status = 0
+        except SystemExit as e:
+            status = self._exit_status(e)
+            raise
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+            raise
+        except KeyboardInterrupt:
+            status = 130
+            raise
+        finally:
+            if self._history and "-l" not in args:
+                record_run(self._project_root, args, started, status, self.command_timings)
+            if journaling:
+                self._journal.close(status == 0, list(self._includes))
+                self._journal = None
+            self._emit("run-finish", args=args, status=status, duration=time.time() - started)
+
+    def _start_journal(self, args: List[str]):
+        path = journal_path(self._project_root, args)
+        lus_kdl_hash = hashlib.sha256(
+            self._raw_content.encode("utf-8", "surrogateescape")
+        ).hexdigest()
+        command = shlex.join(["lus"] + args)
+        self._resume_steps = []
+        if self._resume:
+            previous = load_journal(path)
+            if previous is None:
+                print(
+                    f"{colored('note:', 'blue', attrs=['bold'])} There's no failed run of "
+                    f"`{command}` to resume, running it from the start",
+                    file=sys.stderr,
+                    flush=True,
+                )
+            else:
+                header, steps = previous
+                includes = header.get("includes", {})
+                if header["lus_kdl"] != lus_kdl_hash or file_hashes(list(includes)) != includes:
+                    print(
+                        f"{colored('error:', 'red', attrs=['bold'])} Can't resume `{command}`, "
+                        f"lus.kdl has changed since it failed",
+                        file=sys.stderr,
+                    )
+                    raise SystemExit(1)
+                print(
+                    f"{colored('note:', 'blue', attrs=['bold'])} Resuming `{command}` after "
+                    f"{len(steps)} finished steps",
+                    file=sys.stderr,
+                    flush=True,
+                )
+                self._resume_steps = steps[::-1]
+        self._node_path = []
+        self._step_counts = {}
+        self._journal = Journal(path, {"args": args, "lus_kdl": lus_kdl_hash})
+
+    def _next_step(self, args: List[str]) -> Dict[str, Any]:
+        node = tuple(self._node_path)
+        occurrence = self._step_counts.get(node, 0)
+        self._step_counts[node] = occurrence + 1
+        return {"node": list(node), "occurrence": occurrence, "argv": args}
+
+    def _skip_finished_step(self, step: Dict[str, Any]) -> bool:
+        """Whether step finished in the resumed run, restoring the state after it if so."""
+        if not self._resume_steps:
+            return False
+        finished = self._resume_steps[-1]
+        if any(finished[key] != step[key] for key in ("node", "occurrence", "argv")):
+            # From here on this run differs from the failed one, so nothing is skipped anymore
+            self._resume_steps = []
+            return False
+        self._resume_steps.pop()
+        if "&" in step["argv"]:
+            return False  # the following steps may need the background processes
+        self.context.cwd = finished["cwd"]
+        self.context.environ.reset(
+            finished["environment"]["set"], finished["environment"]["unset"]
+        )
+        self.print_commands = finished["print_commands"]
+        if self.print_commands:
+            self._print(
+                colored(shlex.join(step["argv"]), attrs=["bold"])
+                + " "
+                + colored("# finished before, skipped", "green")
             )
+        self._emit("skipped", argv=step["argv"], task=list(self._task_path))
+        self._journal.record(finished)
+        return True
+
+    def _record_step(self, step: Dict[str, Any]):
+        changed, unset = self.context.environ.changes()
+        self._journal.record(
+            dict(
+                step,
+                cwd=self.context.cwd,
+                environment={"set": changed, "unset": unset},
+                print_commands=self.print_commands,
+            )
+        )
+
+    @staticmethod
+    def _exit_status(e: SystemExit) -> int:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
 
     def _extract_top_level_comments(self, content: str) -> Dict[str, str]:
         comments = {}
@@ -179,7 +615,7 @@ class LusFile:
     def _compute_aliases(self, nodes: List[NormalizedNode]) -> Dict[str, str]:
         aliases: Dict[str, str] = {}
         for node in nodes:
-            if node.name in ("", "$", "-"):
+            if node.name in ("", "$", "-") or self._is_conditional(node):
                 continue
             if len(node.children) != 1:
                 continue
@@ -197,24 +633,624 @@ class LusFile:
                     aliases[node.name] = args[0]
         return aliases
 
-    def print_command(self, args: List[str]):
-        if self.print_commands:
-            self._print(colored(shlex.join(args), attrs=["bold"]))
+    def _emit(self, event: str, **fields: Any):
+        if self._events is not None:
+            self._events.emit(event, **fields)
+
+    def print_command(self, args: List[str], properties: Dict[str, Any] = None):
+        if self.print_commands and self._plan is None:
+            message = colored(shlex.join(args), attrs=["bold"])
+            scheduling = describe(self._scheduling(properties)) if properties is not None else ""
+            if scheduling:
+                message += " " + colored(f"# {scheduling}", "blue")
+            self._print(message)
+
+    def _scheduling(self, properties: Dict[str, Any]) -> Dict[str, Any]:
+        """Scheduling properties of a command, including those of the enclosing subcommands."""
+        result = dict(self._node_properties)
+        result.update(
+            (key, properties[key]) for key in SCHEDULING_PROPERTIES if key in properties
+        )
+        return result
+
+    def _output_filter(self) -> Optional[OutputFilter]:
+        return OutputFilter.from_environment(self._filters, self.context.environ)
 
     def _print(self, message: str):
         if self._piped:
             # strip ANSI escape codes
-            ansi_escape = re.compile(r'\x1B\[[0-?]*[ -/]*[@-~]')
-            message = ansi_escape.sub('', message)
-        print(message, flush=True)
+            message = _ANSI_ESCAPE.sub("", message)
+        if self._output is not None:
+            data = f"{message}\n".encode()
+            output_filter = self._output_filter()
+            if output_filter is not None:
+                # Commands are printed with their arguments, which may contain secrets
+                data = output_filter.apply(data)
+            self._output.write(data)
+        else:
+            print(message, flush=True)
+
+    def _spawn(
+        self, args: List[str], properties: Dict[str, Any], **kwargs
+    ) -> Tuple[subprocess.Popen, Optional[CapturedOutput]]:
+        self._directory_cache.invalidate()
+        apply_scheduling = scheduling_function(self._scheduling(properties))
+        deadline = self._deadline
+        if deadline is not None and os.name != "nt":
+            # So that everything the command starts can be stopped together
+            kwargs.update(process_group_options())
+        if self._jobserver is not None and self._jobserver.pass_fds:
+            kwargs["pass_fds"] = self._jobserver.pass_fds
+        kwargs.setdefault("cwd", self.context.cwd)
+        kwargs.setdefault("env", self.context.environ.to_dict())
+        if self._output is None:
+            process = subprocess.Popen(args, **kwargs)
+            captured = None
+        else:
+            read_fd, write_fd = pipe()
+            try:
+                process = subprocess.Popen(
+                    args, stdout=write_fd, stderr=write_fd, **kwargs
+                )
+            except BaseException:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            label = " ".join(self._task_path) or os.path.basename(args[0])
+            captured = self._output.capture(read_fd, label, self._output_filter())
+        if apply_scheduling is not None:
+            apply_scheduling(process.pid)
+        if deadline is not None:
+            self._timed_processes[process.pid] = (process, deadline)
+        if self._events is not None:
+            task = list(self._task_path)
+            self._processes[process.pid] = (args, task, time.perf_counter())
+            self._emit("spawn", argv=args, pid=process.pid, task=task)
+        return process, captured
+
+    def _wait(
+        self, process: subprocess.Popen, captured: Optional[CapturedOutput]
+    ) -> int:
+        timed = self._timed_processes.get(process.pid)
+        if timed is None:
+            status = process.wait()
+        else:
+            deadline = timed[1]
+            try:
+                status = process.wait(deadline.remaining())
+            except subprocess.TimeoutExpired:
+                status = self._stop(process, deadline)
+            del self._timed_processes[process.pid]
+        self._directory_cache.invalidate()
+        if self._events is not None:
+            argv, task, started = self._processes.pop(process.pid)
+            self._emit(
+                "exit",
+                argv=argv,
+                pid=process.pid,
+                task=task,
+                status=status,
+                duration=time.perf_counter() - started,
+            )
+        if captured is not None:
+            captured.finish(status)
+        return status
+
+    def _run_python_here(self, args: List[str]) -> int:
+        """Run `py` in the lus process, with its output captured like that of commands."""
+        if self._output is None:
+            with self.context.applied():
+                return _call_python(args[1], args[2:])
+        read_fd, write_fd = pipe()
+        label = " ".join(self._task_path) or args[0]
+        captured = self._output.capture(read_fd, label, self._output_filter())
+        status = 1
+        try:
+            with open(
+                write_fd, "w", encoding="utf-8", errors="surrogateescape", buffering=1
+            ) as stream, contextlib.redirect_stdout(stream), contextlib.redirect_stderr(
+                stream
+            ), self.context.applied():
+                status = _call_python(args[1], args[2:])
+        finally:
+            captured.finish(status)
+        return status
+
+    def _run_python_isolated(self, args: List[str]) -> int:
+        """Run `py` in a worker process, which is killed when the deadline passes."""
+        if self._python_pool is None:
+            # Forked workers would inherit the pipes of whatever else is running, and with them
+            # the write end of the FIFO below, so that its reader never saw the end
+            context = None
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+            self._python_pool = concurrent.futures.ProcessPoolExecutor(mp_context=context)
+        deadline = self._deadline
+        captured = directory = output = None
+        if self._output is not None:
+            # The worker writes its output to a FIFO (a file where there are none) that is read
+            # like the pipe of a command
+            directory = tempfile.mkdtemp(prefix="lus-py-")
+            output = os.path.join(directory, "output")
+            if hasattr(os, "mkfifo"):
+                os.mkfifo(output)
+                read_fd = os.open(output, os.O_RDONLY | os.O_NONBLOCK)
+                # Held open until the call is done, so that the reader doesn't see the end of the
+                # output before the worker has opened the FIFO
+                write_fd = os.open(output, os.O_WRONLY)
+                os.set_blocking(read_fd, True)
+            else:
+                read_fd, write_fd = pipe()
+            label = " ".join(self._task_path) or args[0]
+            captured = self._output.capture(read_fd, label, self._output_filter())
+        status = 1
+        try:
+            future = self._python_pool.submit(
+                _run_python,
+                args[1],
+                args[2:],
+                self.context.cwd,
+                dict(self.context.environ.to_dict()),
+                output,
+            )
+            try:
+                status = future.result(deadline.remaining() if deadline is not None else None)
+            except concurrent.futures.TimeoutError:
+                self._report_timeout(args, deadline)
+                # The pool has no way to stop a single call, so it's replaced
+                for process in list(self._python_pool._processes.values()):
+                    process.kill()
+                self._python_pool.shutdown()
+                self._python_pool = None
+                status = TIMEOUT_STATUS
+        finally:
+            if captured is not None:
+                if not hasattr(os, "mkfifo") and os.path.exists(output):
+                    with open(output, "rb") as f, open(write_fd, "wb", closefd=False) as pipe_end:
+                        shutil.copyfileobj(f, pipe_end)
+                os.close(write_fd)
+                captured.finish(status)
+                shutil.rmtree(directory, ignore_errors=True)
+        return status
+
+    def _stop(self, process: subprocess.Popen, deadline: Deadline) -> int:
+        """Stop a process that has exceeded its deadline, returns TIMEOUT_STATUS."""
+        argv = process.args if isinstance(process.args, list) else [str(process.args)]
+        self._report_timeout(argv, deadline, process.pid)
+        terminate(process)
+        return TIMEOUT_STATUS
+
+    def _report_timeout(self, argv: List[str], deadline: Deadline, pid: Optional[int] = None):
+        print(
+            f"{colored('error:', 'red', attrs=['bold'])} `{shlex.join(argv)}` exceeded "
+            f"{deadline.reason} and was stopped",
+            file=sys.stderr,
+        )
+        self._emit(
+            "timeout",
+            argv=argv,
+            pid=pid,
+            task=list(self._task_path),
+            reason=deadline.reason,
+        )
+
+    def _timeout_deadline(self, value: Any, what: str) -> Deadline:
+        """The deadline of timeout=value, starting now."""
+        try:
+            seconds = parse_duration(value)
+        except ValueError as e:
+            print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+            raise SystemExit(1)
+        return Deadline.after(seconds, f"timeout={value}{what}")
+
+    def _worker_startup_count(self, value: Any, args: List[str]) -> int:
+        """The number of arguments of args that start the worker of worker=value."""
+        if value is True:
+            return 1
+        try:
+            count = int(value) if not isinstance(value, (bool, float)) else None
+        except ValueError:
+            count = None
+        if count is None or not 1 <= count <= len(args):
+            print(
+                f"{colored('error:', 'red', attrs=['bold'])} Invalid worker={value} for "
+                f"`{shlex.join(args)}`, expected true or the number of arguments that start "
+                f"the worker (1 to {len(args)})",
+                file=sys.stderr,
+            )
+            raise SystemExit(1)
+        return count
+
+    def _check_scheduling(self, properties: Dict[str, Any]):
+        """Report invalid nice=, cpus= or ionice= like other invalid properties."""
+        try:
+            scheduling_function(properties)
+        except ValueError as e:
+            print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+            raise SystemExit(1)
+
+    def _check_deadline(self, args: List[str]):
+        if self._deadline is not None and self._deadline.expired():
+            print(
+                f"{colored('error:', 'red', attrs=['bold'])} Exceeded {self._deadline.reason}, "
+                f"not running `{shlex.join(args)}`",
+                file=sys.stderr,
+            )
+            raise SystemExit(TIMEOUT_STATUS)
+
+    def _create_scratch(self, properties: Dict[str, Any], task: List[str]):
+        """Create the scratch directory of a subcommand with scratch=ram or scratch=disk."""
+        try:
+            size = parse_size(properties.get("scratch-size", DEFAULT_SCRATCH_SIZE))
+            scratch = ScratchDirectory.create(properties["scratch"], size, "-".join(task))
+        except ValueError as e:
+            print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+            raise SystemExit(1)
+        if properties["scratch"] == "ram" and not scratch.in_ram:
+            print(
+                f"{colored('note:', 'blue', attrs=['bold'])} Not enough memory for the scratch "
+                f"directory of `lus {' '.join(task)}`, using {scratch.path}",
+                file=sys.stderr,
+            )
+        self._scratch = (scratch, f"`lus {' '.join(task)}`")
+        # Also for the temporary files of the commands
+        self.context.environ["TMPDIR"] = scratch.path
+
+    def _check_scratch(self):
+        scratch, what = self._scratch
+        try:
+            scratch.check(what)
+        except ValueError as e:
+            print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+            raise SystemExit(1)
+
+    def _call(self, args: List[str], properties: Dict[str, Any], **kwargs):
+        """Like subprocess.check_call, but honors the output mode and scheduling properties."""
+        status = self._wait(*self._spawn(args, properties, **kwargs))
+        if status != 0:
+            raise subprocess.CalledProcessError(status, args)
 
     def run(self, args: List[str], properties: Dict[str, str]):
+        if self._plan is not None and (
+            args[0] not in ("lus", "cd", "export", "set")
+            or any(operator in args for operator in ("&", "&&", "||"))
+        ):
+            self._plan.append(
+                (args, list(self._task_path), self.context.cwd, dict(properties))
+            )
+            return
+        self._check_scheduling(self._scheduling(properties))
+        self._check_deadline(args)
+        outer_deadline = self._deadline
+        if "timeout" in properties:
+            self._deadline = earliest(
+                outer_deadline, self._timeout_deadline(properties["timeout"], "")
+            )
+        try:
+            self._run_recorded(args, properties)
+            if self._scratch is not None:
+                self._check_scratch()
+        finally:
+            self._deadline = outer_deadline
+
+    def _run_recorded(self, args: List[str], properties: Dict[str, str]):
+        if args[0] == "lus":
+            # Nested subcommands record their own commands
+            return self._run(args, properties)
+        step = None
+        if self._journal is not None:
+            step = self._next_step(args)
+            if self._skip_finished_step(step):
+                return
+        started = time.perf_counter()
+        status = 1
+        try:
+            self._run(args, properties)
+            status = 0
+            if step is not None:
+                self._record_step(step)
+        except SystemExit as e:
+            status = self._exit_status(e)
+            raise
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            self.command_timings.append((shlex.join(args), duration, status))
+            self._emit(
+                "command",
+                argv=args,
+                task=list(self._task_path),
+                status=status,
+                duration=duration,
+            )
+
+    def _run(self, args: List[str], properties: Dict[str, str]):
+        if "&" in args:
+            return self._run_background(args, properties)
         if "&&" in args or "||" in args:
             return self._run_chained(args, properties)
         status, _ = self._run_single(args, properties)
         if status != 0:
             raise SystemExit(status)
 
+    def _run_background(self, args: List[str], properties: Dict[str, str]):
+        segments = [[]]
+        for arg in args:
+            if arg == "&":
+                if len(segments[-1]) == 0:
+                    raise SystemExit(1)
+                segments.append([])
+            else:
+                segments[-1].append(arg)
+
+        # Every segment but the last one was followed by `&`
+        for segment in segments[:-1]:
+            if segment[0] in _BUILTINS or "&&" in segment or "||" in segment:
+                raise ValueError(
+                    f"Only single external commands can run in the background: {shlex.join(segment)}"
+                )
+            self.print_command(segment + ["&"], properties)
+            command = segment
+            if "/" in command[0] and not os.path.isabs(command[0]):
+                command = [self.context.path(command[0])] + command[1:]
+            process, captured = self._spawn(command, properties, shell=os.name == "nt")
+            self._background_jobs[self._next_job_id] = (segment, process, captured)
+            self._next_job_id += 1
+
+        if len(segments[-1]) > 0:
+            self._run(segments[-1], properties)
+
+    def _wait_for_jobs(self, job_ids: List[int]) -> int:
+        """Wait for the given background jobs and return the first non-zero exit status."""
+        failed_status = 0
+        for job_id in job_ids:
+            _, process, captured = self._background_jobs.pop(job_id)
+            status = self._wait(process, captured)
+            if status != 0 and failed_status == 0:
+                failed_status = status
+        return failed_status
+
+    def _run_parallel(
+        self,
+        commands: Iterable[List[str]],
+        jobs: int,
+        properties: Dict[str, Any],
+        on_exit: Optional[Callable[[List[str], int, float], None]] = None,
+    ) -> int:
+        """Run commands with at most `jobs` of them at the same time.
+
+        commands is only consumed as fast as the commands finish, so it can be a lazy stream.
+        With a jobserver, every command but one (which uses the implicit job slot of lus) needs
+        a token from it, so that lus and e.g. the make processes it starts share one job limit.
+        on_exit is called with each command, its exit status and duration (from the thread that
+        waited for it). Returns the first non-zero exit status.
+        """
+        failed_status = 0
+        jobserver = self._jobserver
+
+        def wait(command, process, captured, token, started):
+            try:
+                status = self._wait(process, captured)
+            finally:
+                if token is not None:
+                    jobserver.release(token)
+            if on_exit is not None:
+                on_exit(command, status, time.perf_counter() - started)
+            return status
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            running = set()
+            # The command running in the implicit job slot
+            implicit = None
+            for command in commands:
+                token = None
+                while True:
+                    if len(running) >= jobs:
+                        concurrent.futures.wait(
+                            running, return_when=concurrent.futures.FIRST_COMPLETED
+                        )
+                    done = {future for future in running if future.done()}
+                    for future in done:
+                        if future.result() != 0 and failed_status == 0:
+                            failed_status = future.result()
+                    running -= done
+                    if implicit in done:
+                        implicit = None
+                    if len(running) >= jobs:
+                        continue
+                    if jobserver is None or implicit is None:
+                        break
+                    # Check every now and then if the implicit slot got free in the meantime
+                    token = jobserver.acquire(timeout=0.1)
+                    if token is not None:
+                        break
+                executable = command
+                if "/" in command[0] and not os.path.isabs(command[0]):
+                    executable = [self.context.path(command[0])] + command[1:]
+                started = time.perf_counter()
+                try:
+                    process, captured = self._spawn(
+                        executable, properties, shell=os.name == "nt"
+                    )
+                except BaseException:
+                    if token is not None:
+                        jobserver.release(token)
+                    raise
+                future = executor.submit(wait, command, process, captured, token, started)
+                if jobserver is not None and token is None:
+                    implicit = future
+                running.add(future)
+            for future in concurrent.futures.as_completed(running):
+                if future.result() != 0 and failed_status == 0:
+                    failed_status = future.result()
+        return failed_status
+
+    def _run_chunked(
+        self, args: List[str], variable_part: Tuple[int, int], properties: Dict[str, Any]
+    ):
+        """Run args in batches so that each command line fits the system's limit.
+
+        Only the variable part (from $args or a glob pattern) is split up, the rest of the
+        arguments is repeated for each batch.
+        """
+        start, end = variable_part
+        prefix, items, suffix = args[:start], args[start:end], args[end:]
+        limit = _argument_limit(self.context.environ) - sum(
+            _argument_size(arg) for arg in prefix + suffix
+        )
+
+        batches = []
+        batch: List[str] = []
+        size = 0
+        for item in items:
+            item_size = _argument_size(item)
+            if batch and size + item_size > limit:
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(item)
+            size += item_size
+        batches.append(batch)
+
+        jobs = int(properties.get("jobs", 1))
+        if jobs <= 1 or len(batches) == 1 or self._plan is not None:
+            for batch in batches:
+                self.run(prefix + batch + suffix, properties)
+            return
+        if prefix[0] in _BUILTINS or properties.get("worker", False) is not False:
+            raise ValueError(
+                f"jobs= only works for external commands: {shlex.join(prefix + ['...'] + suffix)}"
+            )
+
+        # Like run() does for a single command, the batches are journaled, timed and reported
+        # as commands of their own
+        steps: Dict[int, Dict[str, Any]] = {}
+        statuses: Dict[int, int] = {}
+        # Batch index by id() of the command lists passed to _run_parallel
+        indexes: Dict[int, int] = {}
+
+        def commands() -> Iterator[List[str]]:
+            for index, batch in enumerate(batches):
+                command = prefix + batch + suffix
+                indexes[id(command)] = index
+                if self._journal is not None:
+                    steps[index] = self._next_step(command)
+                    if self._skip_finished_step(steps[index]):
+                        statuses[index] = 0
+                        continue
+                self._check_deadline(command)
+                self.print_command(command, properties)
+                yield command
+
+        def on_exit(command: List[str], status: int, duration: float):
+            statuses[indexes[id(command)]] = status
+            self.command_timings.append((shlex.join(command), duration, status))
+            self._emit(
+                "command",
+                argv=command,
+                task=list(self._task_path),
+                status=status,
+                duration=duration,
+            )
+
+        outer_deadline = self._deadline
+        if "timeout" in properties:
+            self._deadline = earliest(
+                outer_deadline, self._timeout_deadline(properties["timeout"], "")
+            )
+        try:
+            status = self._run_parallel(commands(), jobs, properties, on_exit)
+        finally:
+            self._deadline = outer_deadline
+            # Resuming goes through the steps in order, so only those up to the first batch
+            # that failed (or didn't run) count as finished
+            for index in sorted(steps):
+                if statuses.get(index) != 0:
+                    break
+                self._record_step(steps[index])
+        if self._scratch is not None:
+            self._check_scratch()
+        if status != 0:
+            raise SystemExit(status)
+
+    def _run_each(self, args: List[str], properties: Dict[str, Any]) -> int:
+        """each [-j jobs] [-n max-items] [-a file] [item ...] -- command [arg ...]"""
+        if "--" not in args:
+            raise ValueError("'each' requires -- before the command")
+        separator = args.index("--")
+        options, command = args[1:separator], args[separator + 1 :]
+        if len(command) == 0:
+            raise ValueError("'each' requires a command after --")
+
+        jobs = self._jobs or os.cpu_count() or 1
+        max_items = 1
+        items_file = None
+        items: List[str] = []
+        option_iter = iter(options)
+        for option in option_iter:
+            # Like for getopt, options end at the first item, which may start with - itself
+            if not items and option[:2] in ("-j", "-n", "-a"):
+                value = option[2:] or next(option_iter, None)
+                if value is None:
+                    raise ValueError(f"'each': {option} requires a value")
+                if option[:2] == "-a":
+                    items_file = value
+                else:
+                    try:
+                        number = int(value)
+                    except ValueError:
+                        raise ValueError(f"'each': invalid number for {option[:2]}: {value}")
+                    if number < 1:
+                        raise ValueError(f"'each': {option[:2]} must be at least 1")
+                    if option[:2] == "-j":
+                        jobs = number
+                    else:
+                        max_items = number
+            else:
+                items.append(option)
+
+        if max_items > 1 and any(arg != "{}" and "{}" in arg for arg in command):
+            raise ValueError("'each': {} inside an argument only works with -n 1")
+
+        def read_lines(f) -> Iterator[str]:
+            for line in f:
+                line = line.rstrip("\r\n")
+                if line:
+                    yield line
+
+        def stream() -> Iterator[str]:
+            # stdin only when asked for, as e.g. on CI it may be open without ever ending
+            if items_file == "-":
+                yield from read_lines(sys.stdin)
+            elif items_file is not None:
+                with open(self.context.path(items_file), "r") as f:
+                    yield from read_lines(f)
+            else:
+                yield from items
+
+        def commands() -> Iterator[List[str]]:
+            item_stream = stream()
+            while True:
+                batch = list(itertools.islice(item_stream, max_items))
+                if not batch:
+                    return
+                if not any("{}" in arg for arg in command):
+                    yield command + batch
+                    continue
+                result = []
+                for arg in command:
+                    if arg == "{}":
+                        result.extend(batch)
+                    else:
+                        result.append(arg.replace("{}", batch[0]))
+                yield result
+
+        self.print_command(args, properties)
+        return self._run_parallel(commands(), jobs, properties)
+
     def _run_chained(self, args: List[str], properties: Dict[str, str]):
         segments = []
         operators = []
@@ -279,20 +1315,19 @@ class LusFile:
         elif args[0] == "cd":
             self.print_command(args)
             if len(args) == 2 and args[1] == "-":
-                os.chdir(self._old_working_directory)
+                self.context.cwd = self.context.old_cwd
                 return 0, True
-            self._old_working_directory = os.getcwd()
-            os.chdir(args[1])
+            self.context.chdir(args[1])
             return 0, True
         elif args[0] == "test":
             if len(args) < 3:
                 raise NotImplementedError(f"test {args[1:]} not implemented")
             if args[1] == "-f" or args[1] == "-d":
-                exists = os.path.exists(args[2])
+                result = self._directory_cache.stat(self.context.path(args[2]))
                 if (
-                    not exists
-                    or (args[1] == "-f" and not os.path.isfile(args[2]))
-                    or (args[1] == "-d" and not os.path.isdir(args[2]))
+                    result is None
+                    or (args[1] == "-f" and not stat.S_ISREG(result.st_mode))
+                    or (args[1] == "-d" and not stat.S_ISDIR(result.st_mode))
                 ):
                     raise SystemExit(1)
                 return 0, True
@@ -310,19 +1345,56 @@ class LusFile:
                 raise NotImplementedError(f"test {args[1:]} not implemented")
             return 0, True
         elif args[0] == "lus":
-            old_cwd = os.getcwd()
             # print_command(args)
+            # Like a `lus` subprocess, the nested run can't change our directory or environment
+            context, file_directory = self.context, self._file_directory
+            self.context = context.copy()
+            self._file_directory = self._project_root
             try:
                 self.check_args(self.main_lus_kdl, args[1:], True)
             except SystemExit as e:
                 if e.code != 0:
                     raise SystemExit(e.code)
             finally:
-                os.chdir(old_cwd)
+                self.context, self._file_directory = context, file_directory
+            return 0, True
+        elif args[0] == "wait":
+            self.print_command(args)
+            job_ids = []
+            for arg in args[1:]:
+                try:
+                    job_id = int(arg.lstrip("%"))
+                except ValueError:
+                    job_id = None
+                if job_id not in self._background_jobs:
+                    raise ValueError(f"wait: no such job: {arg}")
+                job_ids.append(job_id)
+            status = self._wait_for_jobs(job_ids if job_ids else list(self._background_jobs))
+            if status != 0:
+                raise SystemExit(status)
+            return 0, True
+        elif args[0] == "each":
+            status = self._run_each(args, properties)
+            if status != 0:
+                raise SystemExit(status)
+            return 0, True
+        elif args[0] == "py":
+            if len(args) < 2:
+                raise ValueError("'py' requires Python code or a module:function")
+            self.print_command(args)
+            sys.stdout.flush()
+            # Code in the lus process can't be stopped, so with a deadline it runs isolated
+            if properties.get("isolate", False) is True or self._deadline is not None:
+                status = self._run_python_isolated(args)
+            else:
+                status = self._run_python_here(args)
+            self._directory_cache.invalidate()
+            if status != 0:
+                raise SystemExit(status)
             return 0, True
         elif args[0] == "export":
             self.print_command(args + [f"{k}={v}" for k, v in properties.items()])
-            os.environ.update(properties)
+            self.context.environ.update(properties)
             return 0, True
         elif args[0] == "set":
             if args[1] == "-x":
@@ -345,7 +1417,7 @@ class LusFile:
 
             # Support relative paths with / (e.g., scripts/build.bat)
             if "/" in script and not os.path.isabs(script):
-                script = os.path.join(os.getcwd(), script)
+                script = self.context.path(script)
 
             if not os.path.isfile(script):
                 raise FileNotFoundError(f"Script not found: {script}")
@@ -364,8 +1436,15 @@ class LusFile:
 
             full_cmd = f'cmd.exe /c "{cmd_string} && set"'
 
+            self._directory_cache.invalidate()
             result = subprocess.run(
-                full_cmd, shell=True, capture_output=True, text=True, check=True
+                full_cmd,
+                shell=True,
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=self.context.cwd,
+                env=self.context.environ.to_dict(),
             )
 
             # The output contains the environment in KEY=VALUE format
@@ -377,18 +1456,81 @@ class LusFile:
                     new_env[key] = value
 
             for key, value in new_env.items():
-                if key not in os.environ or os.environ[key] != value:
-                    os.environ[key] = value
+                if self.context.environ.get(key) != value:
+                    self.context.environ[key] = value
 
             return 0, True
-        elif "/" in args[0] and not os.path.isabs(args[0]):
+        elif args[0] == "source":
+            # POSIX counterpart of 'call': imports the environment a shell script leaves behind
+            if os.name == "nt":
+                # Silently ignore on Windows, use 'call' there
+                return 0, True
+
+            if len(args) < 2:
+                raise ValueError("'source' requires a script file")
+
+            script = self.context.path(args[1])
+            if not os.path.isfile(script):
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), args[1]
+                )
+
             self.print_command(args)
-            subprocess.check_call([os.path.join(os.getcwd(), args[0])] + args[1:])
+            self._source(
+                script,
+                args[2:],
+                str(properties.get("shell", "sh")),
+                properties.get("cache", True) is not False,
+            )
+            return 0, True
+        elif properties.get("worker", False) is not False:
+            # worker=true: the tool is the first argument, worker=N: the first N arguments start
+            # the worker and the rest is sent with each request
+            startup_count = self._worker_startup_count(properties["worker"], args)
+            startup_args = args[:startup_count]
+            if "/" in startup_args[0] and not os.path.isabs(startup_args[0]):
+                startup_args[0] = self.context.path(startup_args[0])
+            self.print_command(args)
+            deadline = self._deadline
+            try:
+                status, output = self._workers.run(
+                    startup_args,
+                    args[startup_count:],
+                    self.context.cwd,
+                    self.context.environ.to_dict(),
+                    deadline.remaining() if deadline is not None else None,
+                )
+            except subprocess.TimeoutExpired:
+                self._report_timeout(args, deadline)
+                raise subprocess.CalledProcessError(TIMEOUT_STATUS, args)
+            except WorkerError as e:
+                print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+                raise subprocess.CalledProcessError(e.returncode or 1, args)
+            self._directory_cache.invalidate()
+            if output:
+                if self._output is not None:
+                    data = output.encode()
+                    output_filter = self._output_filter()
+                    if output_filter is not None:
+                        data = output_filter.apply(
+                            data if data.endswith(b"\n") else data + b"\n"
+                        )
+                    self._output.write(data)
+                else:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+            if status != 0:
+                raise subprocess.CalledProcessError(status, args)
+            return 0, True
+        elif "/" in args[0] and not os.path.isabs(args[0]):
+            self.print_command(args, properties)
+            self._call([self.context.path(args[0])] + args[1:], properties)
             return 0, True
         else:
-            if not shutil.which(args[0]): # check if args[0] is in PATH
+            search_path = self.context.environ.get("PATH", os.defpath)
+            if not shutil.which(args[0], path=search_path): # check if args[0] is in PATH
                 if sys.platform == "darwin": # only macOS
-                    brew_path = shutil.which("brew")
+                    brew_path = shutil.which("brew", path=search_path)
                     if brew_path:
                         result = subprocess.check_output(
                             [brew_path, "which-formula", args[0]],
@@ -404,13 +1546,170 @@ class LusFile:
                             )
                             if response.lower() in ["", "y", "yes"]:
                                 self.print_command([brew_path, "install", formula])
-                                subprocess.check_call([brew_path, "install", formula])
-            self.print_command(args)
-            subprocess.check_call(args,
+                                subprocess.check_call(
+                                    [brew_path, "install", formula],
+                                    env=self.context.environ.to_dict(),
+                                )
+            self.print_command(args, properties)
+            self._call(args, properties,
                 shell=os.name == 'nt' # required to run .bat, .cmd, etc. on Windows
             )
             return 0, True
 
+    def _source(self, script: str, script_args: List[str], shell: str, use_cache: bool):
+        with open(script, "rb") as f:
+            content = f.read()
+
+        # The diff only depends on the script, its arguments and what it inherits from us
+        ignored = set(_SOURCE_KEY_IGNORED_VARIABLES)
+        scratch = self._scratch[0].path if self._scratch is not None else None
+        if scratch is not None and self.context.environ.get("TMPDIR") == scratch:
+            ignored.add("TMPDIR")
+        key = hashlib.sha256()
+        for part in [script, shell, self.context.cwd, *script_args]:
+            key.update(part.encode("utf-8", "surrogateescape") + b"\0")
+        key.update(hashlib.sha256(content).digest())
+        for name, value in sorted(self.context.environ.items()):
+            if name not in ignored:
+                key.update(f"{name}={value}".encode("utf-8", "surrogateescape") + b"\0")
+
+        cache_file = os.path.join(
+            cache_directory(self._project_root), "source", key.hexdigest() + ".json"
+        )
+        if use_cache:
+            try:
+                with open(cache_file, "r", encoding="utf-8") as f:
+                    diff = json.load(f)
+            except (OSError, ValueError):
+                diff = None
+            self._emit("cache", kind="source", script=script, hit=diff is not None)
+            if diff is not None:
+                self._apply_environment_diff(diff)
+                return
+
+        fd, dump_file = tempfile.mkstemp(prefix="lus-source-", suffix=".json")
+        os.close(fd)
+        try:
+            command = (
+                f'. "$0" && exec {shlex.quote(sys.executable)} '
+                f"-c {shlex.quote(_DUMP_ENVIRONMENT)} > {shlex.quote(dump_file)}"
+            )
+            # Through _call(), so that timeout= and --deadline stop the script as well
+            self._call([shell, "-c", command, script] + script_args, {})
+            with open(dump_file, "r", encoding="utf-8") as f:
+                new_env = json.load(f)
+        finally:
+            os.remove(dump_file)
+
+        diff = {
+            "set": {
+                key: value
+                for key, value in new_env.items()
+                if key not in _SOURCE_IGNORED_VARIABLES
+                and self.context.environ.get(key) != value
+            },
+            "unset": [
+                key
+                for key in self.context.environ
+                if key not in new_env and key not in _SOURCE_IGNORED_VARIABLES
+            ],
+        }
+
+        if use_cache:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(diff, f)
+            os.replace(tmp_file, cache_file)
+
+        self._apply_environment_diff(diff)
+
+    def _apply_environment_diff(self, diff: Dict[str, Any]):
+        self.context.environ.update(diff["set"])
+        for key in diff["unset"]:
+            self.context.environ.pop(key, None)
+
+    @staticmethod
+    def _is_include(node: NormalizedNode) -> bool:
+        return node.name == "include" and len(node.children) == 0 and len(node.args) > 0
+
+    @staticmethod
+    def _is_conditional(node: NormalizedNode) -> bool:
+        """`if <condition> { ... }`, `else if <condition> { ... }` or `else { ... }`"""
+        return node.name in ("if", "else") and len(node.children) > 0
+
+    def _load_include(self, path: str) -> Tuple[List[NormalizedNode], Dict[str, str]]:
+        if path not in self._includes:
+            with open(path, "r") as f:
+                content = f.read()
+            try:
+                nodes = _normalize_nodes(kdl.parse(content).nodes)
+            except ParseError as e:
+                e.lus_file = os.path.relpath(path, self._project_root)
+                raise
+            self._includes[path] = (nodes, self._extract_top_level_comments(content))
+        return self._includes[path]
+
+    def _include_path(self, path: Any) -> str:
+        """Path of an included file, relative to the lus.kdl that includes it."""
+        return os.path.normpath(os.path.join(self._file_directory, str(path)))
+
+    @classmethod
+    def _subcommand_names(cls, nodes: List[NormalizedNode]) -> List[str]:
+        return [
+            node.name
+            for node in nodes
+            if node.name
+            and node.name not in ("$", "-")
+            and node.name[0] != "-"
+            and not cls._is_include(node)
+            and not cls._is_conditional(node)
+        ]
+
+    def _include_names(self, path: str) -> List[str]:
+        """Subcommand names of an included file, parsing it only if it changed since last time.
+
+        So that an unknown subcommand doesn't parse all included files on every invocation, the
+        names are kept in an index in the cache directory.
+        """
+        if path in self._includes:
+            return self._subcommand_names(self._includes[path][0])
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return self._subcommand_names(self._load_include(path)[0])  # raises
+        signature = [stat_result.st_mtime_ns, stat_result.st_size]
+        index_file = os.path.join(cache_directory(self._project_root), "includes.json")
+        if self._include_index is None:
+            try:
+                with open(index_file, "r", encoding="utf-8") as f:
+                    self._include_index = json.load(f)
+            except (OSError, ValueError):
+                self._include_index = {}
+        entry = self._include_index.get(path)
+        if isinstance(entry, dict) and entry.get("signature") == signature:
+            return entry["names"]
+        names = self._subcommand_names(self._load_include(path)[0])
+        self._include_index[path] = {"signature": signature, "names": names}
+        tmp_file = f"{index_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self._include_index, f)
+            os.replace(tmp_file, index_file)
+        except OSError:
+            pass  # the index only saves time
+        return names
+
+    def _run_included(self, path: str, args: List[str]):
+        nodes, _ = self._load_include(path)
+        old_cwd, old_file_directory = self.context.cwd, self._file_directory
+        # Commands of an included file run next to it, just like for the main lus.kdl
+        self.context.cwd = self._file_directory = os.path.dirname(path)
+        try:
+            self.check_args(nodes, args, True)
+        finally:
+            self.context.cwd, self._file_directory = old_cwd, old_file_directory
+
     def check_args(self, nodes, args: List[str], check_if_args_handled: bool):
         # Flags for this subcommand, i.e. ["--release"]
         flags = []
@@ -435,31 +1734,49 @@ class LusFile:
                 "subcommand": subcommand,
                 "invocation_directory": self._invocation_directory,
                 "flags": " ".join(flags),
-            }
+                **({"scratch": self._scratch[0].path} if self._scratch is not None else {}),
+            },
+            self.context.environ,
         )
         subcommand_executed = False
 
-        subcommand_exists = any(
-            child.name == subcommand
-            for child in nodes
-            if len(child.name) > 0 and child.name not in ("$", "-")
-        )
-
-        available_subcommands = [
-            child.name
-            for child in nodes
-            if len(child.name) > 0
-            and child.name not in ("$", "-")
-            and child.name[0] != "-"
-            and child.name != ""
-        ]
+        available_subcommands = self._subcommand_names(nodes)
 
         comments = self._subcommand_comments
         aliases = self._aliases
 
+        # Included files are only looked at when the subcommand isn't defined here (or for -l),
+        # and only -l and the file that defines the subcommand parse them, so that large trees of
+        # includes don't slow down every invocation.
+        included_subcommands: Dict[str, str] = {}  # subcommand name -> path of included file
+        included_nodes: List[NormalizedNode] = []
+        if "-l" in flags or (subcommand and subcommand not in available_subcommands):
+            for child in nodes:
+                if not self._is_include(child):
+                    continue
+                path = self._include_path(child.args[0])
+                if "-l" not in flags:
+                    for name in self._include_names(path):
+                        if name not in available_subcommands:
+                            included_subcommands.setdefault(name, path)
+                    continue
+                include_nodes, include_comments = self._load_include(path)
+                for include_node in include_nodes:
+                    name = include_node.name
+                    if (
+                        name in self._subcommand_names([include_node])
+                        and name not in available_subcommands
+                        and name not in included_subcommands
+                    ):
+                        included_subcommands[name] = path
+                        included_nodes.append(include_node)
+                        if name in include_comments:
+                            comments = {**comments, name: include_comments[name]}
+            available_subcommands.extend(included_subcommands)
+
         # Build a mapping of subcommand names to their flag children
         subcommand_flags: Dict[str, List[str]] = {}
-        for child in nodes:
+        for child in nodes + included_nodes:
             if (
                 child.name
                 and child.name not in ("$", "-")
@@ -514,11 +1831,35 @@ class LusFile:
             return
 
         child_names = set()
+        node_path = self._node_path
+        # Whether a branch of the current if/else chain has run, None outside of such a chain
+        branch_taken: Optional[bool] = None
         for i, child in enumerate(nodes):
+            self._node_path = node_path + [i]
+            previous_branch_taken, branch_taken = branch_taken, None
+            if self._is_conditional(child):
+                branch_taken = self._run_conditional(
+                    child, previous_branch_taken, environment, remaining_args
+                )
+                continue
+            if self._is_include(child):
+                path = self._include_path(child.args[0])
+                if included_subcommands.get(subcommand) == path:
+                    try:
+                        self._run_included(path, remaining_args)
+                    except SystemExit as e:
+                        if e.code != 0:
+                            raise
+                    subcommand_executed = True
+                    remaining_args = []
+                continue
             if child.name == "$" or child.name == "-" or (len(child.children) == 0 and len(child.args) > 0):
                 if len(child.args) > 0:
                     cmd = [] if child.name == "$" or child.name == "-" else [child.name]
+                    # Largest (start, end) range of cmd that comes from $args or a glob pattern
+                    variable_part = (0, 0)
                     for arg in child.args:
+                        start = len(cmd)
                         if arg == "$args":
                             # special case because it won't be passed as one argument with spaces
                             environment.args_used = True
@@ -528,15 +1869,38 @@ class LusFile:
                                     cmd.append("")
                             else:
                                 cmd.extend(remaining_args)
-                            continue
-                        cmd.append(expandvars.expand(str(arg), environ=environment, nounset=True))
+                        else:
+                            expanded = expandvars.expand(str(arg), environ=environment, nounset=True)
+                            matches = None
+                            # Like in shells, only unquoted arguments are expanded, unless glob=
+                            # says otherwise (e.g. for patterns with / that need quotes)
+                            glob_mode = child.properties.get("glob", isinstance(arg, _Unquoted))
+                            if has_magic(expanded) and glob_mode is not False:
+                                matches = self._directory_cache.glob(
+                                    expanded, self.context.cwd, tracked=glob_mode == "tracked"
+                                )
+                            # Like in shells, patterns without matches are passed on unchanged
+                            if matches:
+                                cmd.extend(matches)
+                            else:
+                                cmd.append(expanded)
+                                continue
+                        if len(cmd) - start > variable_part[1] - variable_part[0]:
+                            variable_part = (start, len(cmd))
                     if subcommand_executed and len(cmd) > 1 and cmd[0] == "lus" and cmd[1] == subcommand:
                         continue
-                    self.run(cmd, child.properties)
+                    if (
+                        child.properties.get("chunk", False) is True
+                        and variable_part[1] > variable_part[0]
+                        and not any(op in cmd for op in ("&&", "||", "&"))
+                    ):
+                        self._run_chunked(cmd, variable_part, child.properties)
+                    else:
+                        self.run(cmd, child.properties)
                 else:
                     self.local_variables.update(child.properties)
                 continue
-            if len(child.children) > 0:
+            if len(child.children) > 0 or "include" in child.properties:
                 if child.name in child_names:
                     print(f"{colored('error:', 'red', attrs=['bold'])} Duplicate node name '{child.name}'", file=sys.stderr)
                     raise SystemExit(1)
@@ -546,14 +1910,70 @@ class LusFile:
                     remaining_args.remove(subcommand)
                 except ValueError:
                     pass # if there was a script line before that used $args, it may already be removed
+                self._task_path.append(subcommand)
+                task = list(self._task_path)
+                self._emit("task-start", task=task)
+                task_started = time.perf_counter()
+                task_status = 1
+                outer_properties = self._node_properties
+                outer_deadline = self._deadline
+                outer_scratch = self._scratch
+                outer_tmpdir = self.context.environ.get("TMPDIR")
+                self._node_properties = {
+                    **outer_properties,
+                    **{
+                        key: value
+                        for key, value in child.properties.items()
+                        if key in SCHEDULING_PROPERTIES
+                    },
+                }
                 try:
+                    self._check_scheduling(self._node_properties)
+                    if "timeout" in child.properties:
+                        self._deadline = earliest(
+                            outer_deadline,
+                            self._timeout_deadline(
+                                child.properties["timeout"], f" of `lus {' '.join(task)}`"
+                            ),
+                        )
+                    if "scratch" in child.properties:
+                        self._create_scratch(child.properties, task)
                     # Once we've matched the subcommand, enforce leftover-argument checks inside it
-                    self.check_args(child.children, remaining_args, True)
+                    if "include" in child.properties and len(child.children) == 0:
+                        # Mounted file, e.g. `api include="services/api/lus.kdl"`
+                        self._run_included(
+                            self._include_path(child.properties["include"]),
+                            remaining_args,
+                        )
+                    else:
+                        self.check_args(child.children, remaining_args, True)
                     subcommand_executed = True
+                    task_status = 0
                 except SystemExit as e:
+                    task_status = self._exit_status(e)
                     if e.code != 0:
                         raise
                     subcommand_executed = True
+                except subprocess.CalledProcessError as e:
+                    task_status = e.returncode
+                    raise
+                finally:
+                    self._emit(
+                        "task-finish",
+                        task=task,
+                        status=task_status,
+                        duration=time.perf_counter() - task_started,
+                    )
+                    self._task_path.pop()
+                    self._node_properties = outer_properties
+                    self._deadline = outer_deadline
+                    if self._scratch is not outer_scratch:
+                        self._scratch[0].remove()
+                        self._scratch = outer_scratch
+                        if outer_tmpdir is None:
+                            self.context.environ.pop("TMPDIR", None)
+                        else:
+                            self.context.environ["TMPDIR"] = outer_tmpdir
                 remaining_args = []
             elif child.name in flags:
                 remaining_args.remove(child.name)
@@ -578,3 +1998,49 @@ class LusFile:
                         f"    {colored(available_subcommand, 'blue', attrs=['bold'])}"
                     )
             raise SystemExit(1)
+        return environment.args_used
+
+    def _run_conditional(
+        self,
+        node: NormalizedNode,
+        previous_branch_taken: Optional[bool],
+        environment: Environment,
+        args: List[str],
+    ) -> Optional[bool]:
+        """Run the block of an if/else node if it applies, return whether a branch has run."""
+        try:
+            run, branch_taken = self._choose_branch(node, previous_branch_taken, environment)
+        except ValueError as e:
+            print(f"{colored('error:', 'red', attrs=['bold'])} {e}", file=sys.stderr)
+            raise SystemExit(1)
+        # Arguments used inside the block count as used by the enclosing one
+        if run and self.check_args(node.children, args, False):
+            environment.args_used = True
+        return branch_taken
+
+    def _choose_branch(
+        self,
+        node: NormalizedNode,
+        previous_branch_taken: Optional[bool],
+        environment: Environment,
+    ) -> Tuple[bool, Optional[bool]]:
+        """(whether to run the block of node, whether a branch of the chain has run after it)"""
+        condition = [str(arg) for arg in node.args]
+        if node.name == "else":
+            if previous_branch_taken is None:
+                raise ValueError("'else' without a preceding 'if'")
+            if condition and condition[0] != "if":
+                raise ValueError(
+                    f"Expected 'else' or 'else if', got 'else {shlex.join(condition)}'"
+                )
+            if not condition:
+                # A final `else` ends the chain
+                return not previous_branch_taken, None
+            if previous_branch_taken:
+                return False, True
+            condition = condition[1:]
+        condition = [
+            expandvars.expand(arg, environ=environment, nounset=True) for arg in condition
+        ]
+        taken = evaluate(condition, self.context, self._directory_cache)
+        return taken, taken
@@ -8,7 +8,20 @@ from kdl.errors import ParseError
 from termcolor import colored
 
 from .LusFile import LusFile
+from .affected import select_affected
+from .bench import benchmark
 from .completions import get_completion_script
+from .events import EventWriter
+from .history import print_stats
+from .monorepo import run_all
+from .output import OUTPUT_FILTERS, OUTPUT_MODES
+from .project import CommandTiming, LusProject, RunResult, Step
+from .sharding import parse_shard, run_shard, run_tasks
+from .sharing import run_shared
+from .timeouts import Deadline, parse_duration
+
+# The library API (see project.py) next to the command line
+__all__ = ["CommandTiming", "LusFile", "LusProject", "RunResult", "Step", "main"]
 
 
 @click.command(
@@ -44,9 +57,150 @@ from .completions import get_completion_script
     is_eager=True,
     help="List available subcommands",
 )
+@click.option(
+    "--output",
+    type=click.Choice(OUTPUT_MODES),
+    default="inherit",
+    help="How to show the output of commands: directly (inherit), with each line "
+    "prefixed by its subcommand (prefix) or in one piece per command (group)",
+)
+@click.option(
+    "--filter",
+    "filters",
+    type=click.Choice(OUTPUT_FILTERS),
+    multiple=True,
+    help="Filter the output of commands: strip escape sequences like colors (strip-ansi), "
+    "prefix each line with the time (timestamps) or mask the values of environment variables "
+    "like *_TOKEN and *_PASSWORD (mask-secrets). Can be given more than once",
+)
+@click.option(
+    "--stats",
+    is_flag=True,
+    help="Show duration statistics of previous runs of all or the given subcommand",
+)
+@click.option(
+    "--no-share",
+    is_flag=True,
+    help="Don't wait for and reuse the result of an identical invocation that is "
+    "already running in the same project",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    help="Maximum number of parallel jobs, shared with make, ninja, cargo etc. through a "
+    "GNU make jobserver",
+)
+@click.option(
+    "--deadline",
+    metavar="DURATION",
+    help="Stop the run if it takes longer than DURATION (e.g. 90s, 10m or 1h30m), "
+    "including the process groups of its commands, and exit with status 124",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Continue the last failed run of the same command line, skipping the steps that "
+    "finished",
+)
+@click.option(
+    "--events-fd",
+    type=click.IntRange(min=0),
+    metavar="FD",
+    help="Write progress events as JSON lines to the file descriptor FD",
+)
+@click.option(
+    "--events-file",
+    metavar="FILE",
+    help="Append progress events as JSON lines to FILE",
+)
+@click.option(
+    "--all",
+    "all_projects",
+    is_flag=True,
+    help="Run the subcommand in every project below the current directory that defines it",
+)
+@click.option(
+    "--shard",
+    metavar="K/N",
+    help="Split the subcommands matching the pattern given instead of a subcommand into N "
+    "shards of about the same duration and run the K-th of them",
+)
+@click.option(
+    "--shard-costs",
+    metavar="FILE",
+    help="JSON file with the seconds each subcommand takes, for the subcommands without a cost= "
+    "property, shared by all shards",
+)
+@click.option(
+    "--affected",
+    is_flag=True,
+    help="Only run the subcommands matching the pattern given instead of a subcommand whose "
+    "inputs changed since --since, according to git",
+)
+@click.option(
+    "--since",
+    metavar="REF",
+    default="HEAD",
+    show_default=True,
+    help="Git revision whose merge base with HEAD --affected compares against, e.g. origin/main",
+)
+@click.option(
+    "--bench",
+    is_flag=True,
+    help="Run the subcommand repeatedly and show how long it takes",
+)
+@click.option(
+    "--runs",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="Number of timed runs for --bench",
+)
+@click.option(
+    "--warmup",
+    type=click.IntRange(min=0),
+    default=0,
+    show_default=True,
+    help="Number of untimed runs before the timed ones for --bench",
+)
+@click.option(
+    "--prepare",
+    metavar="SUBCOMMAND",
+    help="Subcommand (with arguments) to run untimed before every run of --bench",
+)
+@click.option(
+    "--export-json",
+    metavar="FILE",
+    help="Write the --bench results to FILE in the format of hyperfine",
+)
 @click.argument("subcommand", nargs=-1, type=click.UNPROCESSED)
 @click.pass_context
-def main(ctx, completions, list_subcommands, subcommand):
+def main(
+    ctx,
+    completions,
+    list_subcommands,
+    output,
+    filters,
+    stats,
+    no_share,
+    jobs,
+    deadline,
+    resume,
+    events_fd,
+    events_file,
+    all_projects,
+    shard,
+    shard_costs,
+    affected,
+    since,
+    bench,
+    runs,
+    warmup,
+    prepare,
+    export_json,
+    subcommand,
+):
     if completions is not None:
         try:
             click.echo(get_completion_script(completions))
@@ -57,7 +211,49 @@ def main(ctx, completions, list_subcommands, subcommand):
 
     args = (["-l"] if list_subcommands else []) + ctx.args + list(subcommand)
 
+    run_deadline = None
+    if deadline is not None:
+        try:
+            run_deadline = Deadline.after(parse_duration(deadline), f"--deadline {deadline}")
+        except ValueError as e:
+            click.echo(f"{colored('error:', 'red', attrs=['bold'])} {e}", err=True)
+            ctx.exit(1)
+
+    events = None
     try:
+        if events_fd is not None:
+            os.fstat(events_fd)  # fail early for a file descriptor that isn't open
+            events = EventWriter(events_fd)
+        elif events_file is not None:
+            events = EventWriter.open(events_file)
+
+        if all_projects:
+            if not any(not arg.startswith("-") for arg in args):
+                click.echo(
+                    f"{colored('error:', 'red', attrs=['bold'])} --all requires a subcommand",
+                    err=True,
+                )
+                sys.exit(1)
+            if events is not None:
+                # The projects run in lus processes of their own, whose events would interleave
+                option = "--events-fd" if events_fd is not None else "--events-file"
+                click.echo(
+                    f"{colored('error:', 'red', attrs=['bold'])} {option} can't be combined "
+                    f"with --all",
+                    err=True,
+                )
+                sys.exit(1)
+            sys.exit(
+                run_all(
+                    os.getcwd(),
+                    args,
+                    jobs=jobs,
+                    output=output,
+                    filters=filters,
+                    deadline=run_deadline,
+                )
+            )
+
         invocation_directory = os.getcwd()
         MAX_DEPTH = 50
         current_filesystem = os.stat(".").st_dev
@@ -75,7 +271,103 @@ def main(ctx, completions, list_subcommands, subcommand):
             else:
                 break
 
-        LusFile(content, invocation_directory, args)
+        if stats:
+            print_stats(os.getcwd(), subcommand[0] if subcommand else None)
+            return
+
+        if shard is not None or affected or shard_costs is not None:
+            try:
+                if shard is not None:
+                    index, count = parse_shard(shard)
+                elif shard_costs is not None:
+                    raise ValueError("--shard-costs requires --shard")
+                if not subcommand:
+                    option = "--shard" if shard is not None else "--affected"
+                    raise ValueError(f"{option} requires a pattern, e.g. 'test-*'")
+                project = LusProject.from_string(content, os.getcwd())
+                only = select_affected(project, subcommand[0], since) if affected else None
+                if shard is None:
+                    sys.exit(
+                        run_tasks(
+                            project,
+                            only,
+                            list(subcommand[1:]),
+                            invocation_directory,
+                            output=output,
+                            jobs=jobs,
+                            filters=filters,
+                            deadline=run_deadline,
+                            events=events,
+                        )
+                    )
+                sys.exit(
+                    run_shard(
+                        project,
+                        index,
+                        count,
+                        list(subcommand),
+                        invocation_directory,
+                        output=output,
+                        jobs=jobs,
+                        filters=filters,
+                        deadline=run_deadline,
+                        only=only,
+                        events=events,
+                        # Relative to where lus was invoked, not to the lus.kdl found above it
+                        costs_file=(
+                            os.path.join(invocation_directory, shard_costs)
+                            if shard_costs is not None
+                            else None
+                        ),
+                    )
+                )
+            except ValueError as e:
+                click.echo(f"{colored('error:', 'red', attrs=['bold'])} {e}", err=True)
+                sys.exit(1)
+
+        if bench:
+            benchmark(
+                content,
+                invocation_directory,
+                args,
+                runs=runs,
+                warmup=warmup,
+                prepare=prepare,
+                # Relative to where lus was invoked, not to the lus.kdl found above it
+                export_json=(
+                    os.path.join(invocation_directory, export_json)
+                    if export_json is not None
+                    else None
+                ),
+                jobs=jobs,
+            )
+            return
+
+        def run():
+            LusFile(
+                content,
+                invocation_directory,
+                args,
+                output=output,
+                history=True,
+                jobs=jobs,
+                events=events,
+                filters=filters,
+                deadline=run_deadline,
+                journal=True,
+                resume=resume,
+            )
+
+        if no_share or list_subcommands:
+            run()
+        else:
+            run_shared(
+                os.getcwd(),
+                args,
+                run,
+                events=events,
+                invocation_directory=invocation_directory,
+            )
     except subprocess.CalledProcessError as e:
         sys.exit(e.returncode)
     except FileNotFoundError as e:
@@ -86,6 +378,13 @@ def main(ctx, completions, list_subcommands, subcommand):
         sys.exit(1)
     except KeyboardInterrupt:
         sys.exit(130)
+    except OSError as e:
+        click.echo(f"{colored('error:', 'red', attrs=['bold'])} {e.strerror}", err=True)
+        sys.exit(1)
     except ParseError as e:
-        click.echo(f"{colored('error:', 'red', attrs=['bold'])} lus.kdl:{e}", err=True)
+        lus_file = getattr(e, "lus_file", "lus.kdl")
+        click.echo(f"{colored('error:', 'red', attrs=['bold'])} {lus_file}:{e}", err=True)
         sys.exit(1)
+    finally:
+        if events is not None:
+            events.close()
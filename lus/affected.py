@@ -0,0 +1,139 @@
+"""Running only the subcommands whose inputs changed (lus --affected --since origin/main 'test-*').
+
+The changed files are the ones git reports between the merge base of the revision and HEAD and
+the working tree, plus untracked files. A subcommand's inputs are
+
+* the glob patterns of its inputs= property (e.g. inputs="src/** Cargo.toml"), relative to the
+  lus.kdl that defines it,
+* else the directory of its lus.kdl, for subcommands mounted with include= or defined in an
+  included file,
+* and always the lus.kdl files it comes from.
+
+Subcommands of the main lus.kdl without inputs= could depend on anything, so they always run.
+"""
+
+import itertools
+import os
+import posixpath
+import re
+import subprocess
+import sys
+from typing import Dict, List, Set, Tuple
+
+from termcolor import colored
+
+from .globbing import _translate, has_magic
+from .project import LusProject
+from .sharding import match_subcommands
+
+
+def _git(directory: str, *args: str) -> bytes:
+    result = subprocess.run(["git", "-C", directory, *args], capture_output=True)
+    if result.returncode != 0:
+        message = os.fsdecode(result.stderr).strip().splitlines()
+        raise ValueError(f"git {args[0]} failed: {message[-1] if message else result.returncode}")
+    return result.stdout
+
+
+def changed_files(directory: str, since: str) -> Tuple[str, List[str]]:
+    """Return the top-level directory of the git repository and the files changed since since.
+
+    Paths are relative to the top-level directory, with /, deleted and renamed files included.
+    """
+    toplevel = os.fsdecode(_git(directory, "rev-parse", "--show-toplevel")).strip()
+    base = os.fsdecode(_git(directory, "merge-base", since, "HEAD")).strip()
+    output = _git(toplevel, "diff", "--name-only", "--no-renames", "-z", base, "--")
+    output += _git(toplevel, "ls-files", "--others", "--exclude-standard", "-z")
+    return toplevel, sorted({os.fsdecode(path) for path in output.split(b"\0") if path})
+
+
+class InputIndex:
+    """Which subcommands a file is an input of, indexed by path prefix.
+
+    Paths and directories a subcommand owns are looked up directly. Every glob pattern is filed
+    under the directory before its first wildcard, so a file is only matched against the
+    patterns of its own parent directories, which keeps lookups fast with many subcommands.
+    """
+
+    def __init__(self):
+        # Subcommands by file or directory they own, including everything below
+        self._paths: Dict[str, Set[str]] = {}
+        # (compiled pattern, subcommand) by the directory before the first wildcard
+        self._patterns: Dict[str, List[Tuple["re.Pattern[str]", str]]] = {}
+        # Subcommands without known inputs, which are always affected
+        self.unconditional: Set[str] = set()
+
+    def add(self, pattern: str, name: str):
+        """Add an input of name, a path or glob pattern relative to the index root, with /."""
+        pattern = posixpath.normpath(pattern)
+        if pattern == ".":
+            self.unconditional.add(name)
+            return
+        parts = pattern.split("/")
+        literal = list(itertools.takewhile(lambda part: not has_magic(part), parts))
+        if len(literal) == len(parts):
+            self._paths.setdefault(pattern, set()).add(name)
+        else:
+            regex = re.compile(_translate(pattern, any_depth=True) + r"\Z")
+            self._patterns.setdefault("/".join(literal), []).append((regex, name))
+
+    def owners(self, path: str) -> Set[str]:
+        """The subcommands path is an input of, apart from the unconditional ones."""
+        result = set(self._paths.get(path, ()))
+        directory = path
+        while directory:
+            directory = posixpath.dirname(directory)
+            result.update(self._paths.get(directory, ()))
+            for regex, name in self._patterns.get(directory, ()):
+                if name not in result and regex.match(path):
+                    result.add(name)
+        return result
+
+    def affected(self, paths: List[str]) -> Set[str]:
+        result = set(self.unconditional)
+        for path in paths:
+            result.update(self.owners(path))
+        return result
+
+
+def input_index(project: LusProject, names: List[str], toplevel: str) -> InputIndex:
+    """Index the inputs of the subcommands names, relative to toplevel."""
+    toplevel = os.path.realpath(toplevel)
+
+    def relative(path: str) -> str:
+        return os.path.relpath(os.path.realpath(path), toplevel).replace(os.sep, "/")
+
+    index = InputIndex()
+    nodes = project._subcommand_nodes()
+    for name in names:
+        node, path = nodes[name]
+        directory = os.path.dirname(path)
+        index.add(relative(project.path), name)
+        index.add(relative(path), name)
+        if "inputs" in node.properties:
+            for pattern in str(node.properties["inputs"]).split():
+                index.add(relative(directory) + "/" + pattern, name)
+        elif "include" in node.properties:
+            included = os.path.join(directory, str(node.properties["include"]))
+            index.add(relative(os.path.dirname(included)), name)
+        elif path != project.path:
+            index.add(relative(directory), name)
+        else:
+            index.unconditional.add(name)
+    return index
+
+
+def select_affected(project: LusProject, pattern: str, since: str) -> List[str]:
+    """The subcommands matching pattern whose inputs changed since the git revision since."""
+    matches = match_subcommands(project, pattern)
+    toplevel, changed = changed_files(project.root, since)
+    affected = input_index(project, matches, toplevel).affected(changed)
+    tasks = [name for name in matches if name in affected]
+    print(
+        f"{colored('note:', 'blue', attrs=['bold'])} {len(tasks)} of the {len(matches)} "
+        f"subcommands matching '{pattern}' are affected by the {len(changed)} files changed "
+        f"since {since}",
+        file=sys.stderr,
+        flush=True,
+    )
+    return tasks
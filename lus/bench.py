@@ -0,0 +1,131 @@
+"""Repeated timing of a subcommand (lus --bench), without interpreter startup and parsing."""
+
+import contextlib
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import time
+from typing import Iterator, List, Optional
+
+from termcolor import colored
+
+from .LusFile import LusFile
+
+
+@contextlib.contextmanager
+def _silenced() -> Iterator[None]:
+    """Send everything written to stdout and stderr (also by child processes) to /dev/null."""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(1), os.dup(2)]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    try:
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + [devnull]:
+            os.close(fd)
+
+
+def _format_time(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.1f} ms"
+    return f"{seconds:.3f} s"
+
+
+def _execute(lusfile: LusFile, args: List[str]) -> int:
+    try:
+        with _silenced():
+            lusfile.execute(args)
+    except SystemExit as e:
+        return LusFile._exit_status(e)
+    except subprocess.CalledProcessError as e:
+        return e.returncode
+    return 0
+
+
+def benchmark(
+    content: str,
+    invocation_directory: str,
+    args: List[str],
+    runs: int = 10,
+    warmup: int = 0,
+    prepare: Optional[str] = None,
+    export_json: Optional[str] = None,
+    jobs: Optional[int] = None,
+):
+    """Run args warmup + runs times in this process and print mean, stddev, min and max.
+
+    The output of the subcommand is hidden. prepare is another lus invocation (e.g. "clean")
+    that runs untimed before every run.
+    """
+    lusfile = LusFile(content, invocation_directory, jobs=jobs, execute=False)
+    prepare_args = shlex.split(prepare) if prepare is not None else None
+    command = shlex.join(["lus"] + args)
+
+    times: List[float] = []
+    for i in range(warmup + runs):
+        if prepare_args is not None:
+            status = _execute(lusfile, prepare_args)
+            if status != 0:
+                print(
+                    f"{colored('error:', 'red', attrs=['bold'])} The prepare step "
+                    f"`{shlex.join(['lus'] + prepare_args)}` failed with exit status {status}",
+                    file=sys.stderr,
+                )
+                raise SystemExit(status)
+        started = time.perf_counter()
+        status = _execute(lusfile, args)
+        duration = time.perf_counter() - started
+        if status != 0:
+            print(
+                f"{colored('error:', 'red', attrs=['bold'])} `{command}` failed with exit "
+                f"status {status} in run {i + 1}",
+                file=sys.stderr,
+            )
+            raise SystemExit(status)
+        if i >= warmup:
+            times.append(duration)
+
+    mean = sum(times) / len(times)
+    stddev = (
+        math.sqrt(sum((t - mean) ** 2 for t in times) / (len(times) - 1))
+        if len(times) > 1
+        else 0.0
+    )
+    print(colored(f"Benchmark: {command}", attrs=["bold"]))
+    print(
+        f"  Time (mean ± σ):   {colored(_format_time(mean), 'green', attrs=['bold'])} ± "
+        f"{_format_time(stddev)}    [{runs} runs, {warmup} warmup]"
+    )
+    print(f"  Range (min … max): {_format_time(min(times))} … {_format_time(max(times))}")
+
+    if export_json is not None:
+        # The same layout as hyperfine's --export-json, so existing comparison scripts work
+        ordered = sorted(times)
+        middle = len(ordered) // 2
+        median = (
+            ordered[middle]
+            if len(ordered) % 2
+            else (ordered[middle - 1] + ordered[middle]) / 2
+        )
+        result = {
+            "command": command,
+            "mean": mean,
+            "stddev": stddev,
+            "median": median,
+            "min": ordered[0],
+            "max": ordered[-1],
+            "times": times,
+        }
+        with open(export_json, "w") as f:
+            json.dump({"results": [result]}, f, indent=2)
+            f.write("\n")
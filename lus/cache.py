@@ -0,0 +1,23 @@
+"""Per-project cache directory shared by lus' persistent state."""
+
+import hashlib
+import os
+
+
+def cache_directory(project_root: str) -> str:
+    """Return (and create) the cache directory for the project at project_root.
+
+    The directory lives below $XDG_CACHE_HOME (or ~/.cache, %LOCALAPPDATA% on
+    Windows) so that nothing is written into the project itself.
+    """
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        if os.name == "nt" and os.environ.get("LOCALAPPDATA"):
+            base = os.environ["LOCALAPPDATA"]
+        else:
+            base = os.path.join(os.path.expanduser("~"), ".cache")
+    root = os.path.abspath(project_root)
+    digest = hashlib.sha256(root.encode("utf-8", "surrogateescape")).hexdigest()[:16]
+    path = os.path.join(base, "lus", f"{os.path.basename(root) or 'root'}-{digest}")
+    os.makedirs(path, exist_ok=True)
+    return path
@@ -8,7 +8,7 @@ _lus_completions() {
 
     # lus options
     if [[ "$cur" == -* ]]; then
-        COMPREPLY=($(compgen -W "-l --list --completions --version --help" -- "$cur"))
+        COMPREPLY=($(compgen -W "-l --list --completions --output --filter --stats --no-share -j --jobs --deadline --resume --events-fd --events-file --all --shard --affected --since --bench --runs --warmup --prepare --export-json --version --help" -- "$cur"))
         return
     fi
 
@@ -18,6 +18,16 @@ _lus_completions() {
         return
     fi
 
+    if [[ "$prev" == "--output" ]]; then
+        COMPREPLY=($(compgen -W "inherit prefix group" -- "$cur"))
+        return
+    fi
+
+    if [[ "$prev" == "--filter" ]]; then
+        COMPREPLY=($(compgen -W "strip-ansi timestamps mask-secrets" -- "$cur"))
+        return
+    fi
+
     # If we already have a subcommand (more than 1 non-option arg), complete files/folders
     local arg_count=0
     for word in "${COMP_WORDS[@]:1:COMP_CWORD-1}"; do
@@ -52,6 +62,25 @@ _lus() {
         '-l[List available subcommands]'
         '--list[List available subcommands]'
         '--completions[Generate shell completion script]:shell:(bash zsh fish powershell)'
+        '--output[How to show the output of commands]:mode:(inherit prefix group)'
+        '*--filter[Filter the output of commands]:filter:(strip-ansi timestamps mask-secrets)'
+        '--stats[Show duration statistics of previous runs]'
+        '--no-share[Do not reuse the result of an identical running invocation]'
+        '-j[Maximum number of parallel jobs]:jobs:'
+        '--jobs[Maximum number of parallel jobs]:jobs:'
+        '--deadline[Stop the run if it takes longer than a duration]:duration:'
+        '--resume[Continue the last failed run, skipping the finished steps]'
+        '--events-fd[Write progress events as JSON lines to a file descriptor]:fd:'
+        '--events-file[Append progress events as JSON lines to a file]:file:_files'
+        '--all[Run the subcommand in every project below the current directory]'
+        '--shard[Run one of N balanced shards of the matching subcommands]:shard:'
+        '--affected[Only run the matching subcommands whose inputs changed]'
+        '--since[Git revision to compare against for --affected]:revision:'
+        '--bench[Run the subcommand repeatedly and show how long it takes]'
+        '--runs[Number of timed runs for --bench]:runs:'
+        '--warmup[Number of untimed runs before the timed ones]:runs:'
+        '--prepare[Subcommand to run before every run of --bench]:subcommand:'
+        '--export-json[Write the --bench results to a file]:file:_files'
         '--version[Show version]'
         '--help[Show help]'
     )
@@ -100,6 +129,24 @@ end
 # Options
 complete -c lus -s l -l list -d "List available subcommands"
 complete -c lus -l completions -xa "bash zsh fish powershell" -d "Generate shell completion script"
+complete -c lus -l output -xa "inherit prefix group" -d "How to show the output of commands"
+complete -c lus -l filter -xa "strip-ansi timestamps mask-secrets" -d "Filter the output of commands"
+complete -c lus -l stats -d "Show duration statistics of previous runs"
+complete -c lus -l no-share -d "Do not reuse the result of an identical running invocation"
+complete -c lus -s j -l jobs -x -d "Maximum number of parallel jobs"
+complete -c lus -l deadline -x -d "Stop the run if it takes longer than a duration"
+complete -c lus -l resume -d "Continue the last failed run, skipping the finished steps"
+complete -c lus -l events-fd -x -d "Write progress events as JSON lines to a file descriptor"
+complete -c lus -l events-file -r -d "Append progress events as JSON lines to a file"
+complete -c lus -l all -d "Run the subcommand in every project below the current directory"
+complete -c lus -l shard -x -d "Run one of N balanced shards of the matching subcommands"
+complete -c lus -l affected -d "Only run the matching subcommands whose inputs changed"
+complete -c lus -l since -x -d "Git revision to compare against for --affected"
+complete -c lus -l bench -d "Run the subcommand repeatedly and show how long it takes"
+complete -c lus -l runs -x -d "Number of timed runs for --bench"
+complete -c lus -l warmup -x -d "Number of untimed runs before the timed ones"
+complete -c lus -l prepare -x -d "Subcommand to run before every run of --bench"
+complete -c lus -l export-json -r -d "Write the --bench results to a file"
 complete -c lus -l version -d "Show version"
 complete -c lus -l help -d "Show help"
 
@@ -116,7 +163,7 @@ POWERSHELL_COMPLETION = """
 Register-ArgumentCompleter -Native -CommandName lus -ScriptBlock {
     param($wordToComplete, $commandAst, $cursorPosition)
 
-    $options = @('-l', '--list', '--completions', '--version', '--help')
+    $options = @('-l', '--list', '--completions', '--output', '--filter', '--stats', '--no-share', '-j', '--jobs', '--deadline', '--resume', '--events-fd', '--events-file', '--all', '--shard', '--affected', '--since', '--bench', '--runs', '--warmup', '--prepare', '--export-json', '--version', '--help')
 
     # If completing an option
     if ($wordToComplete -like '-*') {
@@ -135,6 +182,20 @@ Register-ArgumentCompleter -Native -CommandName lus -ScriptBlock {
         return
     }
 
+    if ($words.Count -ge 2 -and $words[-2].Extent.Text -eq '--output') {
+        @('inherit', 'prefix', 'group') | Where-Object { $_ -like "$wordToComplete*" } | ForEach-Object {
+            [System.Management.Automation.CompletionResult]::new($_, $_, 'ParameterValue', $_)
+        }
+        return
+    }
+
+    if ($words.Count -ge 2 -and $words[-2].Extent.Text -eq '--filter') {
+        @('strip-ansi', 'timestamps', 'mask-secrets') | Where-Object { $_ -like "$wordToComplete*" } | ForEach-Object {
+            [System.Management.Automation.CompletionResult]::new($_, $_, 'ParameterValue', $_)
+        }
+        return
+    }
+
     # Count non-option arguments (excluding 'lus' itself)
     $argCount = 0
     foreach ($word in $words | Select-Object -Skip 1) {
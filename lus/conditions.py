@@ -0,0 +1,109 @@
+"""Conditions of `if` nodes, evaluated in the lus process instead of by starting `test` or `[`.
+
+    if exists "build/app" {
+        - echo up to date
+    }
+    else if newer "src/*.c" "build/app" {
+        - make
+    }
+
+File conditions share the stat() results and directory listings of a DirectoryCache, so many
+conditions about the same files only cost a few system calls.
+"""
+
+import os
+import shutil
+from typing import Callable, Dict, List
+
+from .context import ExecutionContext
+from .globbing import DirectoryCache, has_magic
+
+
+def _check_operands(name: str, operands: List[str], minimum: int, maximum: int = None):
+    if len(operands) < minimum or (maximum is not None and len(operands) > maximum):
+        if maximum == minimum:
+            expected = f"{minimum}"
+        elif maximum is None:
+            expected = f"at least {minimum}"
+        else:
+            expected = f"{minimum} to {maximum}"
+        raise ValueError(
+            f"Condition '{name}' expects {expected} arguments, got {len(operands)}"
+        )
+
+
+def _exists(operands: List[str], context: ExecutionContext, cache: DirectoryCache) -> bool:
+    _check_operands("exists", operands, 1)
+    return all(cache.stat(context.path(path)) is not None for path in operands)
+
+
+def _newer(operands: List[str], context: ExecutionContext, cache: DirectoryCache) -> bool:
+    """Whether the last path is missing or older than any of the others, like for make."""
+    _check_operands("newer", operands, 2)
+    *sources, target = operands
+    target_stat = cache.stat(context.path(target))
+    if target_stat is None:
+        return True
+    for source in sources:
+        paths = cache.glob(source, context.cwd) if has_magic(source) else [source]
+        for path in paths:
+            source_stat = cache.stat(context.path(path))
+            if source_stat is not None and source_stat.st_mtime_ns > target_stat.st_mtime_ns:
+                return True
+    return False
+
+
+def _env(operands: List[str], context: ExecutionContext, cache: DirectoryCache) -> bool:
+    _check_operands("env", operands, 1)
+    return all(name in context.environ for name in operands)
+
+
+def _eq(operands: List[str], context: ExecutionContext, cache: DirectoryCache) -> bool:
+    _check_operands("eq", operands, 2, 2)
+    return operands[0] == operands[1]
+
+
+def _glob_matches(
+    operands: List[str], context: ExecutionContext, cache: DirectoryCache
+) -> bool:
+    _check_operands("glob-matches", operands, 1)
+    return all(cache.glob(pattern, context.cwd) for pattern in operands)
+
+
+def _command_exists(
+    operands: List[str], context: ExecutionContext, cache: DirectoryCache
+) -> bool:
+    _check_operands("command-exists", operands, 1)
+    search_path = context.environ.get("PATH", os.defpath)
+    for command in operands:
+        if "/" in command or os.sep in command:
+            command = context.path(command)
+        if shutil.which(command, path=search_path) is None:
+            return False
+    return True
+
+
+PREDICATES: Dict[str, Callable[[List[str], ExecutionContext, DirectoryCache], bool]] = {
+    "exists": _exists,
+    "newer": _newer,
+    "env": _env,
+    "eq": _eq,
+    "glob-matches": _glob_matches,
+    "command-exists": _command_exists,
+}
+
+
+def evaluate(args: List[str], context: ExecutionContext, cache: DirectoryCache) -> bool:
+    """Evaluate a condition like ["not", "exists", "build"] in context."""
+    negate = False
+    while args and args[0] == "not":
+        negate = not negate
+        args = args[1:]
+    if not args:
+        raise ValueError("'if' requires a condition")
+    predicate = PREDICATES.get(args[0])
+    if predicate is None:
+        raise ValueError(
+            f"Unknown condition '{args[0]}', expected one of: {', '.join(PREDICATES)}"
+        )
+    return predicate(args[1:], context, cache) != negate
@@ -0,0 +1,149 @@
+"""Execution context of commands: working directory, environment variables and print settings.
+
+Commands like `cd`, `export` and `source` change the context instead of the lus process, and
+every child process gets it through cwd= and env=. Nested invocations run in a copy, so what
+they change doesn't leak back, just like for a subprocess.
+"""
+
+import contextlib
+import errno
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Mapping, MutableMapping, Optional, Set, Tuple
+
+
+def _normalize_key(key: str) -> str:
+    # Environment variable names aren't case-sensitive on Windows, os.environ upper-cases them
+    return key.upper() if os.name == "nt" else key
+
+
+class EnvironmentOverlay(MutableMapping):
+    """Environment variables as changes on top of a snapshot that is never modified.
+
+    A copy shares the snapshot and only copies the changes, which are usually a handful of
+    variables, so copies are cheap however large the environment is.
+    """
+
+    def __init__(self, base: Mapping[str, str]):
+        self._base = base
+        self._set: Dict[str, str] = {}
+        self._unset: Set[str] = set()
+        # The merged variables, until the next change
+        self._merged: Optional[Mapping[str, str]] = None
+
+    @classmethod
+    def from_process(cls) -> "EnvironmentOverlay":
+        return cls(dict(os.environ))
+
+    def __getitem__(self, key: str) -> str:
+        key = _normalize_key(key)
+        if key in self._set:
+            return self._set[key]
+        if key in self._unset:
+            raise KeyError(key)
+        return self._base[key]
+
+    def __setitem__(self, key: str, value: str):
+        key = _normalize_key(key)
+        self._set[key] = str(value)
+        self._unset.discard(key)
+        self._merged = None
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        key = _normalize_key(key)
+        self._set.pop(key, None)
+        if key in self._base:
+            self._unset.add(key)
+        self._merged = None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.to_dict())
+
+    def __len__(self) -> int:
+        return len(self.to_dict())
+
+    def copy(self) -> "EnvironmentOverlay":
+        overlay = EnvironmentOverlay(self._base)
+        overlay._set = dict(self._set)
+        overlay._unset = set(self._unset)
+        overlay._merged = self._merged
+        return overlay
+
+    def to_dict(self) -> Mapping[str, str]:
+        """All variables, e.g. for env=. The result is shared and must not be modified."""
+        if not self._set and not self._unset:
+            return self._base
+        if self._merged is None:
+            merged = dict(self._base)
+            merged.update(self._set)
+            for key in self._unset:
+                del merged[key]
+            self._merged = merged
+        return self._merged
+
+    def changes(self) -> Tuple[Dict[str, str], List[str]]:
+        """(variables set, variables unset) compared to the snapshot."""
+        changed = {
+            key: value for key, value in self._set.items() if self._base.get(key) != value
+        }
+        return changed, sorted(self._unset)
+
+    def reset(self, changed: Mapping[str, str], unset: List[str]):
+        """Replace all changes, e.g. with ones returned by changes() before."""
+        self._set = {}
+        self._unset = set()
+        self._merged = None
+        self.update(changed)
+        for key in unset:
+            self.pop(key, None)
+
+
+@dataclass
+class ExecutionContext:
+    cwd: str
+    environ: EnvironmentOverlay = field(default_factory=EnvironmentOverlay.from_process)
+    print_commands: bool = True
+    # Where `cd -` goes
+    old_cwd: Optional[str] = None
+
+    def __post_init__(self):
+        if self.old_cwd is None:
+            self.old_cwd = self.cwd
+
+    def copy(self) -> "ExecutionContext":
+        return ExecutionContext(
+            self.cwd, self.environ.copy(), self.print_commands, self.old_cwd
+        )
+
+    def path(self, path: str) -> str:
+        """path relative to the working directory of the context, made absolute."""
+        return os.path.normpath(os.path.join(self.cwd, path))
+
+    def chdir(self, path: str):
+        directory = self.path(path)
+        if not os.path.isdir(directory):
+            code = errno.ENOTDIR if os.path.exists(directory) else errno.ENOENT
+            error = NotADirectoryError if code == errno.ENOTDIR else FileNotFoundError
+            raise error(code, os.strerror(code), path)
+        self.old_cwd = self.cwd
+        self.cwd = directory
+
+    @contextlib.contextmanager
+    def applied(self) -> Iterator[None]:
+        """Make this the working directory and environment of the process for a while.
+
+        Only for code that runs in the lus process itself, like `py`.
+        """
+        working_directory = os.getcwd()
+        environment = dict(os.environ)
+        os.chdir(self.cwd)
+        os.environ.clear()
+        os.environ.update(self.environ.to_dict())
+        try:
+            yield
+        finally:
+            os.chdir(working_directory)
+            os.environ.clear()
+            os.environ.update(environment)
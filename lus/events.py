@@ -0,0 +1,94 @@
+"""Machine-readable progress events, one JSON object per line (--events-fd / --events-file).
+
+Every event has "event" (its type) and "time" (seconds since the epoch):
+
+    run-start      args
+    run-finish     args, status, duration
+    task-start     task (list of subcommand names)
+    task-finish    task, status, duration
+    spawn          argv, pid, task
+    exit           argv, pid, task, status, duration
+    timeout        argv, pid, task, reason (the command exceeded e.g. "timeout=10m" and is stopped;
+                   pid is null for `py` and worker= commands)
+    command        argv, task, status, duration (every command of a lus.kdl, also built-ins)
+    cache          kind, hit, and what the cache is about (e.g. script for kind "source")
+    shared         args, status (an identical invocation's result was reused)
+    skipped        argv, task (finished in the failed run that is resumed)
+    dropped        count (events lost because the consumer didn't keep up)
+"""
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+# Events waiting to be written, more are dropped instead of slowing lus down
+QUEUE_SIZE = 10000
+
+# How long to wait for a slow consumer to take the remaining events at the end
+CLOSE_TIMEOUT = 5
+
+
+class EventWriter:
+    """Writes events from a background thread, so that a slow consumer never blocks lus."""
+
+    def __init__(self, fd: int, close_fd: bool = False):
+        self._fd = fd
+        self._close_fd = close_fd
+        self._queue: "queue.Queue[Optional[bytes]]" = queue.Queue(QUEUE_SIZE)
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._broken = False
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def open(cls, path: str) -> "EventWriter":
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        return cls(fd, close_fd=True)
+
+    def emit(self, event: str, **fields: Any):
+        if self._broken:
+            return
+        line = json.dumps({"event": event, "time": time.time(), **fields}, default=str)
+        try:
+            self._queue.put_nowait(line.encode("utf-8", "surrogateescape") + b"\n")
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def _write(self):
+        while True:
+            data = self._queue.get()
+            finished = data is None
+            data = data or b""
+            with self._lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                data = (
+                    json.dumps({"event": "dropped", "time": time.time(), "count": dropped})
+                    .encode()
+                    + b"\n"
+                    + data
+                )
+            try:
+                while data:
+                    data = data[os.write(self._fd, data) :]
+            except OSError:
+                # E.g. the consumer has gone away, which must not make the run fail
+                self._broken = True
+                return
+            if finished:
+                return
+
+    def close(self):
+        if not self._broken:
+            try:
+                self._queue.put(None, timeout=CLOSE_TIMEOUT)
+            except queue.Full:
+                pass
+        self._thread.join(CLOSE_TIMEOUT)
+        if self._close_fd and not self._thread.is_alive():
+            os.close(self._fd)
@@ -0,0 +1,350 @@
+"""Glob expansion for command arguments, since lus doesn't run commands through a shell."""
+
+import functools
+import os
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_MAGIC = re.compile(r"[*?[]")
+
+
+def has_magic(pattern: str) -> bool:
+    return _MAGIC.search(pattern) is not None
+
+
+def _translate(pattern: str, any_depth: bool = False) -> str:
+    """Translate a glob pattern into a regex, where * and ? don't match /.
+
+    With any_depth, ** matches across directories like in .gitignore files.
+    """
+    result = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            if any_depth and i < n and pattern[i] == "*":
+                i += 1
+                if i < n and pattern[i] == "/":
+                    i += 1
+                    result.append("(?:.*/)?")
+                else:
+                    result.append(".*")
+            else:
+                result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            j = i
+            if j < n and pattern[j] in "!^":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            while j < n and pattern[j] != "]":
+                j += 1
+            if j >= n:
+                result.append("\\[")
+            else:
+                content = pattern[i:j].replace("\\", "\\\\")
+                if content[0] in "!^":
+                    content = "^" + content[1:]
+                try:
+                    re.compile(f"[{content}]")
+                except re.error:
+                    # Like in shells, an invalid bracket expression (e.g. x[2-1]) is literal
+                    result.append("\\[")
+                    continue
+                i = j + 1
+                result.append(f"[{content}]")
+        else:
+            result.append(re.escape(c))
+    return "".join(result)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(pattern: str) -> "re.Pattern[str]":
+    return re.compile(_translate(pattern) + r"\Z")
+
+
+class _IgnoreRules:
+    """The patterns of one .gitignore file."""
+
+    def __init__(self, content: str):
+        self._rules: List[Tuple["re.Pattern[str]", bool, bool]] = []
+        for line in content.splitlines():
+            line = line.rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negate = line.startswith("!")
+            if negate:
+                line = line[1:]
+            directory_only = line.endswith("/")
+            line = line.rstrip("/")
+            if not line:
+                continue
+            if "/" in line:
+                # Anchored to the directory of the .gitignore file
+                regex = _translate(line.lstrip("/"), any_depth=True)
+            else:
+                regex = "(?:.*/)?" + _translate(line, any_depth=True)
+            self._rules.append((re.compile(regex + r"\Z"), negate, directory_only))
+
+    def match(self, path: str, is_dir: bool) -> Optional[bool]:
+        """True if path (relative to the .gitignore) is ignored, False if re-included."""
+        result = None
+        for regex, negate, directory_only in self._rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(path):
+                result = not negate
+        return result
+
+
+# (directory, rules) of the .gitignore files that apply to a directory, from the top down, or
+# None when .gitignore files aren't taken into account
+_IgnoreChain = Optional[Tuple[Tuple[str, "_IgnoreRules"], ...]]
+
+
+class _Entry:
+    __slots__ = ("mtime", "generation", "children", "ignore")
+
+    def __init__(self, mtime, generation, children, ignore):
+        self.mtime = mtime
+        self.generation = generation
+        # (name, is_dir, is_symlink)
+        self.children: List[Tuple[str, bool, bool]] = children
+        self.ignore: Optional[_IgnoreRules] = ignore
+
+
+class DirectoryCache:
+    """Directory listings and stat() results shared by all glob patterns and conditions of a run.
+
+    Call invalidate() whenever something may have changed the file system (i.e. after running a
+    command). Listings are then revalidated lazily with a single stat() of the directory.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _Entry] = {}
+        self._generation = 0
+        self._top_directories: Dict[str, str] = {}
+        # stat() results by path (None if missing) since the last invalidate()
+        self._stats: Dict[str, Optional[os.stat_result]] = {}
+
+    def invalidate(self):
+        self._generation += 1
+        self._stats.clear()
+
+    def stat(self, path: str) -> Optional[os.stat_result]:
+        """os.stat() of path, None if it doesn't exist."""
+        if path not in self._stats:
+            try:
+                self._stats[path] = os.stat(path)
+            except OSError:
+                self._stats[path] = None
+        return self._stats[path]
+
+    def _entry(self, directory: str) -> Optional[_Entry]:
+        entry = self._entries.get(directory)
+        if entry is not None and entry.generation == self._generation:
+            return entry
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            self._entries.pop(directory, None)
+            return None
+        if entry is not None and entry.mtime == mtime:
+            entry.generation = self._generation
+            return entry
+
+        children = []
+        ignore = None
+        try:
+            with os.scandir(directory) as it:
+                for child in it:
+                    try:
+                        is_dir = child.is_dir()
+                    except OSError:
+                        is_dir = False
+                    children.append((child.name, is_dir, child.is_symlink()))
+                    if child.name == ".gitignore" and not is_dir:
+                        try:
+                            with open(child.path, "r", encoding="utf-8") as f:
+                                ignore = _IgnoreRules(f.read())
+                        except (OSError, UnicodeDecodeError):
+                            pass
+        except OSError:
+            return None
+        entry = _Entry(mtime, self._generation, children, ignore)
+        self._entries[directory] = entry
+        return entry
+
+    def listdir(self, directory: str) -> List[Tuple[str, bool, bool]]:
+        entry = self._entry(directory)
+        return entry.children if entry is not None else []
+
+    def _top_directory(self, directory: str) -> str:
+        """The root of the git repository containing directory, or directory itself."""
+        if directory not in self._top_directories:
+            current = directory
+            while True:
+                if os.path.exists(os.path.join(current, ".git")):
+                    top = current
+                    break
+                parent = os.path.dirname(current)
+                if parent == current:
+                    top = directory
+                    break
+                current = parent
+            self._top_directories[directory] = top
+        return self._top_directories[directory]
+
+    def _ignore_chain(self, directory: str) -> _IgnoreChain:
+        """The .gitignore files that apply to the entries of directory."""
+        top = self._top_directory(directory)
+        chain: Tuple[Tuple[str, _IgnoreRules], ...] = ()
+        current = top
+        parts = os.path.relpath(directory, top).split(os.sep)
+        for part in [""] + [part for part in parts if part not in ("", ".")]:
+            current = os.path.join(current, part) if part else current
+            entry = self._entry(current)
+            if entry is not None and entry.ignore is not None:
+                chain += ((current, entry.ignore),)
+        return chain
+
+    @staticmethod
+    def _is_ignored(chain: _IgnoreChain, path: str, is_dir: bool) -> bool:
+        ignored = False
+        if chain is None:
+            return ignored
+        for directory, rules in chain:
+            relative = path[len(directory) :].lstrip(os.sep).replace(os.sep, "/")
+            result = rules.match(relative, is_dir)
+            if result is not None:
+                ignored = result
+        return ignored
+
+    def _child_chain(self, chain: _IgnoreChain, directory: str) -> _IgnoreChain:
+        if chain is None:
+            return chain
+        entry = self._entry(directory)
+        if entry is not None and entry.ignore is not None:
+            return chain + ((directory, entry.ignore),)
+        return chain
+
+    def glob(self, pattern: str, cwd: str, tracked: bool = False) -> List[str]:
+        """Return the sorted paths matching pattern, relative to cwd unless pattern is absolute.
+
+        Like in shells, * and ? don't match a leading dot and ** matches any number of
+        directories. With tracked, matches of wildcards that are ignored by a .gitignore file
+        are left out.
+        """
+        if os.name == "nt":
+            pattern = pattern.replace("\\", "/")
+        directories_only = pattern.endswith("/")
+        drive, rest = os.path.splitdrive(pattern)
+        if rest.startswith("/"):
+            base = os.path.abspath(drive + "/")
+            prefix = drive + "/"
+        else:
+            base = os.path.abspath(os.path.join(cwd, drive))
+            prefix = drive
+        segments = [segment for segment in rest.split("/") if segment]
+        if not segments:
+            return []
+
+        results = set()
+        for path, is_dir in self._match(
+            base, prefix, segments, 0, self._ignore_chain(base) if tracked else None
+        ):
+            if directories_only:
+                if is_dir:
+                    results.add(path + "/")
+            else:
+                results.add(path)
+        return sorted(results)
+
+    def _match(
+        self,
+        directory: str,
+        prefix: str,
+        segments: List[str],
+        index: int,
+        chain: _IgnoreChain,
+    ) -> Iterator[Tuple[str, bool]]:
+        segment = segments[index]
+        last = index == len(segments) - 1
+
+        if segment == "**":
+            if last:
+                # Like bash' globstar, a trailing ** matches all files and directories
+                yield from self._walk(directory, prefix, chain)
+                return
+            yield from self._match(directory, prefix, segments, index + 1, chain)
+            for name, is_dir, is_symlink in self.listdir(directory):
+                if not is_dir or is_symlink or name.startswith("."):
+                    continue
+                path = os.path.join(directory, name)
+                if self._is_ignored(chain, path, True):
+                    continue
+                yield from self._match(
+                    path,
+                    _join(prefix, name),
+                    segments,
+                    index,
+                    self._child_chain(chain, path),
+                )
+        elif has_magic(segment):
+            regex = _compile(segment)
+            for name, is_dir, _ in self.listdir(directory):
+                if name.startswith(".") and not segment.startswith("."):
+                    continue
+                if not regex.match(name) or (not last and not is_dir):
+                    continue
+                path = os.path.join(directory, name)
+                if self._is_ignored(chain, path, is_dir):
+                    continue
+                if last:
+                    yield _join(prefix, name), is_dir
+                else:
+                    yield from self._match(
+                        path,
+                        _join(prefix, name),
+                        segments,
+                        index + 1,
+                        self._child_chain(chain, path),
+                    )
+        else:
+            path = os.path.join(directory, segment)
+            if last:
+                if os.path.lexists(path):
+                    yield _join(prefix, segment), os.path.isdir(path)
+            elif os.path.isdir(path):
+                yield from self._match(
+                    path,
+                    _join(prefix, segment),
+                    segments,
+                    index + 1,
+                    self._child_chain(chain, path),
+                )
+
+    def _walk(
+        self, directory: str, prefix: str, chain: _IgnoreChain
+    ) -> Iterator[Tuple[str, bool]]:
+        for name, is_dir, is_symlink in self.listdir(directory):
+            if name.startswith("."):
+                continue
+            path = os.path.join(directory, name)
+            if self._is_ignored(chain, path, is_dir):
+                continue
+            yield _join(prefix, name), is_dir
+            if is_dir and not is_symlink:
+                yield from self._walk(
+                    path, _join(prefix, name), self._child_chain(chain, path)
+                )
+
+
+def _join(prefix: str, name: str) -> str:
+    if not prefix or prefix.endswith("/"):
+        return prefix + name
+    return f"{prefix}/{name}"
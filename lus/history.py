@@ -0,0 +1,175 @@
+"""Run history in a SQLite database in the project's cache directory."""
+
+import json
+import math
+import os
+import socket
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+from termcolor import colored
+
+from .cache import cache_directory
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    task TEXT NOT NULL,
+    args TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    status INTEGER NOT NULL,
+    duration REAL NOT NULL,
+    host TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS commands (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    position INTEGER NOT NULL,
+    command TEXT NOT NULL,
+    duration REAL NOT NULL,
+    status INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_task ON runs(task, started);
+"""
+
+# Number of runs compared against each other for the trend
+TREND_WINDOW = 5
+
+
+def _connect(project_root: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(
+        os.path.join(cache_directory(project_root), "history.sqlite3"), timeout=5
+    )
+    connection.executescript(_SCHEMA)
+    return connection
+
+
+def split_task(args: List[str]) -> Tuple[str, List[str], List[str]]:
+    """Split the command line like LusFile.check_args does into (task, args, flags)."""
+    flags = []
+    remaining = []
+    for arg in args:
+        if len(remaining) == 0 and arg.startswith("-"):
+            flags.append(arg)
+        else:
+            remaining.append(arg)
+    return (remaining[0] if remaining else ""), remaining[1:], flags
+
+
+def record_run(
+    project_root: str,
+    args: List[str],
+    started: float,
+    status: int,
+    commands: List[Tuple[str, float, int]],
+):
+    """Append a run with its (command, duration, status) steps to the history.
+
+    Errors are ignored, the history must never be the reason a task fails.
+    """
+    task, task_args, flags = split_task(args)
+    try:
+        connection = _connect(project_root)
+        try:
+            with connection:
+                cursor = connection.execute(
+                    "INSERT INTO runs (started, task, args, flags, status, duration, host) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        started,
+                        task,
+                        json.dumps(task_args),
+                        json.dumps(flags),
+                        status,
+                        time.time() - started,
+                        socket.gethostname(),
+                    ),
+                )
+                connection.executemany(
+                    "INSERT INTO commands (run_id, position, command, duration, status) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (cursor.lastrowid, position, command, duration, command_status)
+                        for position, (command, duration, command_status) in enumerate(
+                            commands
+                        )
+                    ],
+                )
+        finally:
+            connection.close()
+    except (OSError, sqlite3.Error):
+        pass
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    return f"{int(seconds // 60)}m{seconds % 60:04.1f}s"
+
+
+def print_stats(project_root: str, task: Optional[str] = None):
+    connection = _connect(project_root)
+    try:
+        if task is None:
+            tasks = [
+                row[0]
+                for row in connection.execute(
+                    "SELECT task FROM runs GROUP BY task ORDER BY MAX(started) DESC"
+                )
+            ]
+        else:
+            tasks = [task]
+
+        if not tasks:
+            print("No runs recorded yet.")
+            return
+
+        for name in tasks:
+            runs = connection.execute(
+                "SELECT status, duration FROM runs WHERE task = ? ORDER BY started",
+                (name,),
+            ).fetchall()
+            label = colored(name or "(default)", attrs=["bold"])
+            if not runs:
+                print(f"{label}: no runs recorded")
+                continue
+            durations = [duration for status, duration in runs if status == 0]
+            failures = len(runs) - len(durations)
+            summary = f"{len(runs)} runs"
+            if failures:
+                summary += ", " + colored(f"{failures} failed", "red")
+            if durations:
+                summary += (
+                    f", p50 {_format_duration(percentile(durations, 50))}"
+                    f", p95 {_format_duration(percentile(durations, 95))}"
+                )
+            if len(durations) >= 2 * TREND_WINDOW:
+                recent = sum(durations[-TREND_WINDOW:]) / TREND_WINDOW
+                before = sum(durations[-2 * TREND_WINDOW : -TREND_WINDOW]) / TREND_WINDOW
+                if before > 0:
+                    change = (recent - before) / before * 100
+                    color = "red" if change > 0 else "green"
+                    summary += ", trend " + colored(f"{change:+.0f}%", color)
+            print(f"{label}: {summary}")
+
+            if not durations:
+                continue
+            slowest = connection.execute(
+                "SELECT command, AVG(duration) AS average FROM commands "
+                "WHERE run_id IN (SELECT id FROM runs WHERE task = ? AND status = 0) "
+                "GROUP BY command ORDER BY average DESC LIMIT 5",
+                (name,),
+            ).fetchall()
+            for command, average in slowest:
+                print(f"    {_format_duration(average):>9}  {command}")
+    finally:
+        connection.close()
@@ -0,0 +1,101 @@
+"""GNU make jobserver, so that lus and the make/ninja/cargo processes it starts share one job limit.
+
+See https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html. Every process owns one
+implicit job and has to read a token from the jobserver for each additional job, writing it back
+once that job has finished.
+"""
+
+import os
+import re
+import select
+import shutil
+import tempfile
+from typing import List, Optional
+
+_AUTH = re.compile(r"--jobserver-(?:auth|fds)=(?:fifo:(\S+)|(\d+),(\d+))")
+
+
+class JobServer:
+    def __init__(self, read_fd: int, write_fd: int, makeflags: Optional[str] = None):
+        self._read_fd = read_fd
+        self._write_fd = write_fd
+        self._directory: Optional[str] = None
+        self._old_makeflags: Optional[str] = None
+        self._makeflags = makeflags
+
+    @classmethod
+    def create(cls, jobs: int) -> Optional["JobServer"]:
+        """Create a new fifo-based jobserver for jobs parallel jobs (requires GNU make 4.4)."""
+        if os.name == "nt" or not hasattr(os, "mkfifo"):
+            return None
+        directory = tempfile.mkdtemp(prefix="lus-jobserver-")
+        path = os.path.join(directory, "fifo")
+        os.mkfifo(path, 0o600)
+        # Opening for reading and writing doesn't block until the other side is opened
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+        jobserver = cls(fd, fd, f"-j{jobs} --jobserver-auth=fifo:{path}")
+        jobserver._directory = directory
+        # One job is the implicit one of lus itself
+        os.write(fd, b"+" * (jobs - 1))
+        return jobserver
+
+    @classmethod
+    def from_environment(cls) -> Optional["JobServer"]:
+        """Join the jobserver of a parent make (or lus) process, if there is one."""
+        if os.name == "nt":
+            return None
+        match = None
+        for match in _AUTH.finditer(os.environ.get("MAKEFLAGS", "")):
+            pass  # the last one wins
+        if match is None:
+            return None
+        try:
+            if match.group(1):
+                fd = os.open(match.group(1), os.O_RDWR | os.O_NONBLOCK)
+                return cls(fd, fd)
+            read_fd, write_fd = int(match.group(2)), int(match.group(3))
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+            return cls(read_fd, write_fd)
+        except OSError:
+            # The parent didn't pass the file descriptors (e.g. no `+` in front of the recipe)
+            return None
+
+    @property
+    def pass_fds(self) -> List[int]:
+        """File descriptors children need to inherit to use the jobserver."""
+        return [] if self._directory is not None else sorted({self._read_fd, self._write_fd})
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """Read a token, waiting at most timeout seconds. Returns None on timeout."""
+        while True:
+            readable, _, _ = select.select([self._read_fd], [], [], timeout)
+            if not readable:
+                return None
+            try:
+                # Inherited pipes are blocking (they're shared with the parent), fifos aren't
+                token = os.read(self._read_fd, 1)
+            except BlockingIOError:
+                continue  # another process was faster
+            if token:
+                return token
+
+    def release(self, token: bytes):
+        os.write(self._write_fd, token)
+
+    def __enter__(self):
+        if self._makeflags is not None:
+            # Children like make, ninja and cargo find the jobserver through MAKEFLAGS
+            self._old_makeflags = os.environ.get("MAKEFLAGS")
+            os.environ["MAKEFLAGS"] = self._makeflags
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._makeflags is not None:
+            if self._old_makeflags is None:
+                os.environ.pop("MAKEFLAGS", None)
+            else:
+                os.environ["MAKEFLAGS"] = self._old_makeflags
+        if self._directory is not None:
+            os.close(self._read_fd)
+            shutil.rmtree(self._directory, ignore_errors=True)
@@ -0,0 +1,82 @@
+"""Journal of the finished steps of a run, so that a failed run can be resumed (lus --resume).
+
+The journal is a JSON-lines file in the cache directory, one per command line. The first line
+describes the run, every further line one finished step: which command of which node it was,
+its expanded argv and the working directory and environment changes after it. A run that
+succeeds removes its journal.
+"""
+
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from .cache import cache_directory
+
+JOURNAL_VERSION = 1
+
+
+def journal_path(project_root: str, args: List[str]) -> str:
+    directory = os.path.join(cache_directory(project_root), "journal")
+    os.makedirs(directory, exist_ok=True)
+    key = hashlib.sha256(json.dumps(args).encode("utf-8", "surrogateescape")).hexdigest()
+    return os.path.join(directory, f"{key}.jsonl")
+
+
+def file_hashes(paths: List[str]) -> Dict[str, Optional[str]]:
+    """sha256 of each file, None for files that don't exist (anymore)."""
+    hashes = {}
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                hashes[path] = hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            hashes[path] = None
+    return hashes
+
+
+def load_journal(path: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """Return (header, steps) of the journal at path, if there is one."""
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            break  # the last line may be incomplete after a crash
+    if not entries or entries[0].get("version") != JOURNAL_VERSION:
+        return None
+    header, steps = entries[0], entries[1:]
+    # Included files are only known at the end of the run
+    for step in steps:
+        if "includes" in step:
+            header = dict(header, includes=step["includes"])
+    return header, [step for step in steps if "includes" not in step]
+
+
+class Journal:
+    def __init__(self, path: str, header: Dict[str, Any]):
+        self.path = path
+        # The environment may contain secrets, so it's only readable by the user
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        self._file = os.fdopen(fd, "w", encoding="utf-8", errors="surrogateescape")
+        self._write(dict(header, version=JOURNAL_VERSION))
+
+    def _write(self, entry: Dict[str, Any]):
+        self._file.write(json.dumps(entry) + "\n")
+        # Written right away, the run may be killed at any time
+        self._file.flush()
+
+    def record(self, step: Dict[str, Any]):
+        self._write(step)
+
+    def close(self, succeeded: bool, includes: List[str]):
+        if not succeeded:
+            self._write({"includes": file_hashes(includes)})
+        self._file.close()
+        if succeeded:
+            os.remove(self.path)
@@ -0,0 +1,307 @@
+"""Running a subcommand in every project of a tree with many lus.kdl files (lus --all)."""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import kdl
+from kdl.errors import ParseError
+from termcolor import colored
+
+from .LusFile import LusFile, _ensure_kdl_supports_bare_identifiers, _normalize_nodes
+from .cache import cache_directory
+from .jobserver import JobServer
+from .output import OutputFilter, OutputMultiplexer, pipe
+from .timeouts import TIMEOUT_STATUS, Deadline
+
+INDEX_VERSION = 1
+
+
+def _load_index(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "r") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return index if index.get("version") == INDEX_VERSION else {}
+
+
+def _save_index(path: str, index: Dict[str, Any]):
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(dict(index, version=INDEX_VERSION), f)
+        os.replace(tmp_file, path)
+    except OSError:
+        pass  # the index only saves time
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def find_projects(root: str, index: Dict[str, Any]) -> List[str]:
+    """Return the directories below root (relative, with /) that contain a lus.kdl file.
+
+    Every directory is listed once with os.scandir and remembered in index together with its
+    mtime, so later calls only list the directories in which entries were added or removed.
+    Hidden directories and symlinks are skipped.
+    """
+    known = index.get("directories", {})
+    directories = {}
+    projects = []
+    stack = ["."]
+    while stack:
+        relative = stack.pop()
+        path = os.path.join(root, relative)
+        mtime = _mtime(path)
+        if mtime is None:
+            continue
+        entry = known.get(relative)
+        if entry is None or entry["mtime"] != mtime:
+            has_lus_kdl = False
+            subdirectories = []
+            try:
+                with os.scandir(path) as it:
+                    for child in it:
+                        if child.name == "lus.kdl":
+                            has_lus_kdl = child.is_file()
+                        elif not child.name.startswith(".") and child.is_dir(
+                            follow_symlinks=False
+                        ):
+                            subdirectories.append(child.name)
+            except OSError:
+                continue
+            entry = {
+                "mtime": mtime,
+                "lus_kdl": has_lus_kdl,
+                "subdirectories": sorted(subdirectories),
+            }
+        directories[relative] = entry
+        if entry["lus_kdl"]:
+            projects.append(relative)
+        for name in reversed(entry["subdirectories"]):
+            stack.append(name if relative == "." else f"{relative}/{name}")
+    # Directories that don't exist anymore are dropped
+    index["directories"] = directories
+    return sorted(projects)
+
+
+def project_subcommands(directory: str, index: Dict[str, Any], project: str) -> List[str]:
+    """Return the subcommands defined by the lus.kdl in directory (and the files it includes).
+
+    They're cached in index until one of these files changes.
+    """
+    entry = index.setdefault("projects", {}).get(project)
+    if entry is not None and all(
+        _mtime(os.path.join(directory, path)) == mtime
+        for path, mtime in entry["mtimes"].items()
+    ):
+        return entry["subcommands"]
+
+    _ensure_kdl_supports_bare_identifiers()
+    subcommands: List[str] = []
+    mtimes: Dict[str, Optional[int]] = {}
+
+    def load(path: str) -> List:
+        full_path = os.path.join(directory, path)
+        mtimes[path] = _mtime(full_path)
+        with open(full_path, "r") as f:
+            content = f.read()
+        try:
+            return _normalize_nodes(kdl.parse(content).nodes)
+        except ParseError as e:
+            e.lus_file = os.path.join(project, path)
+            raise
+
+    nodes = load("lus.kdl")
+    for node in list(nodes):
+        if LusFile._is_include(node):
+            nodes.extend(load(str(node.args[0])))
+    for node in nodes:
+        name = node.name
+        if (
+            name
+            and name not in ("$", "-")
+            and name[0] != "-"
+            and not LusFile._is_include(node)
+            and not LusFile._is_conditional(node)
+            and name not in subcommands
+        ):
+            subcommands.append(name)
+
+    index["projects"][project] = {"mtimes": mtimes, "subcommands": subcommands}
+    return subcommands
+
+
+def _format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    return f"{int(seconds // 60)}m{seconds % 60:04.1f}s"
+
+
+class _JobSlots:
+    """Job slots for the projects: the implicit one of lus and the tokens of the jobserver."""
+
+    def __init__(self, jobserver: Optional[JobServer]):
+        self._jobserver = jobserver
+        self._implicit = threading.Lock()
+
+    def acquire(self) -> Optional[bytes]:
+        """Wait for a slot and return its token (None for the implicit one)."""
+        while True:
+            if self._implicit.acquire(blocking=False):
+                return None
+            token = self._jobserver.acquire(timeout=0.1)
+            if token is not None:
+                return token
+
+    def release(self, token: Optional[bytes]):
+        if token is None:
+            self._implicit.release()
+        else:
+            self._jobserver.release(token)
+
+
+def run_all(
+    root: str,
+    args: List[str],
+    jobs: Optional[int] = None,
+    output: str = "inherit",
+    filters: Iterable[str] = (),
+    deadline: Optional[Deadline] = None,
+) -> int:
+    """Run args in every project below root whose lus.kdl defines the subcommand.
+
+    Up to jobs projects run at the same time. Their output is prefixed with the project (or
+    grouped with --output group) and a summary of all projects is printed at the end. Each
+    project gets the time left until deadline as its --deadline, and projects whose turn comes
+    after it aren't started. Returns the exit status for lus itself.
+    """
+    subcommand = next((arg for arg in args if not arg.startswith("-")), None)
+    if subcommand is None:
+        raise ValueError("--all requires a subcommand")
+    jobs = jobs or os.cpu_count() or 1
+
+    index_path = os.path.join(cache_directory(root), "projects.json")
+    index = _load_index(index_path)
+    projects = find_projects(root, index)
+    results: Dict[str, Tuple[int, float]] = {}
+    errors: Dict[str, str] = {}
+    # Projects that weren't started because the deadline had passed
+    not_started = set()
+    selected = []
+    for project in projects:
+        try:
+            if subcommand in project_subcommands(
+                os.path.join(root, project), index, project
+            ):
+                selected.append(project)
+        except ParseError as e:
+            errors[project] = f"{e.lus_file}:{e}"
+        except OSError as e:
+            errors[project] = f"{e.strerror}: {e.filename}"
+    index["projects"] = {
+        project: entry
+        for project, entry in index.get("projects", {}).items()
+        if project in projects
+    }
+    _save_index(index_path, index)
+
+    multiplexer = OutputMultiplexer("group" if output == "group" else "prefix")
+
+    # The projects take their job slots from a jobserver, which their commands share as well
+    jobserver = JobServer.from_environment()
+    if jobserver is None and jobs > 1:
+        jobserver = JobServer.create(jobs)
+    slots = _JobSlots(jobserver) if jobserver is not None else None
+
+    def run(project: str) -> Tuple[int, float]:
+        token = slots.acquire() if slots is not None else None
+        try:
+            started = time.perf_counter()
+            deadline_args = []
+            if deadline is not None:
+                if deadline.expired():
+                    not_started.add(project)
+                    return TIMEOUT_STATUS, 0.0
+                deadline_args = ["--deadline", f"{deadline.remaining():.3f}"]
+            read_fd, write_fd = pipe()
+            try:
+                process = subprocess.Popen(
+                    [sys.executable, "-m", "lus"] + deadline_args + args,
+                    cwd=os.path.join(root, project),
+                    env=environment,
+                    stdin=subprocess.DEVNULL,
+                    stdout=write_fd,
+                    stderr=write_fd,
+                    pass_fds=jobserver.pass_fds if jobserver is not None else (),
+                )
+            except BaseException:
+                os.close(read_fd)
+                raise
+            finally:
+                os.close(write_fd)
+            captured = multiplexer.capture(
+                read_fd, project, OutputFilter.from_environment(filters, environment)
+            )
+            status = process.wait()
+            captured.finish(status)
+            return status, time.perf_counter() - started
+        finally:
+            if slots is not None:
+                slots.release(token)
+
+    if jobserver is not None:
+        jobserver.__enter__()
+    # Taken after entering the jobserver, so that the projects get its MAKEFLAGS
+    environment = dict(os.environ)
+    if sys.stdout.isatty():
+        # The output goes through a pipe, but ends up in a terminal
+        environment.setdefault("FORCE_COLOR", "1")
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(run, project): project for project in selected}
+            for future in concurrent.futures.as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        if jobserver is not None:
+            jobserver.__exit__(None, None, None)
+
+    passed = sum(1 for status, _ in results.values() if status == 0)
+    failed = len(results) - passed + len(errors)
+    print(
+        colored(
+            f"{passed} passed, {failed} failed, "
+            f"{len(projects) - len(selected) - len(errors)} without `{subcommand}`",
+            attrs=["bold"],
+        ),
+        flush=True,
+    )
+    width = max((len(project) for project in list(results) + list(errors)), default=0)
+    for project in sorted(list(results) + list(errors)):
+        if project in errors:
+            label, details = colored("error ", "red", attrs=["bold"]), errors[project]
+        elif project in not_started:
+            label = colored("FAILED", "red", attrs=["bold"])
+            details = f"not started, {deadline.reason} passed"
+        else:
+            status, duration = results[project]
+            details = _format_duration(duration)
+            if status == 0:
+                label = colored("ok    ", "green")
+            else:
+                label = colored("FAILED", "red", attrs=["bold"])
+                details += f" (exit status {status})"
+        print(f"  {label} {project.ljust(width)}  {details}")
+    if any(status == TIMEOUT_STATUS for status, _ in results.values()):
+        return TIMEOUT_STATUS
+    return 1 if failed else 0
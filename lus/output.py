@@ -0,0 +1,248 @@
+"""Capturing of child process output, so that concurrently running commands don't interleave.
+
+The captured output can also be filtered (--filter): escape sequences stripped, secrets masked
+and lines prefixed with a timestamp, e.g. for CI logs.
+"""
+
+import functools
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from typing import BinaryIO, Iterable, List, Mapping, Optional, Tuple
+
+OUTPUT_MODES = ("inherit", "prefix", "group")
+
+OUTPUT_FILTERS = ("strip-ansi", "timestamps", "mask-secrets")
+
+# Size of a single read from a child's pipe
+READ_SIZE = 1 << 20
+
+# Capacity of the pipes (where the system allows it), so that a chatty child needs fewer
+# wake-ups of the reading thread
+PIPE_SIZE = 1 << 20
+
+# Captured output above this size is moved from memory to a temporary file
+SPOOL_SIZE = 8 << 20
+
+# How much of the end of a failed command's output is kept for the error report
+TAIL_SIZE = 64 << 10
+TAIL_LINES = 50
+
+# CSI sequences (colors, cursor movement), OSC sequences (titles, hyperlinks) and other escapes
+_ANSI_ESCAPE = re.compile(
+    rb"\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[ -/]+[0-~]|[@-Z\\-_])"
+)
+
+# Environment variables whose values are masked by mask-secrets, e.g. GITHUB_TOKEN but not
+# TOKENIZERS_PARALLELISM
+_SECRET_NAME = re.compile(
+    r"(?:^|_)(?:TOKEN|SECRET|PASSWORD|PASSWD|API_?KEY|PRIVATE_?KEY|CREDENTIALS?)$", re.I
+)
+
+# Shorter values would mask too much unrelated output
+MIN_SECRET_LENGTH = 4
+
+SECRET_MASK = b"***"
+
+
+def pipe() -> Tuple[int, int]:
+    read_fd, write_fd = os.pipe()
+    try:
+        import fcntl
+
+        fcntl.fcntl(write_fd, getattr(fcntl, "F_SETPIPE_SZ", 1031), PIPE_SIZE)
+    except (ImportError, OSError):
+        pass  # not Linux, or above the system's limit
+    return read_fd, write_fd
+
+
+def _prefix_lines(lines: bytes, prefix: bytes) -> bytes:
+    """Prefix every line of lines, which ends with a newline."""
+    if not prefix:
+        return lines
+    return prefix + lines[:-1].replace(b"\n", b"\n" + prefix) + b"\n"
+
+
+@functools.lru_cache(maxsize=32)
+def _secret_pattern(secrets: Tuple[bytes, ...]) -> "re.Pattern[bytes]":
+    # Longest first, so that a secret containing another one is masked completely
+    return re.compile(b"|".join(re.escape(secret) for secret in secrets))
+
+
+class OutputFilter:
+    """Transforms complete lines of output, all lines of a chunk at once."""
+
+    def __init__(self, filters: Iterable[str], secrets: Iterable[str] = ()):
+        filters = set(filters)
+        self._strip_ansi = "strip-ansi" in filters
+        self._timestamps = "timestamps" in filters
+        self._secrets = None
+        secrets = sorted(
+            {secret.encode("utf-8", "surrogateescape") for secret in secrets},
+            key=lambda secret: (-len(secret), secret),
+        )
+        if "mask-secrets" in filters and secrets:
+            self._secrets = _secret_pattern(tuple(secrets))
+        self._second: Optional[int] = None
+        self._clock = b""
+
+    @classmethod
+    def from_environment(
+        cls, filters: Iterable[str], environ: Mapping[str, str]
+    ) -> Optional["OutputFilter"]:
+        """The filter for output of commands running with environ, None without filters."""
+        filters = list(filters)
+        if not filters:
+            return None
+        secrets = []
+        if "mask-secrets" in filters:
+            secrets = [
+                value
+                for name, value in environ.items()
+                if _SECRET_NAME.search(name) and len(value) >= MIN_SECRET_LENGTH
+            ]
+        return cls(filters, secrets)
+
+    def _timestamp(self) -> bytes:
+        now = time.time()
+        second = int(now)
+        if second != self._second:
+            self._second = second
+            self._clock = time.strftime("%H:%M:%S", time.localtime(second)).encode()
+        return self._clock + b".%03d " % int((now - second) * 1000)
+
+    def clean(self, lines: bytes) -> bytes:
+        """lines without escape sequences and secrets (depending on the filters)."""
+        if self._strip_ansi and b"\x1b" in lines:
+            lines = _ANSI_ESCAPE.sub(b"", lines)
+        if self._secrets is not None:
+            lines = self._secrets.sub(SECRET_MASK, lines)
+        return lines
+
+    def prefix(self, prefix: bytes = b"") -> bytes:
+        """prefix for lines written now, with the time in front of it for timestamps."""
+        return self._timestamp() + prefix if self._timestamps else prefix
+
+    def apply(self, lines: bytes, prefix: bytes = b"") -> bytes:
+        """Filter lines, which ends with a newline, and put prefix in front of each line."""
+        return _prefix_lines(self.clean(lines), self.prefix(prefix))
+
+
+class OutputMultiplexer:
+    """Writes the output of several children to one stream.
+
+    In "prefix" mode every line is written as soon as it's complete, prefixed with the label of
+    the task it belongs to. In "group" mode the output of a command is held back (in a temporary
+    file once it gets big) and written in one piece when the command has finished. "inherit"
+    mode writes the lines as they are and is only needed for filtering them.
+    """
+
+    def __init__(self, mode: str, stream: Optional[BinaryIO] = None):
+        if mode not in OUTPUT_MODES:
+            raise ValueError(f"Unknown output mode: {mode}")
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.lock = threading.Lock()
+
+    def capture(
+        self, fd: int, label: str, output_filter: Optional[OutputFilter] = None
+    ) -> "CapturedOutput":
+        return CapturedOutput(self, fd, label, output_filter)
+
+    def write(self, data: bytes):
+        with self.lock:
+            sys.stdout.flush()
+            self.stream.write(data)
+            self.stream.flush()
+
+
+class CapturedOutput:
+    """Reads the read end of a child's pipe in a background thread."""
+
+    def __init__(
+        self,
+        multiplexer: OutputMultiplexer,
+        fd: int,
+        label: str,
+        output_filter: Optional[OutputFilter] = None,
+    ):
+        self._multiplexer = multiplexer
+        self._fd = fd
+        self._prefix = f"[{label}] ".encode() if multiplexer.mode == "prefix" else b""
+        self._filter = output_filter
+        self._pending = b""
+        self._tail = bytearray()
+        self._spool = None
+        if multiplexer.mode == "group":
+            self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        # Without a filter, grouped output is kept as it is, otherwise it's split into lines
+        by_line = self._spool is None or self._filter is not None
+        try:
+            while True:
+                chunk = os.read(self._fd, READ_SIZE)
+                if not chunk:
+                    break
+                if by_line:
+                    data = self._pending + chunk
+                    end = data.rfind(b"\n") + 1
+                    self._pending = data[end:]
+                    if end:
+                        self._output_lines(data[:end])
+                else:
+                    self._output(chunk, chunk)
+        finally:
+            os.close(self._fd)
+        if by_line and self._pending:
+            self._output_lines(self._pending + b"\n")
+
+    def _output_lines(self, lines: bytes):
+        prefix = self._prefix
+        if self._filter is not None:
+            lines = self._filter.clean(lines)
+            prefix = self._filter.prefix(prefix)
+        self._output(lines, _prefix_lines(lines, prefix))
+
+    def _output(self, data: bytes, prefixed: bytes):
+        """Write prefixed, and remember the end of data (without prefixes) for tail()."""
+        self._tail += data
+        if len(self._tail) > 2 * TAIL_SIZE:
+            del self._tail[:-TAIL_SIZE]
+        if self._spool is not None:
+            self._spool.write(prefixed)
+        else:
+            self._multiplexer.write(prefixed)
+
+    def tail(self) -> List[bytes]:
+        return bytes(self._tail).splitlines()[-TAIL_LINES:]
+
+    def finish(self, status: int):
+        """Wait until the pipe is drained and write what hasn't been written yet."""
+        self._thread.join()
+        if self._spool is not None:
+            self._spool.seek(0)
+            with self._multiplexer.lock:
+                sys.stdout.flush()
+                while True:
+                    data = self._spool.read(READ_SIZE)
+                    if not data:
+                        break
+                    self._multiplexer.stream.write(data)
+                if self._tail and not self._tail.endswith(b"\n"):
+                    self._multiplexer.stream.write(b"\n")
+                self._multiplexer.stream.flush()
+            self._spool.close()
+        elif status != 0 and self._tail and self._multiplexer.mode == "prefix":
+            # The output of a failed command may be buried between the lines of others
+            lines = self.tail()
+            self._multiplexer.write(
+                self._prefix
+                + f"failed with exit code {status}, last {len(lines)} lines:\n".encode()
+                + b"".join(b"    " + line + b"\n" for line in lines)
+            )
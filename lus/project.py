@@ -0,0 +1,177 @@
+"""Library API: parse a lus.kdl once and then plan or run any number of invocations."""
+
+import os
+import subprocess
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import kdl
+
+from .LusFile import (
+    LusFile,
+    NormalizedNode,
+    _ensure_kdl_supports_bare_identifiers,
+    _normalize_nodes,
+)
+from .events import EventWriter
+from .timeouts import Deadline
+
+
+@dataclass(frozen=True)
+class Step:
+    """A command a run would execute, as resolved by LusProject.plan()."""
+
+    args: Tuple[str, ...]
+    # Subcommands leading to the command, e.g. ("release", "build")
+    task: Tuple[str, ...]
+    cwd: str
+    properties: Mapping[str, Any]
+
+
+@dataclass(frozen=True)
+class CommandTiming:
+    command: str
+    duration: float
+    status: int
+
+
+@dataclass(frozen=True)
+class RunResult:
+    status: int
+    # Wall time of the whole run in seconds
+    duration: float
+    timings: Tuple[CommandTiming, ...]
+
+    @property
+    def ok(self) -> bool:
+        return self.status == 0
+
+
+@dataclass(frozen=True)
+class LusProject:
+    """A parsed lus.kdl.
+
+    Every plan() and run() starts from the same state: they run in the project's directory with
+    a fresh execution context and leave the working directory and environment variables of this
+    process alone. Included files are parsed on first use and then kept as well.
+    """
+
+    path: str
+    root: str
+    content: str = field(repr=False)
+    _nodes: Tuple[NormalizedNode, ...] = field(repr=False, compare=False)
+    _includes: Dict[str, Any] = field(default_factory=dict, repr=False, compare=False)
+
+    @classmethod
+    def load(cls, path: str) -> "LusProject":
+        """Parse the lus.kdl at path (or in the directory path)."""
+        if os.path.isdir(path):
+            path = os.path.join(path, "lus.kdl")
+        path = os.path.abspath(path)
+        with open(path, "r") as f:
+            content = f.read()
+        return cls.from_string(content, os.path.dirname(path), path=path)
+
+    @classmethod
+    def from_string(
+        cls, content: str, root: str, path: Optional[str] = None
+    ) -> "LusProject":
+        _ensure_kdl_supports_bare_identifiers()
+        root = os.path.abspath(root)
+        return cls(
+            path=path or os.path.join(root, "lus.kdl"),
+            root=root,
+            content=content,
+            _nodes=tuple(_normalize_nodes(kdl.parse(content).nodes)),
+        )
+
+    def _lus_file(
+        self,
+        output: str = "inherit",
+        jobs: Optional[int] = None,
+        history: bool = False,
+        invocation_directory: Optional[str] = None,
+        filters: Iterable[str] = (),
+        deadline: Optional[Deadline] = None,
+        events: Optional[EventWriter] = None,
+    ) -> LusFile:
+        return LusFile(
+            self.content,
+            invocation_directory or self.root,
+            output=output,
+            history=history,
+            jobs=jobs,
+            events=events,
+            execute=False,
+            nodes=list(self._nodes),
+            includes=self._includes,
+            project_root=self.root,
+            filters=filters,
+            deadline=deadline,
+        )
+
+    def _subcommand_nodes(self) -> Dict[str, Tuple[NormalizedNode, str]]:
+        """The nodes of the subcommands, also those of included files, and the file of each."""
+        lus_file = self._lus_file()
+        nodes = [(node, self.path) for node in self._nodes]
+        for node in self._nodes:
+            if LusFile._is_include(node):
+                path = lus_file.context.path(str(node.args[0]))
+                nodes.extend((child, path) for child in lus_file._load_include(path)[0])
+        result: Dict[str, Tuple[NormalizedNode, str]] = {}
+        for node, path in nodes:
+            if (
+                node.name not in result
+                and node.name not in ("", "$", "-")
+                and not node.name.startswith("-")
+                and not LusFile._is_conditional(node)
+                and (len(node.children) > 0 or "include" in node.properties)
+            ):
+                result[node.name] = (node, path)
+        return result
+
+    def subcommands(self) -> Dict[str, Mapping[str, Any]]:
+        """The subcommands, also those of included files, with the properties of their nodes."""
+        return {
+            name: MappingProxyType(dict(node.properties))
+            for name, (node, _) in self._subcommand_nodes().items()
+        }
+
+    def plan(self, args: List[str]) -> List[Step]:
+        """Return the commands `lus <args>` would run, without running any of them.
+
+        Raises ValueError if args can't be resolved, e.g. for an unknown subcommand.
+        """
+        try:
+            steps = self._lus_file().plan(list(args))
+        except SystemExit as e:
+            raise ValueError(
+                f"Can't resolve {args} (exit status {LusFile._exit_status(e)})"
+            )
+        return [
+            Step(tuple(command), tuple(task), cwd, MappingProxyType(properties))
+            for command, task, cwd, properties in steps
+        ]
+
+    def run(
+        self, args: List[str], output: str = "inherit", jobs: Optional[int] = None
+    ) -> RunResult:
+        """Run `lus <args>` in this process and return its exit status and timings."""
+        lus_file = self._lus_file(output=output, jobs=jobs)
+        started = time.perf_counter()
+        status = 0
+        try:
+            lus_file.execute(list(args))
+        except SystemExit as e:
+            status = LusFile._exit_status(e)
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+        finally:
+            duration = time.perf_counter() - started
+        return RunResult(
+            status,
+            duration,
+            tuple(CommandTiming(*timing) for timing in lus_file.command_timings),
+        )
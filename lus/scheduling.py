@@ -0,0 +1,137 @@
+"""CPU affinity, nice level and I/O priority of commands (nice=10 cpus="0-7" ionice=idle).
+
+They're applied by lus to the child right after it has started, not in a preexec_fn, which
+isn't safe while other threads of lus (output readers, parallel jobs) are running. On Linux all
+of them are per thread, so they're applied to every thread the child has by then; threads it
+starts later inherit them.
+"""
+
+import ctypes
+import os
+import platform
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+SCHEDULING_PROPERTIES = ("nice", "cpus", "ionice")
+
+_IOPRIO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+_IOPRIO_CLASS_SHIFT = 13
+_IOPRIO_WHO_PROCESS = 1
+
+# Number of the ioprio_set system call, which has no wrapper in libc
+_SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "ppc64": 273,
+    "s390x": 282,
+}
+
+
+def parse_cpus(value: Any) -> Set[int]:
+    """Parse a CPU list like "0-3,8,10-11"."""
+    cpus = set()
+    for part in str(value).split(","):
+        part = part.strip()
+        try:
+            if "-" in part:
+                first, last = part.split("-", 1)
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(part))
+        except ValueError:
+            raise ValueError(f"Invalid CPU list: {value}")
+    if not cpus:
+        raise ValueError(f"Invalid CPU list: {value}")
+    return cpus
+
+
+def parse_ionice(value: Any) -> Tuple[int, int]:
+    """Parse "idle", "best-effort", "best-effort:7" or "realtime:0" into (class, level)."""
+    name, _, level = str(value).partition(":")
+    if name not in _IOPRIO_CLASSES:
+        raise ValueError(
+            f"Invalid I/O priority class '{name}', expected one of: {', '.join(_IOPRIO_CLASSES)}"
+        )
+    try:
+        level = int(level) if level else 4
+    except ValueError:
+        raise ValueError(f"Invalid I/O priority level: {value}")
+    if not 0 <= level <= 7:
+        raise ValueError(f"Invalid I/O priority level: {value}")
+    return _IOPRIO_CLASSES[name], 0 if name == "idle" else level
+
+
+def parse_nice(value: Any) -> int:
+    try:
+        nice = int(value)
+    except (TypeError, ValueError):
+        nice = None
+    if nice is None or not -20 <= nice <= 19:
+        raise ValueError(f"Invalid nice level '{value}', expected -20 to 19")
+    return nice
+
+
+def _ioprio_set_function() -> Optional[Callable[[int, int, int], None]]:
+    number = _SYS_IOPRIO_SET.get(platform.machine())
+    if platform.system() != "Linux" or number is None:
+        return None
+    libc = ctypes.CDLL(None, use_errno=True)
+
+    def ioprio_set(tid: int, ioprio_class: int, level: int):
+        libc.syscall(
+            number, _IOPRIO_WHO_PROCESS, tid, (ioprio_class << _IOPRIO_CLASS_SHIFT) | level
+        )
+
+    return ioprio_set
+
+
+def _threads(pid: int) -> List[int]:
+    try:
+        return [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except (OSError, ValueError):
+        return [pid]  # not Linux, or the process has exited already
+
+
+def scheduling_function(properties: Dict[str, Any]) -> Optional[Callable[[int], None]]:
+    """Return a function applying the scheduling properties to a child by pid, if there are any.
+
+    Raises a ValueError for invalid values. Settings the platform doesn't support are ignored.
+    """
+    if os.name == "nt" or not any(key in properties for key in SCHEDULING_PROPERTIES):
+        return None
+
+    nice = parse_nice(properties["nice"]) if "nice" in properties else None
+    cpus = parse_cpus(properties["cpus"]) if "cpus" in properties else None
+    ionice = parse_ionice(properties["ionice"]) if "ionice" in properties else None
+
+    set_affinity = getattr(os, "sched_setaffinity", None)
+    ioprio_set = _ioprio_set_function() if ionice is not None else None
+
+    def apply(pid: int):
+        for tid in _threads(pid):
+            try:
+                if nice is not None:
+                    try:
+                        # An absolute level, like the nice= of systemd units
+                        os.setpriority(os.PRIO_PROCESS, tid, nice)
+                    except PermissionError:
+                        pass  # only privileged users may lower it below that of lus
+                if cpus is not None and set_affinity is not None:
+                    set_affinity(tid, cpus)
+                if ionice is not None and ioprio_set is not None:
+                    ioprio_set(tid, *ionice)
+            except ProcessLookupError:
+                pass  # the thread or the whole child has exited already
+
+    return apply
+
+
+def describe(properties: Dict[str, Any]) -> str:
+    """E.g. "nice=10 cpus=0-7" for the scheduling properties in properties."""
+    return " ".join(
+        f"{key}={properties[key]}" for key in SCHEDULING_PROPERTIES if key in properties
+    )
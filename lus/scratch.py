@@ -0,0 +1,111 @@
+"""Scratch directories of subcommands for intermediate files (scratch=ram scratch-size="2G").
+
+    test scratch=ram scratch-size="4G" {
+        - tar -xf fixtures.tar -C $scratch
+        - pytest --basetemp "$scratch/pytest"
+    }
+
+With scratch=ram the directory is created on a tmpfs like /dev/shm, unless that has less room
+than the size cap, in which case it falls back to the temporary directory on disk. A tmpfs has
+no quotas for subdirectories, so the cap is checked after every command of the subcommand.
+"""
+
+import os
+import re
+import shutil
+import tempfile
+from typing import Any, Optional
+
+SCRATCH_MODES = ("ram", "disk")
+
+# Cap of scratch directories without scratch-size=
+DEFAULT_SCRATCH_SIZE = 1 << 30
+
+# Memory-backed file systems to create scratch=ram directories on, in order of preference
+RAM_DIRECTORIES = ("/dev/shm",)
+
+_SIZE_UNITS = {"": 1, "k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+_SIZE = re.compile(r"(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?", re.IGNORECASE)
+
+
+def parse_size(value: Any) -> int:
+    """Parse a size like 1048576 (bytes), "512M", "2G" or "1.5GiB" into bytes."""
+    match = _SIZE.fullmatch(str(value).strip())
+    if match is None or not float(match.group(1)) > 0:
+        raise ValueError(f"Invalid size '{value}', expected e.g. 512M or 2G")
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).lower()])
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def _free_space(path: str) -> Optional[int]:
+    try:
+        result = os.statvfs(path)
+    except (OSError, AttributeError):  # no statvfs on Windows
+        return None
+    return result.f_bavail * result.f_frsize
+
+
+def disk_usage(path: str) -> int:
+    """Bytes that the files below path take up, like `du -s`."""
+    total = 0
+    directories = [path]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError:
+            continue  # removed in the meantime
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                    continue
+                result = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            blocks = getattr(result, "st_blocks", None)
+            total += result.st_size if blocks is None else blocks * 512
+    return total
+
+
+class ScratchDirectory:
+    def __init__(self, path: str, size: int, in_ram: bool):
+        self.path = path
+        # Cap of the disk usage in bytes
+        self.size = size
+        self.in_ram = in_ram
+
+    @classmethod
+    def create(cls, mode: Any, size: int, label: str) -> "ScratchDirectory":
+        if mode not in SCRATCH_MODES:
+            raise ValueError(
+                f"Invalid scratch mode '{mode}', expected one of: {', '.join(SCRATCH_MODES)}"
+            )
+        parent = None
+        if mode == "ram":
+            for directory in RAM_DIRECTORIES:
+                free = _free_space(directory)
+                if free is not None and free >= size:
+                    parent = directory
+                    break
+        label = re.sub(r"[^\w.-]+", "-", label)
+        path = tempfile.mkdtemp(prefix=f"lus-{label}-", dir=parent)
+        return cls(path, size, parent is not None)
+
+    def check(self, what: str):
+        """Raise a ValueError if the files in the directory exceed the cap."""
+        usage = disk_usage(self.path)
+        if usage > self.size:
+            raise ValueError(
+                f"The scratch directory of {what} uses {format_size(usage)}, more than its "
+                f"scratch-size of {format_size(self.size)}"
+            )
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -0,0 +1,195 @@
+"""Splitting the subcommands matching a pattern into balanced shards (lus --shard 3/8 'test-*')."""
+
+import fnmatch
+import json
+import subprocess
+import sys
+from typing import Collection, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from termcolor import colored
+
+from .LusFile import LusFile
+from .events import EventWriter
+from .history import _format_duration
+from .project import LusProject
+from .timeouts import TIMEOUT_STATUS, Deadline
+
+# Cost of subcommands without a cost= property or entry in --shard-costs, if no other one has either
+DEFAULT_COST = 1.0
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse "3/8" into (3, 8), shards are numbered from 1."""
+    index, separator, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index = count = 0
+    if not separator or count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{value}', expected e.g. 3/8")
+    return index, count
+
+
+def load_costs(path: str) -> Dict[str, float]:
+    """Read a --shard-costs file, a JSON object of subcommand names and seconds.
+
+    Unlike the run history, which is different on every machine, the file is the same on every
+    CI node (e.g. committed or passed on as an artifact), so all nodes compute the same split.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            costs = json.load(f)
+    except OSError as e:
+        raise ValueError(f"Can't read {path}: {e.strerror}")
+    except ValueError as e:
+        raise ValueError(f"Invalid JSON in {path}: {e}")
+    if not isinstance(costs, dict) or not all(
+        isinstance(cost, (int, float)) and not isinstance(cost, bool) for cost in costs.values()
+    ):
+        raise ValueError(f"{path} must contain a JSON object of subcommand names and seconds")
+    return {name: float(cost) for name, cost in costs.items()}
+
+
+def task_costs(
+    project: LusProject, names: List[str], shared: Optional[Mapping[str, float]] = None
+) -> Dict[str, float]:
+    """Cost of each subcommand: its cost= property in seconds, else its entry in shared.
+
+    Subcommands without either get the median of the others, so that a new test doesn't end up
+    in the shard that happens to be the shortest at the moment. Nothing machine-local (like the
+    run history) is used, so every CI node computes the same costs.
+    """
+    subcommands = project.subcommands()
+    costs: Dict[str, float] = {}
+    for name in names:
+        if "cost" in subcommands[name]:
+            try:
+                costs[name] = float(subcommands[name]["cost"])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid cost of '{name}': {subcommands[name]['cost']}")
+        elif shared is not None and name in shared:
+            costs[name] = shared[name]
+    known = sorted(costs.values())
+    fallback = known[len(known) // 2] if known else DEFAULT_COST
+    return {name: costs.get(name, fallback) for name in names}
+
+
+def assign_shards(costs: Dict[str, float], count: int) -> List[List[str]]:
+    """Split the tasks into count shards with about the same total cost.
+
+    Longest tasks first, each into the shard with the lowest total so far. Ties are broken by
+    name and shard number, so every CI node computes the same split from the same costs.
+    """
+    shards: List[List[str]] = [[] for _ in range(count)]
+    totals = [0.0] * count
+    for name in sorted(costs, key=lambda name: (-costs[name], name)):
+        shard = min(range(count), key=lambda i: (totals[i], i))
+        shards[shard].append(name)
+        totals[shard] += costs[name]
+    return [sorted(shard) for shard in shards]
+
+
+def match_subcommands(project: LusProject, pattern: str) -> List[str]:
+    """Names of the subcommands that match a pattern like 'test-*'."""
+    matches = [
+        name for name in project.subcommands() if fnmatch.fnmatchcase(name, pattern)
+    ]
+    if not matches:
+        raise ValueError(f"No subcommand matches '{pattern}'")
+    return matches
+
+
+def run_tasks(
+    project: LusProject,
+    tasks: List[str],
+    task_args: List[str],
+    invocation_directory: Optional[str] = None,
+    output: str = "inherit",
+    jobs: Optional[int] = None,
+    filters: Iterable[str] = (),
+    deadline: Optional[Deadline] = None,
+    events: Optional[EventWriter] = None,
+) -> int:
+    """Run each of the subcommands tasks with task_args, all of them even after a failure.
+
+    Every subcommand is a run of its own in the events. Returns the exit status for lus itself,
+    which is TIMEOUT_STATUS if one of them exceeded its timeout or the deadline.
+    """
+    lus_file = project._lus_file(
+        output=output,
+        jobs=jobs,
+        history=True,
+        invocation_directory=invocation_directory,
+        filters=filters,
+        deadline=deadline,
+        events=events,
+    )
+    failed = []
+    timed_out = False
+    for task in tasks:
+        status = 0
+        try:
+            lus_file.execute([task] + task_args)
+        except SystemExit as e:
+            status = LusFile._exit_status(e)
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+        if status != 0:
+            failed.append(task)
+        timed_out = timed_out or status == TIMEOUT_STATUS
+    if failed:
+        print(
+            f"{colored('error:', 'red', attrs=['bold'])} {len(failed)} of {len(tasks)} "
+            f"subcommands failed: {', '.join(failed)}",
+            file=sys.stderr,
+        )
+        return TIMEOUT_STATUS if timed_out else 1
+    return 0
+
+
+def run_shard(
+    project: LusProject,
+    index: int,
+    count: int,
+    args: List[str],
+    invocation_directory: Optional[str] = None,
+    output: str = "inherit",
+    jobs: Optional[int] = None,
+    filters: Iterable[str] = (),
+    deadline: Optional[Deadline] = None,
+    only: Optional[Collection[str]] = None,
+    costs_file: Optional[str] = None,
+    events: Optional[EventWriter] = None,
+) -> int:
+    """Run the subcommands of shard index of count whose names match the pattern args[0].
+
+    With only, e.g. the subcommands affected by a change (see affected.py), the others are left
+    out before splitting. costs_file is a file for load_costs(). Returns the exit status of
+    run_tasks().
+    """
+    pattern, task_args = args[0], args[1:]
+    matches = match_subcommands(project, pattern)
+    if only is not None:
+        matches = [name for name in matches if name in only]
+    costs = task_costs(
+        project, matches, load_costs(costs_file) if costs_file is not None else None
+    )
+    tasks = assign_shards(costs, count)[index - 1]
+    print(
+        f"{colored('note:', 'blue', attrs=['bold'])} Shard {index}/{count} runs "
+        f"{len(tasks)} of the {len(matches)} subcommands matching '{pattern}' "
+        f"(about {_format_duration(sum(costs[task] for task in tasks))})",
+        file=sys.stderr,
+        flush=True,
+    )
+    return run_tasks(
+        project,
+        tasks,
+        task_args,
+        invocation_directory,
+        output=output,
+        jobs=jobs,
+        filters=filters,
+        deadline=deadline,
+        events=events,
+    )
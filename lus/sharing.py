@@ -0,0 +1,125 @@
+"""Deduplication of identical lus invocations running at the same time in the same project."""
+
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from termcolor import colored
+
+from .cache import cache_directory
+from .events import EventWriter
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def _terminal() -> Optional[str]:
+    """The terminal this process writes to, if any."""
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            if stream.isatty():
+                return os.ttyname(stream.fileno())
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _read_owner(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r") as f:
+            owner = json.load(f)
+    except (OSError, ValueError):
+        return None  # not written yet
+    return owner if isinstance(owner, dict) else None
+
+
+def run_shared(
+    project_root: str,
+    args: List[str],
+    function: Callable[[], None],
+    events: Optional[EventWriter] = None,
+    invocation_directory: Optional[str] = None,
+):
+    """Call function, unless the same args are already running in the project.
+
+    In that case wait until the other invocation has finished and exit with its exit status
+    instead of doing the same work a second time. Invocations are the same if they have the
+    same args and invocation_directory (which $invocation_directory and relative paths in args
+    depend on); environment variables aren't compared.
+    """
+    if fcntl is None:
+        return function()
+
+    directory = os.path.join(cache_directory(project_root), "locks")
+    os.makedirs(directory, exist_ok=True)
+    key = hashlib.sha256(
+        json.dumps([invocation_directory, args]).encode("utf-8", "surrogateescape")
+    ).hexdigest()
+    status_file = os.path.join(directory, f"{key}.status")
+    lock_file = os.path.join(directory, f"{key}.lock")
+
+    with open(lock_file, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            waiting_since = time.time()
+            owner = _read_owner(lock_file)
+            where = ""
+            if owner is not None:
+                # Its output only goes to wherever it was started
+                where = f" (pid {owner['pid']}"
+                where += f" in {owner['terminal']})" if owner.get("terminal") else ")"
+            print(
+                f"{colored('note:', 'blue', attrs=['bold'])} Waiting for the already "
+                f"running `{shlex.join(['lus'] + args)}`{where} to finish, its output is shown "
+                f"there ...",
+                file=sys.stderr,
+                flush=True,
+            )
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(status_file, "r") as f:
+                    result = json.load(f)
+            except (OSError, ValueError):
+                result = None
+            # Only reuse the result if it's from the run we've waited for (and it wasn't aborted)
+            if result is not None and result["finished"] >= waiting_since:
+                print(
+                    f"{colored('note:', 'blue', attrs=['bold'])} Reusing its exit status "
+                    f"{result['status']}",
+                    file=sys.stderr,
+                    flush=True,
+                )
+                if events is not None:
+                    events.emit("shared", args=args, status=result["status"])
+                raise SystemExit(result["status"])
+
+        # For the invocations waiting for this one, see above
+        lock.truncate(0)
+        json.dump({"pid": os.getpid(), "terminal": _terminal()}, lock)
+        lock.flush()
+
+        status = None
+        try:
+            function()
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            raise
+        except subprocess.CalledProcessError as e:
+            status = e.returncode
+            raise
+        finally:
+            # status stays None for Ctrl+C or crashes, so that waiting invocations run themselves
+            if status is not None:
+                tmp_file = f"{status_file}.{os.getpid()}.tmp"
+                with open(tmp_file, "w") as f:
+                    json.dump({"finished": time.time(), "status": status}, f)
+                os.replace(tmp_file, status_file)
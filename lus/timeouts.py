@@ -0,0 +1,104 @@
+"""Timeouts of commands and subcommands (timeout="10m") and of whole runs (--deadline).
+
+Commands that have to finish by a deadline run in a process group of their own. When it
+passes, the whole group gets SIGTERM and, if the command is still running after a grace
+period, SIGKILL, so that nothing it started keeps running.
+"""
+
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+# Exit status of commands and runs that were stopped, like for GNU timeout
+TIMEOUT_STATUS = 124
+
+# How long a command may take to exit after SIGTERM before it gets SIGKILL
+TERMINATE_GRACE = 10
+
+_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h|d)")
+
+
+def parse_duration(value: Any) -> float:
+    """Parse a duration like 90 (seconds), "90s", "10m", "1h30m" or "500ms" into seconds."""
+    text = str(value).strip()
+    seconds = None
+    try:
+        seconds = float(text)
+    except ValueError:
+        position = 0
+        for match in _DURATION_PART.finditer(text):
+            if match.start() != position:
+                break
+            seconds = (seconds or 0) + float(match.group(1)) * _UNITS[match.group(2)]
+            position = match.end()
+        if position != len(text):
+            seconds = None
+    if seconds is None or not seconds > 0:
+        raise ValueError(f"Invalid duration '{value}', expected e.g. 90s, 10m or 1h30m")
+    return seconds
+
+
+@dataclass(frozen=True)
+class Deadline:
+    # In terms of time.monotonic()
+    time: float
+    # What set it, e.g. "timeout=10m of `lus test`"
+    reason: str
+
+    @classmethod
+    def after(cls, seconds: float, reason: str) -> "Deadline":
+        return cls(time.monotonic() + seconds, reason)
+
+    def remaining(self) -> float:
+        return max(0.0, self.time - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.time
+
+
+def earliest(first: Optional[Deadline], second: Optional[Deadline]) -> Optional[Deadline]:
+    if first is None or (second is not None and second.time < first.time):
+        return second
+    return first
+
+
+def process_group_options() -> Dict[str, Any]:
+    """Popen arguments that start the child in a new process group."""
+    if sys.version_info >= (3, 11):
+        return {"process_group": 0}
+    # A function implemented in C, as Python code in a preexec_fn isn't safe with threads
+    return {"preexec_fn": os.setpgrp}
+
+
+def signal_group(process: subprocess.Popen, signal_number: int):
+    """Send a signal to the process group started with process_group_options()."""
+    try:
+        os.killpg(process.pid, signal_number)
+    except (ProcessLookupError, PermissionError):
+        pass  # everything in it has exited already
+
+
+def terminate(process: subprocess.Popen, grace: Optional[float] = None) -> int:
+    """Stop process and everything else in its process group, return its exit status."""
+    grace = TERMINATE_GRACE if grace is None else grace
+    if os.name == "nt":
+        process.terminate()
+        try:
+            return process.wait(grace)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            return process.wait()
+    signal_group(process, signal.SIGTERM)
+    try:
+        status = process.wait(grace)
+    except subprocess.TimeoutExpired:
+        status = None
+    # Also children that ignore SIGTERM or outlived the command
+    signal_group(process, signal.SIGKILL)
+    return process.wait() if status is None else status
@@ -0,0 +1,126 @@
+"""Persistent workers, which are started once and then handle many invocations.
+
+This uses the JSON flavour of Bazel's persistent worker protocol: The tool is started with
+--persistent_worker and receives one request per line on stdin, e.g.
+
+    {"arguments": ["--out", "foo.h", "foo.idl"], "requestId": 0}
+
+to which it answers with one line on stdout:
+
+    {"exitCode": 0, "output": "text to show to the user", "requestId": 0}
+"""
+
+import json
+import subprocess
+import threading
+from typing import Dict, List, Mapping, Optional, Tuple
+
+# How long a worker may take to exit after its stdin has been closed
+SHUTDOWN_TIMEOUT = 5
+
+
+class WorkerError(RuntimeError):
+    """A worker exited without a response or answered with something that isn't one."""
+
+    def __init__(self, message: str, returncode: Optional[int]):
+        super().__init__(message)
+        # Exit status of the worker, if it has exited
+        self.returncode = returncode
+
+
+class Worker:
+    def __init__(self, startup_args: List[str], cwd: str, env: Mapping[str, str]):
+        self.startup_args = startup_args
+        self.process = subprocess.Popen(
+            startup_args + ["--persistent_worker"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            text=True,
+        )
+
+    def request(self, arguments: List[str], timeout: Optional[float] = None) -> Tuple[int, str]:
+        """Send one request and return (exit status, output) of the response.
+
+        Raises subprocess.TimeoutExpired, after killing the worker, if there's no response within
+        timeout seconds.
+        """
+        try:
+            self.process.stdin.write(
+                json.dumps({"arguments": arguments, "requestId": 0}) + "\n"
+            )
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+        if timeout is None:
+            line = self.process.stdout.readline()
+        else:
+            lines = []
+            reader = threading.Thread(
+                target=lambda: lines.append(self.process.stdout.readline()), daemon=True
+            )
+            reader.start()
+            reader.join(timeout)
+            if reader.is_alive():
+                self.process.kill()
+                reader.join()
+                raise subprocess.TimeoutExpired(self.startup_args, timeout)
+            line = lines[0]
+        if not line:
+            raise WorkerError(
+                f"Persistent worker {' '.join(self.startup_args)} exited without a response",
+                self.process.wait(),
+            )
+        try:
+            response = json.loads(line)
+        except ValueError:
+            raise WorkerError(
+                f"Invalid response from persistent worker {' '.join(self.startup_args)}: {line!r}",
+                self.process.poll(),
+            )
+        return int(response.get("exitCode", 0)), response.get("output", "")
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            self.process.wait(SHUTDOWN_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+
+
+class WorkerPool:
+    """Idle workers, by startup command, working directory and environment."""
+
+    def __init__(self):
+        self._idle: Dict[Tuple, List[Worker]] = {}
+
+    def run(
+        self,
+        startup_args: List[str],
+        arguments: List[str],
+        cwd: str,
+        env: Mapping[str, str],
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, str]:
+        key = (tuple(startup_args), cwd, hash(frozenset(env.items())))
+        idle = self._idle.setdefault(key, [])
+        worker = idle.pop() if idle else Worker(startup_args, cwd, env)
+        try:
+            result = worker.request(arguments, timeout)
+        except BaseException:
+            worker.close()
+            raise
+        idle.append(worker)
+        return result
+
+    def close(self):
+        for workers in self._idle.values():
+            for worker in workers:
+                worker.close()
+        self._idle.clear()
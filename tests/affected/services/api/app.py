@@ -0,0 +1 @@
+app = 1
@@ -0,0 +1 @@
+fn parse() {}
@@ -1,17 +1,30 @@
+import concurrent.futures
+import json
 import os
+import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import time
 
+import pytest
 
-def lus(*args, force_color=True):
+# Keep the run history etc. of the tests out of the user's cache directory
+CACHE_HOME = tempfile.mkdtemp(prefix="lus-tests-")
+
+
+def lus(*args, force_color=True, cwd=None):
     """Run the lus command with the given arguments."""
     return subprocess.run(
         [sys.executable, "-m", "lus"] + list(args),
+        cwd=cwd,
         capture_output=True,
         text=True,
         env=os.environ
         | {
             "PYTHONPATH": os.path.join(os.path.dirname(__file__), ".."),
+            "XDG_CACHE_HOME": CACHE_HOME,
         }
         | ({"FORCE_COLOR": "1"} if force_color else {}),
     )
@@ -224,3 +237,583 @@ def test_invocation_directory():
         assert result.returncode == 0
     finally:
         os.chdir(original_cwd)
+
+
+def test_include():
+    os.chdir(os.path.join(os.path.dirname(__file__), "include"))
+
+    # broken/lus.kdl is only mounted, so it mustn't be parsed for other subcommands
+    result = lus("local")
+    assert result.stderr == ""
+    assert result.stdout == "local\n"
+    assert result.returncode == 0
+
+    result = lus("hello", "world")
+    assert result.stderr == ""
+    assert result.stdout == "hello world\n"
+    assert result.returncode == 0
+
+    result = lus("api", "build")
+    assert result.stderr == ""
+    assert result.stdout == "building in api\n"
+    assert result.returncode == 0
+
+    result = lus("from-sub")
+    assert result.stderr == ""
+    assert result.stdout == "hello from lib\n"
+    assert result.returncode == 0
+
+    # a subcommand of an included file calling one of lib/lus.kdl through the main lus.kdl
+    result = lus("greet")
+    assert result.stderr == ""
+    assert result.stdout == "hello from greet\n"
+    assert result.returncode == 0
+
+    # mounted by lib/lus.kdl, relative to it
+    result = lus("extra", "deep")
+    assert result.stderr == ""
+    assert result.stdout == "deep in extra\n"
+    assert result.returncode == 0
+
+    result = lus("broken", force_color=False)
+    assert result.stderr.startswith("error: broken/lus.kdl:1:")
+    assert result.returncode == 1
+
+    result = lus("-l", force_color=False)
+    assert result.stderr == ""
+    assert (
+        result.stdout
+        == """Available subcommands:
+    local    # defined in this file
+    api      # mounted, only parsed when dispatched
+    broken
+    from-sub # includes are relative to this file, not to the working directory
+    hello    # defined in lib/lus.kdl
+    greet
+    extra
+"""
+    )
+    assert result.returncode == 0
+
+
+def test_output():
+    os.chdir(os.path.join(os.path.dirname(__file__), "output"))
+
+    result = lus("--output", "prefix", "build")
+    assert result.stderr == ""
+    assert result.stdout == "[build] one\n[build] two\n"
+    assert result.returncode == 0
+
+    result = lus("--output", "group", "build")
+    assert result.stderr == ""
+    assert result.stdout == "one\ntwo\n"
+    assert result.returncode == 0
+
+    result = lus("--output", "prefix", "fail")
+    assert result.stderr == ""
+    assert (
+        result.stdout
+        == "[fail] oops\n[fail] failed with exit code 3, last 1 lines:\n    oops\n"
+    )
+    assert result.returncode == 3
+
+
+def test_output_filter(monkeypatch):
+    os.chdir(os.path.join(os.path.dirname(__file__), "output"))
+    monkeypatch.setenv("DEPLOY_TOKEN", "hunter22")
+    # Only names ending in e.g. _TOKEN are secrets
+    monkeypatch.setenv("TOKENIZERS_PARALLELISM", "false")
+
+    result = lus("--filter", "strip-ansi", "--filter", "mask-secrets", "deploy")
+    assert result.stderr == ""
+    lines = result.stdout.splitlines()
+    # The printed commands are masked as well
+    assert lines[:2] == ["echo 'token ***'", "token ***"]
+    assert lines[3] == "red ***"
+    assert lines[5] == "parallel false"
+    assert "hunter22" not in result.stdout
+    assert result.returncode == 0
+
+    result = lus("--filter", "timestamps", "--output", "prefix", "build")
+    assert re.fullmatch(
+        r"\d\d:\d\d:\d\d\.\d{3} \[build\] one\n\d\d:\d\d:\d\d\.\d{3} \[build\] two\n",
+        result.stdout,
+    )
+
+    # py runs in the lus process or a worker, whose output is labelled all the same
+    result = lus("--output", "prefix", "python")
+    assert result.stderr == ""
+    assert (
+        result.stdout == "[python] here hunter22\n[python] oops\n[python] isolated hunter22\n"
+    )
+    assert result.returncode == 0
+
+    result = lus("--filter", "mask-secrets", "python")
+    assert result.stderr == ""
+    assert result.stdout == "here ***\noops\nisolated ***\n"
+    assert result.returncode == 0
+
+    # Without filters the output stays untouched
+    result = lus("deploy")
+    assert "\x1b[31mred\x1b[0m hunter22\n" in result.stdout
+
+
+def test_stats():
+    os.chdir(os.path.join(os.path.dirname(__file__), "output"))
+
+    lus("build")
+    lus("build")
+    lus("fail")
+
+    result = lus("--stats", "build", force_color=False)
+    assert result.stderr == ""
+    lines = result.stdout.splitlines()
+    assert lines[0].startswith("build: ")
+    assert int(lines[0].split()[1]) >= 2
+    assert "p50" in lines[0] and "p95" in lines[0]
+    assert "python -c" in lines[1]
+    assert result.returncode == 0
+
+    result = lus("--stats", "fail", force_color=False)
+    assert result.stdout.startswith("fail: ")
+    assert "failed" in result.stdout
+    assert result.returncode == 0
+
+
+@pytest.mark.skipif(os.name == "nt", reason="sharing needs fcntl")
+def test_sharing(tmp_path, monkeypatch):
+    root = tmp_path / "sharing"
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "sharing"), root)
+    (root / "sub").mkdir()
+    os.chdir(root)
+    runs_file = tmp_path / "runs.txt"
+    monkeypatch.setenv("RUNS_FILE", str(runs_file))
+
+    def delayed_lus(delay, *args, cwd=None):
+        time.sleep(delay)
+        return lus(*args, force_color=False, cwd=cwd)
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        first = executor.submit(delayed_lus, 0, "slow")
+        second = executor.submit(delayed_lus, 0.5, "slow")
+        first, second = first.result(), second.result()
+
+    assert first.stderr == ""
+    assert first.returncode == 3
+    # The output of the first one isn't repeated, but it's said where it goes
+    assert re.fullmatch(
+        r"note: Waiting for the already running `lus slow` \(pid \d+\) to finish, its output is "
+        r"shown there \.\.\.\n"
+        r"note: Reusing its exit status 3\n",
+        second.stderr,
+    )
+    assert second.returncode == 3
+    assert runs_file.read_text() == "run\n"
+
+    # From another directory the same arguments can mean something else
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        first = executor.submit(delayed_lus, 0, "slow")
+        second = executor.submit(delayed_lus, 0.5, "slow", cwd=root / "sub")
+        assert first.result().returncode == 3
+        assert second.result().stderr == ""
+        assert second.result().returncode == 3
+    assert runs_file.read_text() == "run\nrun\nrun\n"
+
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        first = executor.submit(delayed_lus, 0, "slow")
+        second = executor.submit(delayed_lus, 0.5, "--no-share", "slow")
+        assert first.result().returncode == 3
+        assert second.result().returncode == 3
+    assert runs_file.read_text() == "run\nrun\nrun\nrun\nrun\n"
+
+
+def test_background():
+    os.chdir(os.path.join(os.path.dirname(__file__), "background"))
+
+    result = lus("dev")
+    assert result.stderr == ""
+    assert result.stdout == "fast\nslow\ndone\n"
+    assert result.returncode == 0
+
+    result = lus("fail")
+    assert result.stderr == ""
+    assert result.stdout == "fast\nfirst job failed\n"
+    assert result.returncode == 0
+
+    result = lus("implicit")
+    assert result.stderr == ""
+    assert result.stdout == "slow\n"
+    assert result.returncode == 4
+
+
+def test_bench(tmp_path, monkeypatch):
+    os.chdir(os.path.join(os.path.dirname(__file__), "bench"))
+    count_file = tmp_path / "count.txt"
+    json_file = tmp_path / "bench.json"
+    monkeypatch.setenv("COUNT_FILE", str(count_file))
+
+    result = lus(
+        "--bench",
+        "--runs",
+        "3",
+        "--warmup",
+        "1",
+        "--prepare",
+        "reset",
+        "--export-json",
+        str(json_file),
+        "count",
+        force_color=False,
+    )
+    assert result.stderr == ""
+    lines = result.stdout.splitlines()
+    assert lines[0] == "Benchmark: lus count"
+    assert "[3 runs, 1 warmup]" in lines[1]
+    assert lines[2].startswith("  Range (min … max): ")
+    assert result.returncode == 0
+
+    # Every run starts in the same directory, even though the subcommand changes it
+    parent = os.path.dirname(os.path.abspath(__file__))
+    assert count_file.read_text().splitlines() == ["reset", parent] * 4
+
+    results = json.loads(json_file.read_text())["results"]
+    assert results[0]["command"] == "lus count"
+    assert len(results[0]["times"]) == 3
+    assert results[0]["min"] <= results[0]["mean"] <= results[0]["max"]
+
+    result = lus("--bench", "fail", force_color=False)
+    assert result.stdout == ""
+    assert result.stderr == "error: `lus fail` failed with exit status 2 in run 1\n"
+    assert result.returncode == 2
+
+    # A relative --export-json is relative to the invocation directory
+    project = tmp_path / "bench"
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "bench"), project)
+    (project / "sub").mkdir()
+    os.chdir(project / "sub")
+    result = lus("--bench", "--runs", "1", "--export-json", "out.json", "reset")
+    assert result.returncode == 0
+    assert (project / "sub" / "out.json").exists()
+    assert not (project / "out.json").exists()
+
+
+def test_all(tmp_path):
+    root = tmp_path / "all"
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "all"), root)
+    os.chdir(root)
+
+    result = lus("--all", "-j", "2", "build", force_color=False)
+    assert result.stderr == ""
+    lines = result.stdout.splitlines()
+    assert "[a] building a" in lines
+    assert "[b/nested] building b/nested" in lines
+    assert "[b] failed with exit code 3, last 1 lines:" in lines
+    # c doesn't define build and hidden directories are skipped
+    assert lines[-4] == "2 passed, 1 failed, 1 without `build`"
+    assert lines[-3].split() == ["ok", "a", lines[-3].split()[2]]
+    assert lines[-2].split()[:2] == ["FAILED", "b"]
+    assert lines[-2].endswith("(exit status 3)")
+    assert lines[-1].split()[:2] == ["ok", "b/nested"]
+    assert result.returncode == 1
+
+    # New projects are found although the directory index is cached
+    (root / "c" / "d").mkdir()
+    (root / "c" / "d" / "lus.kdl").write_text('build {\n    - python -c "print(1)"\n}\n')
+    (root / "b" / "tasks.kdl").write_text("build {\n    - exit 0\n}\n")
+    result = lus("--all", "build", force_color=False)
+    assert result.stdout.splitlines()[-5] == "4 passed, 0 failed, 1 without `build`"
+    assert result.returncode == 0
+
+    result = lus("--all", force_color=False)
+    assert result.stderr == "error: --all requires a subcommand\n"
+    assert result.returncode == 1
+
+    events_file = str(tmp_path / "events.jsonl")
+    result = lus("--all", "--events-file", events_file, "build", force_color=False)
+    assert result.stderr == "error: --events-file can't be combined with --all\n"
+    assert result.returncode == 1
+
+
+def test_all_deadline(tmp_path):
+    for project in ("a", "b"):
+        (tmp_path / project).mkdir()
+        (tmp_path / project / "lus.kdl").write_text(
+            'build {\n    - python -c "import time; time.sleep(30)"\n}\n'
+        )
+    os.chdir(tmp_path)
+
+    # The first project gets the rest of the deadline, the second one isn't started after it
+    started = time.monotonic()
+    result = lus("--all", "-j", "1", "--deadline", "1", "build", force_color=False)
+    assert time.monotonic() - started < 20
+    lines = result.stdout.splitlines()
+    assert lines[-3] == "0 passed, 2 failed, 0 without `build`"
+    assert lines[-2].endswith("(exit status 124)")
+    assert lines[-1].split(None, 2)[2] == "not started, --deadline 1 passed"
+    assert result.returncode == 124
+
+
+def test_shard():
+    os.chdir(os.path.join(os.path.dirname(__file__), "shard"))
+
+    # Longest first into the emptiest shard: [slow], [medium, broken], [fast-1, fast-2]
+    result = lus("--shard", "1/3", "test-*", force_color=False)
+    assert result.stdout == "test-slow\n"
+    assert result.stderr == (
+        "note: Shard 1/3 runs 1 of the 5 subcommands matching 'test-*' (about 10.00s)\n"
+    )
+    assert result.returncode == 0
+
+    result = lus("--shard", "2/3", "test-*", force_color=False)
+    assert result.stdout == "test-medium\n"
+    assert result.stderr.endswith("error: 1 of 2 subcommands failed: test-broken\n")
+    assert result.returncode == 1
+
+    result = lus("--shard", "3/3", "test-*", force_color=False)
+    assert result.stdout == "test-fast-1\ntest-fast-2\n"
+    assert result.returncode == 0
+
+    result = lus("--shard", "4/3", "test-*", force_color=False)
+    assert result.stderr == "error: Invalid shard '4/3', expected e.g. 3/8\n"
+    assert result.returncode == 1
+
+    result = lus("--shard", "1/2", "deploy-*", force_color=False)
+    assert result.stderr == "error: No subcommand matches 'deploy-*'\n"
+    assert result.returncode == 1
+
+
+def test_shard_costs(tmp_path):
+    os.chdir(os.path.join(os.path.dirname(__file__), "shard"))
+    costs_file = tmp_path / "costs.json"
+
+    # cost= properties take precedence over the file
+    costs_file.write_text(json.dumps({"test-slow": 1, "build": 20}))
+    result = lus("--shard", "1/3", "--shard-costs", str(costs_file), "test-*", force_color=False)
+    assert result.stdout == "test-slow\n"
+    assert result.returncode == 0
+
+    costs_file.write_text('["test-slow"]')
+    result = lus("--shard", "1/3", "--shard-costs", str(costs_file), "test-*", force_color=False)
+    assert result.stderr == (
+        f"error: {costs_file} must contain a JSON object of subcommand names and seconds\n"
+    )
+    assert result.returncode == 1
+
+    result = lus("--shard-costs", str(costs_file), "build", force_color=False)
+    assert result.stderr == "error: --shard-costs requires --shard\n"
+    assert result.returncode == 1
+
+
+def test_shard_events(tmp_path):
+    os.chdir(os.path.join(os.path.dirname(__file__), "shard"))
+    events_file = tmp_path / "events.jsonl"
+
+    # Every subcommand of the shard is a run of its own
+    result = lus("--events-file", str(events_file), "--shard", "3/3", "test-*")
+    assert result.returncode == 0
+    events = [json.loads(line) for line in events_file.read_text().splitlines()]
+    assert [
+        (event["event"], event["args"]) for event in events if event["event"].startswith("run-")
+    ] == [
+        ("run-start", ["test-fast-1"]),
+        ("run-finish", ["test-fast-1"]),
+        ("run-start", ["test-fast-2"]),
+        ("run-finish", ["test-fast-2"]),
+    ]
+
+
+def test_events(tmp_path):
+    os.chdir(os.path.join(os.path.dirname(__file__), "events"))
+    events_file = tmp_path / "events.jsonl"
+
+    result = lus("--events-file", str(events_file), "build", force_color=False)
+    assert result.stdout == "built\n"
+    assert result.returncode == 2
+
+    events = [json.loads(line) for line in events_file.read_text().splitlines()]
+    assert [(event["event"], event.get("task")) for event in events] == [
+        ("run-start", None),
+        ("command", []),
+        ("task-start", ["build"]),
+        ("spawn", ["build"]),
+        ("exit", ["build"]),
+        ("command", ["build"]),
+        ("command", ["build"]),
+        ("task-start", ["build", "check"]),
+        ("command", ["build", "check"]),
+        ("task-finish", ["build", "check"]),
+        ("task-finish", ["build"]),
+        ("run-finish", None),
+    ]
+    assert events[0]["args"] == ["build"]
+    assert events[3]["argv"][:2] == ["python", "-c"]
+    assert events[4]["pid"] == events[3]["pid"]
+    assert events[4]["status"] == 0
+    assert events[8]["argv"] == ["exit", "2"]
+    assert events[9]["status"] == 2
+    assert events[-1]["status"] == 2
+    assert all(event["time"] >= events[0]["time"] for event in events)
+
+    result = lus("--events-fd", "100", "build", force_color=False)
+    assert result.stderr == "error: Bad file descriptor\n"
+    assert result.returncode == 1
+
+
+def test_resume(tmp_path, monkeypatch):
+    os.chdir(os.path.join(os.path.dirname(__file__), "resume"))
+    steps_file = tmp_path / "steps.txt"
+    monkeypatch.setenv("STEPS_FILE", str(steps_file))
+
+    monkeypatch.setenv("UPLOAD_STATUS", "1")
+    result = lus("release", force_color=False)
+    assert result.returncode == 1
+    assert steps_file.read_text() == "build 1.2.3\nupload\n"
+
+    # The build is skipped, but its cd and export still apply to the following steps
+    monkeypatch.setenv("UPLOAD_STATUS", "0")
+    result = lus("--resume", "release", force_color=False)
+    assert result.stderr.startswith("note: Resuming `lus release` after 5 finished steps\n")
+    assert result.stdout == ""  # set +x applies as well
+    assert steps_file.read_text() == "build 1.2.3\nupload\nupload\nannounce tests\n"
+    assert result.returncode == 0
+
+    # The journal of a successful run is gone
+    result = lus("--resume", "release", force_color=False)
+    assert result.stderr.startswith("note: There's no failed run of `lus release` to resume")
+    assert result.returncode == 0
+
+
+def test_resume_changed_lus_kdl(tmp_path, monkeypatch):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "resume"), tmp_path / "resume")
+    os.chdir(tmp_path / "resume")
+    monkeypatch.setenv("STEPS_FILE", str(tmp_path / "steps.txt"))
+    monkeypatch.setenv("UPLOAD_STATUS", "1")
+    assert lus("release").returncode == 1
+
+    with open("lus.kdl", "a") as f:
+        f.write("\nother {\n    - exit 0\n}\n")
+    result = lus("--resume", "release", force_color=False)
+    assert result.stderr == "error: Can't resume `lus release`, lus.kdl has changed since it failed\n"
+    assert result.returncode == 1
+
+
+def test_conditions(tmp_path):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "conditions"), tmp_path / "conditions")
+    os.chdir(tmp_path / "conditions")
+
+    result = lus("check", force_color=False)
+    assert result.stderr == ""
+    assert result.stdout == "no missing.txt\nHOME is set\nsources\n"
+
+    # $args in a condition counts as used
+    result = lus("check", "fast", force_color=False)
+    assert result.stdout == "no missing.txt\nHOME is set\nfast\n"
+    assert result.returncode == 0
+
+    os.utime("out/app.txt", (0, 0))
+    assert lus("build").stdout == "building\n"
+    os.utime("src/a.txt", (0, 0))
+    os.utime("out/app.txt", (1, 1))
+    assert lus("build").stdout == "up to date\n"
+
+    result = lus("dangling", force_color=False)
+    assert result.stderr == "error: 'else' without a preceding 'if'\n"
+    assert result.returncode == 1
+
+    # if and else nodes aren't subcommands
+    assert lus("-l", force_color=False).stdout.split() == [
+        "Available", "subcommands:", "build", "check", "dangling"
+    ]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX process groups")
+def test_timeouts(tmp_path):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "timeouts"), tmp_path / "timeouts")
+    os.chdir(tmp_path / "timeouts")
+
+    started = time.monotonic()
+    result = lus("hang", force_color=False)
+    assert time.monotonic() - started < 10
+    assert result.returncode == 124
+    assert "exceeded timeout=1s of `lus hang` and was stopped" in result.stderr
+    time.sleep(1)
+    assert not os.path.exists("grandchild.txt")
+
+    result = lus("--deadline", "1", "steps", force_color=False)
+    assert result.returncode == 124
+    assert "exceeded --deadline 1" in result.stderr.lower()
+    assert "not reached" not in result.stdout
+
+    result = lus("invalid", force_color=False)
+    assert result.stderr == "error: Invalid duration 'soon', expected e.g. 90s, 10m or 1h30m\n"
+    assert result.returncode == 1
+
+    result = lus("--deadline", "1x", "steps", force_color=False)
+    assert "Invalid duration '1x'" in result.stderr
+    assert result.returncode == 1
+
+
+def test_affected(tmp_path):
+    shutil.copytree(os.path.join(os.path.dirname(__file__), "affected"), tmp_path / "affected")
+    os.chdir(tmp_path / "affected")
+
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=lus", "-c", "user.email=lus@example.com", *args],
+            check=True,
+            capture_output=True,
+        )
+
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "initial")
+
+    result = lus("--affected", "test-*", force_color=False)
+    assert result.stdout == ""
+    assert result.stderr == (
+        "note: 0 of the 3 subcommands matching 'test-*' are affected by the 0 files changed "
+        "since HEAD\n"
+    )
+    assert result.returncode == 0
+
+    # Subcommands without inputs always run
+    assert lus("--affected", "*", force_color=False).stdout == "lint\n"
+
+    # Uncommitted and untracked files
+    with open("src/parser/lib.rs", "a") as f:
+        f.write("fn parse_more() {}\n")
+    with open("services/api/new.py", "w") as f:
+        f.write("new = 1\n")
+    result = lus("--affected", "test-*", force_color=False)
+    assert result.stdout == "test-parser\ntest-api\n"
+    assert "2 of the 3 subcommands" in result.stderr
+
+    git("add", ".")
+    git("commit", "-q", "-m", "parser and api")
+    with open("docs/index.md", "a") as f:
+        f.write("More\n")
+    git("commit", "-q", "-am", "docs")
+    assert lus("--affected", "--since", "HEAD~1", "test-*").stdout == "test-docs\n"
+    assert lus("--affected", "--since", "HEAD~2", "test-*").stdout == (
+        "test-parser\ntest-api\ntest-docs\n"
+    )
+    # Only the affected subcommands are split into shards
+    shards = [
+        lus("--affected", "--since", "HEAD~1", "--shard", shard, "test-*", force_color=False)
+        for shard in ("1/2", "2/2")
+    ]
+    assert shards[0].stdout + shards[1].stdout == "test-docs\n"
+    assert "of the 1 subcommands matching 'test-*'" in shards[0].stderr
+
+    # A change of lus.kdl affects all of its subcommands
+    with open("lus.kdl", "a") as f:
+        f.write("\n")
+    assert lus("--affected", "test-*").stdout == "test-parser\ntest-api\ntest-docs\n"
+
+    result = lus("--affected", "--since", "no-such-branch", "test-*", force_color=False)
+    assert result.stderr.startswith("error: git merge-base failed: ")
+    assert result.returncode == 1
+
+    result = lus("--affected", force_color=False)
+    assert result.stderr == "error: --affected requires a pattern, e.g. 'test-*'\n"
+    assert result.returncode == 1
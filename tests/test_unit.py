@@ -1,6 +1,18 @@
+import concurrent.futures
+import io
+import json
 import os
+import subprocess
+import sys
+import time
 import pytest
-from lus import LusFile
+from lus import LusFile, LusProject
+from lus import events, scratch, timeouts
+from lus.affected import InputIndex
+from lus.context import EnvironmentOverlay
+from lus.globbing import DirectoryCache
+from lus.jobserver import JobServer
+from lus.sharding import task_costs
 
 def test_run_cd(tmp_path):
     lusfile = LusFile("")
@@ -12,9 +24,11 @@ def test_run_cd(tmp_path):
     assert cwd != str(test_dir)
     lusfile = LusFile("")
     lusfile.run(["cd", str(test_dir)], {})
-    assert os.getcwd() == str(test_dir)
-    lusfile.run(["cd", "-"], {})
+    assert lusfile.context.cwd == str(test_dir)
+    # Only the context changes, not the working directory of the process
     assert os.getcwd() == cwd
+    lusfile.run(["cd", "-"], {})
+    assert lusfile.context.cwd == cwd
 
 
 @pytest.mark.skipif(os.name != "nt", reason="call command is Windows-only")
@@ -129,8 +143,8 @@ def test_run_call_environment_variables(tmp_path):
         lusfile.run(["call", "scripts/setenv.bat"], {})
 
         # Verify the environment variables were set
-        assert os.environ.get("MY_TEST_VAR") == "hello_world"
-        assert os.environ.get("ANOTHER_VAR") == "test123"
+        assert lusfile.context.environ.get("MY_TEST_VAR") == "hello_world"
+        assert lusfile.context.environ.get("ANOTHER_VAR") == "test123"
 
         # Clean up
         if "MY_TEST_VAR" in os.environ:
@@ -159,3 +173,565 @@ def test_run_call_ignored_on_non_windows(tmp_path):
         lusfile.run(["call", "scripts/test.bat"], {})
     finally:
         os.chdir(cwd)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="source command is POSIX-only")
+def test_run_source_environment_variables(tmp_path, monkeypatch):
+    """Test that source imports environment changes and caches them."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("SOURCE_REMOVED_VAR", "removed")
+    monkeypatch.delenv("SOURCE_TEST_VAR", raising=False)
+    script = tmp_path / "setenv.sh"
+    counter = tmp_path / "counter"
+    script.write_text(
+        f"echo run >> '{counter}'\n"
+        "export SOURCE_TEST_VAR=\"hello $1\"\n"
+        "unset SOURCE_REMOVED_VAR\n"
+    )
+
+    for i in range(2):
+        # A fresh context, so that the second run hits the cache
+        lusfile = LusFile("")
+        # Like the jobserver of `lus -j`, which differs from run to run
+        lusfile.context.environ["MAKEFLAGS"] = f"-j --jobserver-auth=fifo:/tmp/lus-jobserver-{i}"
+        lusfile.run(["source", str(script), "world"], {})
+        assert lusfile.context.environ.get("SOURCE_TEST_VAR") == "hello world"
+        assert "SOURCE_REMOVED_VAR" not in lusfile.context.environ
+        assert os.environ["SOURCE_REMOVED_VAR"] == "removed"
+
+    assert counter.read_text() == "run\n"
+
+    lusfile.run(["source", str(script), "world"], {"cache": False})
+    assert counter.read_text() == "run\nrun\n"
+
+    # The working directory is part of the cache key
+    where = tmp_path / "where.sh"
+    where.write_text('export WHERE="$(pwd)"\n')
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        lusfile.context.chdir(str(tmp_path / directory))
+        lusfile.run(["source", str(where)], {})
+        assert lusfile.context.environ["WHERE"] == str(tmp_path / directory)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="source command is POSIX-only")
+def test_run_source_missing_file(tmp_path):
+    lusfile = LusFile("")
+    with pytest.raises(FileNotFoundError):
+        lusfile.run(["source", str(tmp_path / "missing.sh")], {})
+
+
+def test_run_each(tmp_path, monkeypatch):
+    lusfile = LusFile("")
+    output = tmp_path / "output.txt"
+    write_args = [
+        sys.executable,
+        "-c",
+        "import sys; open(sys.argv[1], 'a').write(' '.join(sys.argv[2:]) + '\\n')",
+        str(output),
+    ]
+
+    lusfile.run(["each", "-j", "2", "-n", "2", "a", "b", "c", "--"] + write_args, {})
+    assert sorted(output.read_text().splitlines()) == ["a b", "c"]
+
+    output.unlink()
+    items = tmp_path / "items.txt"
+    items.write_text("x\n\ny\n")
+    lusfile.run(["each", "-j1", "-a", str(items), "--"] + write_args + ["<{}>"], {})
+    assert output.read_text() == "<x>\n<y>\n"
+
+    # Items that look like options after the first item are items
+    output.unlink()
+    lusfile.run(["each", "-j", "1", "a", "-nope", "-a.txt", "--"] + write_args, {})
+    assert output.read_text() == "a\n-nope\n-a.txt\n"
+
+    # Without items (e.g. from an empty $args) nothing runs, stdin is only read with -a -
+    output.unlink()
+    monkeypatch.setattr(sys, "stdin", io.StringIO("z\n"))
+    lusfile.run(["each", "--"] + write_args, {})
+    assert not output.exists()
+    lusfile.run(["each", "-a", "-", "--"] + write_args, {})
+    assert output.read_text() == "z\n"
+
+    with pytest.raises(SystemExit) as e:
+        lusfile.run(
+            ["each", "1", "0", "5", "--", sys.executable, "-c"]
+            + ["import sys; sys.exit(int(sys.argv[1]))"],
+            {},
+        )
+    assert e.value.code in (1, 5)
+
+    with pytest.raises(ValueError, match="requires -- before the command"):
+        lusfile.run(["each", "a", "b"], {})
+
+
+def test_glob(tmp_path):
+    for path in [
+        "a.c", "b.c", ".hidden.c", "sub/c.c", "sub/deep/d.c", "sub/x.tmp",
+        "sub/keep.tmp", "build/e.c",
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text("")
+    (tmp_path / ".gitignore").write_text("build/\n")
+    (tmp_path / "sub" / ".gitignore").write_text("*.tmp\n!keep.tmp\n")
+
+    cache = DirectoryCache()
+    assert cache.glob("*.c", str(tmp_path)) == ["a.c", "b.c"]
+    assert cache.glob("**/*.c", str(tmp_path)) == [
+        "a.c", "b.c", "build/e.c", "sub/c.c", "sub/deep/d.c"
+    ]
+    assert cache.glob("**/*.c", str(tmp_path), tracked=True) == [
+        "a.c", "b.c", "sub/c.c", "sub/deep/d.c"
+    ]
+    assert cache.glob("sub/*.tmp", str(tmp_path)) == ["sub/keep.tmp", "sub/x.tmp"]
+    assert cache.glob("sub/*.tmp", str(tmp_path), tracked=True) == ["sub/keep.tmp"]
+    assert cache.glob("build/*.c", str(tmp_path)) == ["build/e.c"]
+    assert cache.glob("*/", str(tmp_path), tracked=True) == ["sub/"]
+    assert cache.glob(".*.c", str(tmp_path)) == [".hidden.c"]
+    assert cache.glob(str(tmp_path / "sub" / "*.c"), "/") == [str(tmp_path / "sub" / "c.c")]
+    assert cache.glob("*.h", str(tmp_path)) == []
+
+    # Listings are reused until the cache is invalidated
+    (tmp_path / "new.c").write_text("")
+    assert cache.glob("*.c", str(tmp_path)) == ["a.c", "b.c"]
+    cache.invalidate()
+    assert cache.glob("*.c", str(tmp_path)) == ["a.c", "b.c", "new.c"]
+
+
+def test_glob_arguments(tmp_path, capfd):
+    (tmp_path / "a.txt").write_text("")
+    (tmp_path / "b.txt").write_text("")
+    (tmp_path / ".gitignore").write_text("*.txt\n")
+    cwd = os.getcwd()
+    try:
+        os.chdir(tmp_path)
+        LusFile(
+            "- set +x\n- echo *.txt\n- echo *.none\n- echo *.txt glob=false\n"
+            "- echo *.txt glob=tracked\n"
+            # An invalid bracket expression is passed on like any other argument
+            "- python -c \"x='abc'; print(x[2-1])\"\n"
+            # Quoted arguments, like the regular expression of grep, are only expanded with glob=
+            '- echo "a.*"\n'
+            '- echo "*.txt" glob=true\n',
+            args=[],
+        )
+    finally:
+        os.chdir(cwd)
+    assert capfd.readouterr().out == "a.txt b.txt\n*.none\n*.txt\n*.txt\nb\na.*\na.txt b.txt\n"
+
+
+def test_run_py(tmp_path, capfd):
+    lusfile = LusFile("")
+    lusfile.run(["py", "import sys; print(sys.argv[1:])", "a", "b"], {})
+    assert capfd.readouterr().out == "py 'import sys; print(sys.argv[1:])' a b\n['a', 'b']\n"
+
+    lusfile.print_commands = False
+    # Every run gets a fresh namespace
+    lusfile.run(["py", "x = 1"], {})
+    lusfile.run(["py", "print('x' in globals())"], {})
+    assert capfd.readouterr().out == "False\n"
+
+    with pytest.raises(SystemExit) as e:
+        lusfile.run(["py", "import sys; sys.exit(3)"], {})
+    assert e.value.code == 3
+
+    with pytest.raises(SystemExit) as e:
+        lusfile.run(["py", "raise RuntimeError('boom')"], {})
+    assert e.value.code == 1
+    assert "RuntimeError: boom" in capfd.readouterr().err
+
+    (tmp_path / "lus_py_helper.py").write_text(
+        "import sys\ndef main():\n    print('helper', *sys.argv[1:])\n    return 5\n"
+    )
+    cwd = os.getcwd()
+    lusfile.run(["cd", str(tmp_path)], {})
+    lusfile.run(["export"], {"LUS_PY_VAR": "context"})
+    with pytest.raises(SystemExit) as e:
+        lusfile.run(["py", "lus_py_helper:main", "x"], {})
+    assert e.value.code == 5
+    assert capfd.readouterr().out == "helper x\n"
+
+    # Code running in the lus process sees the context only while it runs
+    lusfile.run(["py", "import os; print(os.getcwd(), os.environ['LUS_PY_VAR'])"], {})
+    assert capfd.readouterr().out == f"{tmp_path} context\n"
+    assert os.getcwd() == cwd
+    assert "LUS_PY_VAR" not in os.environ
+
+    with pytest.raises(SystemExit) as e:
+        lusfile.run(["py", "import os, sys; sys.exit(len(os.getcwd()))"], {"isolate": True})
+    assert e.value.code == len(str(tmp_path))
+
+
+def test_run_worker(tmp_path, capfd):
+    worker = tmp_path / "worker.py"
+    worker.write_text(
+        "import json, os, sys\n"
+        "assert sys.argv[1:] == ['--persistent_worker']\n"
+        "for line in sys.stdin:\n"
+        "    arguments = json.loads(line)['arguments']\n"
+        "    output = f'{os.getpid()} {arguments[1:]}\\n'\n"
+        "    print(json.dumps({'exitCode': int(arguments[0]), 'output': output}), flush=True)\n"
+    )
+    lusfile = LusFile("")
+    lusfile.print_commands = False
+    try:
+        lusfile.run([sys.executable, str(worker), "0", "a"], {"worker": 2})
+        lusfile.run([sys.executable, str(worker), "0", "b"], {"worker": 2})
+        with pytest.raises(subprocess.CalledProcessError) as e:
+            lusfile.run([sys.executable, str(worker), "3", "c"], {"worker": 2})
+        assert e.value.returncode == 3
+    finally:
+        lusfile._workers.close()
+
+    # A tool that isn't a worker fails like any other command
+    (tmp_path / "exits.py").write_text("import sys\nsys.exit(2)\n")
+    (tmp_path / "garbage.py").write_text("print('hello')\ninput()\n")
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        lusfile.run([sys.executable, str(tmp_path / "exits.py"), "x"], {"worker": 2})
+    assert e.value.returncode == 2
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        lusfile.run([sys.executable, str(tmp_path / "garbage.py"), "x"], {"worker": 2})
+    assert e.value.returncode == 1
+    lusfile._workers.close()
+    captured = capfd.readouterr()
+    assert "exited without a response" in captured.err
+    assert "Invalid response from persistent worker" in captured.err
+
+    lines = captured.out.splitlines()
+    pids = {line.split()[0] for line in lines}
+    assert len(pids) == 1
+    assert [line.split(" ", 1)[1] for line in lines] == ["['a']", "['b']", "['c']"]
+
+    for value in ("x", 0, 5):
+        with pytest.raises(SystemExit) as e:
+            lusfile.run([sys.executable, str(worker), "0", "d"], {"worker": value})
+        assert e.value.code == 1
+        assert capfd.readouterr().err.startswith(f"error: Invalid worker={value} for ")
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_chunk(monkeypatch, capfd, jobs):
+    # Every argument counts as 1, 10 items fit next to the 3 fixed arguments
+    module = sys.modules[LusFile.__module__]
+    monkeypatch.setattr(module, "_argument_size", lambda arg: 1)
+    monkeypatch.setattr(module, "_argument_limit", lambda environ: 13)
+    lusfile = LusFile(
+        "- set +x\n"
+        f"- python -c \"import sys; print(len(sys.argv) - 1)\" $args chunk=true jobs={jobs}\n",
+        args=[f"item{i}" for i in range(95)],
+    )
+    counts = capfd.readouterr().out.split()
+    if jobs == 1:
+        assert counts == ["10"] * 9 + ["5"]
+    else:
+        assert sorted(counts, key=int) == ["5"] + ["10"] * 9
+    # Every batch is timed like a command of its own, also in parallel
+    batches = [timing for timing in lusfile.command_timings if timing[0].startswith("python")]
+    assert len(batches) == 10
+    assert all(status == 0 for _, _, status in batches)
+
+    if jobs > 1:
+        with pytest.raises(ValueError, match="jobs= only works for external commands"):
+            LusFile(
+                f"- py \"import sys; print(sys.argv)\" $args chunk=true jobs={jobs}\n",
+                args=[f"item{i}" for i in range(95)],
+            )
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="Linux-only scheduling")
+def test_scheduling_properties(capfd):
+    niceness = os.getpriority(os.PRIO_PROCESS, 0)
+    LusFile(
+        'build nice=5 ionice=idle {\n'
+        '    - python -c "import os; print(os.getpriority(os.PRIO_PROCESS, 0), '
+        'sorted(os.sched_getaffinity(0)))" cpus="0"\n'
+        "}\n",
+        args=["build"],
+    )
+    lines = capfd.readouterr().out.splitlines()
+    assert lines[0].endswith(" # nice=5 cpus=0 ionice=idle")
+    # nice= is an absolute level, which only privileged users may set below that of lus
+    assert lines[1] == f"{max(niceness, 5)} [0]"
+
+    for properties, message in [
+        ('cpus="x"', "Invalid CPU list: x"),
+        ("nice=42", "Invalid nice level '42', expected -20 to 19"),
+        ("ionice=low", "Invalid I/O priority class 'low'"),
+    ]:
+        with pytest.raises(SystemExit) as e:
+            LusFile(f"build {properties} {{\n    - python -c pass\n}}\n", args=["build"])
+        assert e.value.code == 1
+        assert capfd.readouterr().err.startswith(f"error: {message}")
+        with pytest.raises(SystemExit):
+            LusFile(f"- python -c pass {properties}\n", args=[])
+        assert capfd.readouterr().err.startswith(f"error: {message}")
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX-only jobserver")
+def test_jobserver(monkeypatch):
+    monkeypatch.delenv("MAKEFLAGS", raising=False)
+    jobserver = JobServer.create(3)
+    with jobserver:
+        assert "--jobserver-auth=fifo:" in os.environ["MAKEFLAGS"]
+        # lus owns one implicit job, so there are only two tokens
+        tokens = [jobserver.acquire(timeout=0), jobserver.acquire(timeout=0)]
+        assert tokens == [b"+", b"+"]
+        assert jobserver.acquire(timeout=0) is None
+
+        child = JobServer.from_environment()
+        jobserver.release(tokens.pop())
+        assert child.acquire(timeout=0) == b"+"
+    assert "MAKEFLAGS" not in os.environ
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX-only jobserver")
+def test_jobs(monkeypatch, tmp_path, capfd):
+    monkeypatch.delenv("MAKEFLAGS", raising=False)
+    monkeypatch.chdir(tmp_path)
+    # Every command counts how many commands are running at the same time
+    LusFile(
+        "- set +x\n"
+        "- each -j 8 a b c d e f -- python -c r#\"import os, sys, time; "
+        "open(sys.argv[1], 'w').close(); time.sleep(0.3); "
+        "os.write(1, b'%d %d\\n' % (len(os.listdir('.')), 'fifo:' in os.environ['MAKEFLAGS'])); "
+        "os.remove(sys.argv[1])\"#\n",
+        args=[],
+        jobs=2,
+    )
+    lines = capfd.readouterr().out.splitlines()
+    assert len(lines) == 6
+    assert all(line in ("1 1", "2 1") for line in lines)
+
+
+def test_project(tmp_path, monkeypatch, capfd):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "lus.kdl").write_text(
+        "- set +x\n"
+        "build nice=5 {\n"
+        "    - cd sub\n"
+        "    - export MODE=release\n"
+        '    - python -c "import os; print(os.environ[\'MODE\'], os.path.basename(os.getcwd()))"\n'
+        "    - lus check\n"
+        "}\n"
+        "check {\n"
+        "    - exit 3\n"
+        "}\n"
+    )
+    project = LusProject.load(str(tmp_path))
+    monkeypatch.delenv("MODE", raising=False)
+    cwd = os.getcwd()
+
+    steps = project.plan(["build"])
+    assert [step.args[0] for step in steps] == ["python", "exit"]
+    assert steps[0].task == ("build",)
+    assert steps[0].cwd == str(tmp_path / "sub")
+    assert steps[1].args == ("exit", "3")
+    assert steps[1].task == ("build", "check")
+    assert capfd.readouterr().out == ""
+
+    for _ in range(2):
+        result = project.run(["build"])
+        assert result.status == 3
+        assert not result.ok
+        assert [timing.command.split()[0] for timing in result.timings] == [
+            "set",
+            "cd",
+            "export",
+            "python",
+            "set",
+            "exit",
+        ]
+        assert result.timings[-1].status == 3
+        assert capfd.readouterr().out == "release sub\n"
+        assert os.getcwd() == cwd
+        assert "MODE" not in os.environ
+
+    with pytest.raises(ValueError):
+        project.plan(["unknown"])
+
+
+def test_execution_context(tmp_path, capfd):
+    base = {"KEEP": "1", "DROP": "2"}
+    environ = EnvironmentOverlay(base)
+    environ["NEW"] = "3"
+    del environ["DROP"]
+    copy = environ.copy()
+    copy["NEW"] = "4"
+    copy["DROP"] = "5"
+    assert dict(environ) == {"KEEP": "1", "NEW": "3"}
+    assert dict(copy) == {"KEEP": "1", "NEW": "4", "DROP": "5"}
+    assert environ.changes() == ({"NEW": "3"}, ["DROP"])
+    assert base == {"KEEP": "1", "DROP": "2"}
+
+    # A nested `lus` runs in a copy of the context, like a lus subprocess would
+    (tmp_path / "sub").mkdir()
+    project = LusProject.from_string(
+        "- set +x\n"
+        "inner {\n"
+        "    - cd sub\n"
+        "    - export INNER=1\n"
+        "    - set -x\n"
+        "}\n"
+        "outer {\n"
+        "    - lus inner\n"
+        '    - python -c "import os; print(os.path.basename(os.getcwd()), os.environ.get(\'INNER\'))"\n'
+        "}\n",
+        str(tmp_path),
+    )
+    assert project.run(["outer"]).ok
+    assert capfd.readouterr().out == f"{tmp_path.name} None\n"
+
+
+def test_event_writer_never_blocks(monkeypatch):
+    monkeypatch.setattr(events, "QUEUE_SIZE", 10)
+    read_fd, write_fd = os.pipe()
+    writer = events.EventWriter(write_fd, close_fd=True)
+    # Nobody reads yet, so the pipe fills up and then the queue
+    for i in range(1000):
+        writer.emit("command", argv=["x" * 1000], index=i)
+
+    with os.fdopen(read_fd, "rb") as f:
+        reader = concurrent.futures.ThreadPoolExecutor(1).submit(f.read)
+        writer.close()
+        lines = [json.loads(line) for line in reader.result().splitlines()]
+    indices = [line["index"] for line in lines if line["event"] == "command"]
+    assert indices == sorted(indices)
+    dropped = sum(line["count"] for line in lines if line["event"] == "dropped")
+    assert dropped > 0
+    assert len(indices) + dropped == 1000
+
+
+def test_parse_duration():
+    assert timeouts.parse_duration(90) == 90
+    assert timeouts.parse_duration("1.5") == 1.5
+    assert timeouts.parse_duration("1h30m") == 5400
+    assert timeouts.parse_duration("500ms") == 0.5
+    for value in ("", "0", "10x", "m10", "1h 30m", "-5s"):
+        with pytest.raises(ValueError, match="Invalid duration"):
+            timeouts.parse_duration(value)
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX process groups")
+def test_timeout(monkeypatch, capfd):
+    monkeypatch.setattr(timeouts, "TERMINATE_GRACE", 0.2)
+    started = time.monotonic()
+    # Ignores SIGTERM, so it takes SIGKILL after the grace period
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        LusFile(
+            "- python -c r#\"import signal, time; signal.signal(signal.SIGTERM, signal.SIG_IGN); "
+            "print('started', flush=True); time.sleep(30)\"# timeout=0.5\n"
+            "- echo not reached\n",
+            args=[],
+        )
+    assert e.value.returncode == timeouts.TIMEOUT_STATUS
+    assert time.monotonic() - started < 5
+    captured = capfd.readouterr()
+    assert "started" in captured.out
+    assert "not reached" not in captured.out
+    assert "exceeded timeout=0.5 and was stopped" in captured.err
+
+
+def test_scratch(capfd):
+    assert scratch.parse_size("512M") == 512 << 20
+    assert scratch.parse_size("1.5GiB") == 3 << 29
+    with pytest.raises(ValueError, match="Invalid size"):
+        scratch.parse_size("lots")
+
+    LusFile(
+        "- set +x\n"
+        "unpack scratch=ram scratch-size=\"1M\" {\n"
+        '    - python -c "import os, sys, tempfile; print(sys.argv[1], tempfile.gettempdir())" $scratch\n'
+        "}\n",
+        args=["unpack"],
+    )
+    path, tmpdir = capfd.readouterr().out.split()
+    assert path == tmpdir
+    assert os.path.basename(path).startswith("lus-unpack-")
+    if os.path.isdir("/dev/shm"):
+        assert path.startswith("/dev/shm/")
+    assert not os.path.exists(path)
+
+    with pytest.raises(SystemExit) as e:
+        LusFile(
+            "- set +x\n"
+            "unpack scratch=disk scratch-size=\"1K\" {\n"
+            "    - python -c r#\"open('$scratch/big', 'wb').write(b'x' * 100000)\"#\n"
+            "    - echo not reached\n"
+            "}\n",
+            args=["unpack"],
+        )
+    assert e.value.code == 1
+    captured = capfd.readouterr()
+    assert "not reached" not in captured.out
+    assert "The scratch directory of `lus unpack` uses " in captured.err
+    assert "more than its scratch-size of 1.0 KiB" in captured.err
+
+
+def test_input_index():
+    index = InputIndex()
+    index.add("src/parser/**", "parser")
+    index.add("./Cargo.lock", "parser")
+    index.add("services/api", "api")
+    index.add("docs/*.md", "docs")
+    index.add("**/*.proto", "proto")
+    index.add(".", "everything")
+    assert index.owners("src/parser/a/b.rs") == {"parser"}
+    assert index.owners("Cargo.lock") == {"parser"}
+    assert index.owners("services/api/app.py") == {"api"}
+    assert index.owners("services/apis/app.py") == set()
+    assert index.owners("docs/index.md") == {"docs"}
+    assert index.owners("docs/api/index.md") == set()
+    assert index.owners("services/api/api.proto") == {"api", "proto"}
+    assert index.affected([]) == {"everything"}
+    assert index.affected(["docs/a.md", "Cargo.lock"]) == {"everything", "docs", "parser"}
+
+
+@pytest.mark.skipif(os.name == "nt", reason="POSIX process groups")
+def test_timeout_builtins(tmp_path, capfd):
+    script = tmp_path / "slow.sh"
+    script.write_text("sleep 30\n")
+    worker = tmp_path / "worker.py"
+    worker.write_text("import sys, time\nsys.stdin.readline()\ntime.sleep(30)\n")
+    lusfile = LusFile("")
+    lusfile.print_commands = False
+    commands = [
+        (["py", "import time; time.sleep(30)"], {}),
+        (["source", str(script)], {"cache": False}),
+        ([sys.executable, str(worker), "x"], {"worker": 2}),
+    ]
+    try:
+        for args, properties in commands:
+            started = time.monotonic()
+            with pytest.raises((SystemExit, subprocess.CalledProcessError)) as e:
+                lusfile.run(args, dict(properties, timeout="500ms"))
+            code = getattr(e.value, "returncode", getattr(e.value, "code", None))
+            assert code == timeouts.TIMEOUT_STATUS
+            assert time.monotonic() - started < 5
+    finally:
+        lusfile._workers.close()
+    assert capfd.readouterr().err.count("exceeded timeout=500ms and was stopped") == 3
+
+
+def test_task_costs(tmp_path):
+    project = LusProject.from_string(
+        "test-a cost=10 {\n"
+        "    - exit 0\n"
+        "}\n"
+        "test-b {\n"
+        "    - exit 0\n"
+        "}\n"
+        "test-c {\n"
+        "    - exit 0\n"
+        "}\n"
+        "test-d {\n"
+        "    - exit 0\n"
+        "}\n",
+        str(tmp_path),
+    )
+    names = ["test-a", "test-b", "test-c", "test-d"]
+    # cost= first, then the shared file, the median of those for the rest
+    costs = task_costs(project, names, {"test-a": 1.0, "test-b": 4.0, "test-c": 2.0})
+    assert costs == {"test-a": 10.0, "test-b": 4.0, "test-c": 2.0, "test-d": 4.0}
+    # Recorded runs don't matter, so that every machine computes the same costs
+    assert project.run(["test-b"]).ok
+    assert task_costs(project, names) == {name: 10.0 for name in names}